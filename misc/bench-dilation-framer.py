@@ -0,0 +1,75 @@
+# Measure how fast the dilation _Framer can split inbound data into frames.
+#
+# Run like: python misc/bench-dilation-framer.py [FRAME_SIZE] [READ_SIZE]
+#
+# This builds a stream of frames (65535 bytes each, by default, which is a
+# full Noise message), then feeds it to a _Framer in kernel-sized reads (256
+# KiB by default), and reports frames/sec for both the old copy-per-frame
+# parser and the current one. Try a READ_SIZE of 4194304 to see what large
+# reads used to cost.
+
+import sys
+import time
+from unittest import mock
+
+from zope.interface import alsoProvides
+from twisted.internet.interfaces import ITransport
+from wormhole._dilation.connection import _Framer, Frame
+from wormhole._dilation.encode import from_be4
+
+FRAME_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 2**16 - 1
+READ_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 256 * 1024
+TOTAL = 256 * 1024 * 1024
+
+
+def legacy_parse_frame(self):
+    # the parser as it was before the bytearray/memoryview rewrite
+    if len(self._buffer) < 4:
+        return None
+    frame_length = from_be4(self._buffer[0:4])
+    if len(self._buffer) < 4 + frame_length:
+        return None
+    frame = self._buffer[4:4 + frame_length]
+    self._buffer = self._buffer[4 + frame_length:]
+    return Frame(frame=frame)
+
+
+class LegacyFramer(_Framer):
+    def _add(self, data):
+        self._buffer += data
+
+    _parse_frame = legacy_parse_frame
+
+
+def make_framer(cls):
+    t = mock.Mock()
+    alsoProvides(t, ITransport)
+    f = cls(t, b"outbound_prologue\n", b"inbound_prologue\n")
+    f.connectionMade()
+    list(f.add_and_parse(b"inbound_prologue\n"))
+    if cls is LegacyFramer:
+        f._buffer = b""
+    return f
+
+
+def run(framer, reads, count):
+    received = 0
+    start = time.perf_counter()
+    for data in reads:
+        # (without holding on to any frame, like _Record)
+        received += sum(1 for _ in framer.add_and_parse(data))
+    elapsed = time.perf_counter() - start
+    assert received == count, (received, count)
+    return elapsed
+
+
+count = TOTAL // FRAME_SIZE
+frame = b"\x00" * FRAME_SIZE
+stream = (len(frame).to_bytes(4, "big") + frame) * count
+reads = [stream[i:i + READ_SIZE] for i in range(0, len(stream), READ_SIZE)]
+print(f"{count} frames of {FRAME_SIZE} bytes, {len(reads)} reads of "
+      f"{READ_SIZE} bytes")
+for name, cls in [("before", LegacyFramer), ("after", _Framer)]:
+    elapsed = run(make_framer(cls), reads, count)
+    print(f"{name:>6}: {count / elapsed:10.0f} frames/sec "
+          f"({TOTAL / elapsed / 1e6:.0f} MB/s)")
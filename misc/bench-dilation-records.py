@@ -0,0 +1,66 @@
+# Measure how fast dilation records can be encoded and parsed.
+#
+# Run like: python misc/bench-dilation-records.py [DATA_SIZE]
+#
+# This encodes and then parses a Data-heavy stream of records (each Data
+# record, with a DATA_SIZE-byte payload (1024 by default), followed by the
+# Ack that the other side would send for it), and reports records/sec for
+# both the old namedtuple records and the current ones. Encryption is left
+# out: it costs the same for both, and would hide the difference.
+
+import sys
+import time
+from collections import namedtuple
+
+from wormhole._dilation import connection
+from wormhole._dilation.encode import to_be4, from_be4
+
+DATA_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+COUNT = 200000
+
+# the record layer as it was before the slotted/Struct rewrite
+LegacyData = namedtuple("Data", ["seqnum", "scid", "data"])
+LegacyAck = namedtuple("Ack", ["resp_seqnum"])
+
+
+def legacy_encode_record(r):
+    if isinstance(r, LegacyData):
+        assert isinstance(r.scid, int)
+        assert isinstance(r.seqnum, int)
+        return connection.T_DATA + to_be4(r.scid) + to_be4(r.seqnum) + r.data
+    if isinstance(r, LegacyAck):
+        assert isinstance(r.resp_seqnum, int)
+        return connection.T_ACK + to_be4(r.resp_seqnum)
+    raise TypeError(r)
+
+
+def legacy_parse_record(plaintext):
+    msgtype = plaintext[0:1]
+    if msgtype == connection.T_DATA:
+        scid = from_be4(plaintext[1:5])
+        seqnum = from_be4(plaintext[5:9])
+        data = plaintext[9:]
+        return LegacyData(seqnum, scid, data)
+    if msgtype == connection.T_ACK:
+        resp_seqnum = from_be4(plaintext[1:5])
+        return LegacyAck(resp_seqnum)
+    raise ValueError()
+
+
+def run(Data, Ack, encode_record, parse_record):
+    payload = b"\x00" * DATA_SIZE
+    start = time.perf_counter()
+    for seqnum in range(COUNT):
+        r = parse_record(encode_record(Data(seqnum, 1, payload)))
+        parse_record(encode_record(Ack(r.seqnum)))
+    return time.perf_counter() - start
+
+
+print(f"{COUNT} Data records of {DATA_SIZE} bytes, and {COUNT} Acks")
+for name, impl in [("before", (LegacyData, LegacyAck, legacy_encode_record,
+                               legacy_parse_record)),
+                   ("after", (connection.Data, connection.Ack,
+                              connection.encode_record,
+                              connection.parse_record))]:
+    elapsed = run(*impl)
+    print(f"{name:>6}: {2 * COUNT / elapsed:10.0f} records/sec")
@@ -0,0 +1,87 @@
+# Measure how fast transit.Connection can parse and decrypt inbound records.
+#
+# Run like: python misc/bench-transit-records.py [RECORD_SIZE] [READ_SIZE]
+#
+# This builds a stream of encrypted records (16 KiB each, by default, which
+# is what basic.FileSender produces), then feeds it to a Connection in
+# kernel-sized reads (256 KiB by default), and reports records/sec for both
+# the old copy-per-record parser and the current one. Pass a RECORD_SIZE of
+# 262144 to see what a negotiated max-record-size buys us.
+
+import sys
+import time
+from binascii import hexlify
+
+from nacl.secret import SecretBox
+from wormhole import transit
+
+RECORD_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 16 * 1024
+READ_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 256 * 1024
+TOTAL = 256 * 1024 * 1024
+KEY = b"k" * SecretBox.KEY_SIZE
+
+
+class LegacyConnection(transit.Connection):
+    # the parser as it was before the bytearray/memoryview rewrite
+    def dataReceived(self, data):
+        self.buf += data
+        self.dataReceivedRECORDS()
+
+    def dataReceivedRECORDS(self):
+        while True:
+            if len(self.buf) < 4:
+                return
+            length = int(hexlify(self.buf[:4]), 16)
+            if len(self.buf) < 4 + length:
+                return
+            encrypted, self.buf = self.buf[4:4 + length], self.buf[4 + length:]
+            record = self._decrypt_record(encrypted)
+            self.recordReceived(record)
+
+    def _decrypt_record(self, encrypted):
+        nonce_buf = encrypted[:SecretBox.NONCE_SIZE]
+        nonce = int(hexlify(nonce_buf), 16)
+        if nonce != self.next_receive_nonce:
+            raise transit.BadNonce(nonce)
+        self.next_receive_nonce += 1
+        return self.receive_box.decrypt(encrypted)
+
+
+def build_stream(count):
+    box = SecretBox(KEY)
+    plaintext = b"\x00" * RECORD_SIZE
+    out = []
+    for i in range(count):
+        encrypted = box.encrypt(plaintext, i.to_bytes(24, "big"))
+        out.append(len(encrypted).to_bytes(4, "big") + encrypted)
+    return b"".join(out)
+
+
+def run(cls, reads, count):
+    c = cls(None, None, None, "bench")
+    c.state = "records"
+    c.buf = b"" if cls is LegacyConnection else bytearray()
+    c.receive_box = SecretBox(KEY)
+    c.next_receive_nonce = 0
+    received = []
+    c.recordReceived = lambda record: received.append(len(record))
+    start = time.perf_counter()
+    for data in reads:
+        if cls is LegacyConnection:
+            c.dataReceived(data)
+        else:
+            c._dataReceived(data)
+    elapsed = time.perf_counter() - start
+    assert len(received) == count, (len(received), count)
+    return elapsed
+
+
+count = TOTAL // RECORD_SIZE
+stream = build_stream(count)
+reads = [stream[i:i + READ_SIZE] for i in range(0, len(stream), READ_SIZE)]
+print(f"{count} records of {RECORD_SIZE} bytes, {len(reads)} reads of "
+      f"{READ_SIZE} bytes")
+for name, cls in [("before", LegacyConnection), ("after", transit.Connection)]:
+    elapsed = run(cls, reads, count)
+    print(f"{name:>6}: {count / elapsed:10.0f} records/sec "
+          f"({TOTAL / elapsed / 1e6:.0f} MB/s)")
@@ -60,7 +60,6 @@ setup(name="magic-wormhole",
           "click",
           "humanize",
           "txtorcon >= 18.0.2", # 18.0.2 fixes py3.4 support
-          "zipstream-ng >= 1.7.1, <2.0.0",
           "iterable-io >= 1.0.0, <2.0.0",
           "qrcode >= 8.0",
       ],
@@ -76,6 +75,7 @@ setup(name="magic-wormhole",
               "hypothesis",
           ],
           "dilate": ["noiseprotocol"],
+          "zstd": ["zstandard"],
           "build": ["twine", "dulwich", "readme_renderer", "pysequoia", "wheel"],
       },
       test_suite="wormhole.test",
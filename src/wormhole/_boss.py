@@ -230,7 +230,7 @@ class Boss:
         self._did_start_code = True
         self._C.set_code(code)
 
-    def dilate(self, transit_relay_location=None, no_listen=False, on_status_update=None, ping_interval=None, expected_subprotocols=None):
+    def dilate(self, transit_relay_location=None, no_listen=False, on_status_update=None, ping_interval=None, expected_subprotocols=None, listener=None):
         # returns DilatedWormhole instance; see wormhole.dilate() docs
         return self._D.dilate(
             transit_relay_location,
@@ -239,6 +239,7 @@ class Boss:
             status_update=on_status_update,
             ping_interval=ping_interval,
             expected_subprotocols=expected_subprotocols,
+            listener=listener,
         )
 
     @m.input()
@@ -1,3 +1,4 @@
+import struct
 from collections import namedtuple
 from attr import attrs, attrib
 from attr.validators import instance_of
@@ -9,9 +10,9 @@ from twisted.internet.interfaces import ITransport
 from .._interfaces import IDilationConnector
 from ..observer import OneShotObserver
 from ..util import provides
-from .encode import to_be4, from_be4
+from .encode import to_be4
 from .roles import LEADER, FOLLOWER
-from ._noise import NoiseInvalidMessage, NoiseHandshakeError, NOISE_MAX_PAYLOAD, NOISE_MAX_CIPHERTEXT
+from ._noise import NoiseInvalidMessage, NoiseHandshakeError, NOISE_MAX_PAYLOAD, NOISE_MAX_CIPHERTEXT, NOISE_OVERHEAD
 
 # InboundFraming is given data and returns Frames (Noise wire-side
 # bytestrings). It handles the relay handshake and the prologue. The Frames it
@@ -79,7 +80,9 @@ class Disconnect(Exception):
 
 RelayOK = namedtuple("RelayOk", [])
 Prologue = namedtuple("Prologue", [])
-Frame = namedtuple("Frame", ["frame"])
+Frame = namedtuple("Frame", ["frame"])  # frame is a memoryview, see below
+
+FRAME_LENGTH = struct.Struct(">L")
 
 
 @attrs
@@ -88,9 +91,18 @@ class _Framer:
     _transport = attrib(validator=provides(ITransport))
     _outbound_prologue = attrib(validator=instance_of(bytes))
     _inbound_prologue = attrib(validator=instance_of(bytes))
-    _buffer = b""
     _can_send_frames = False
 
+    def __attrs_post_init__(self):
+        # Inbound data is appended to _buffer, and frames are handed out as
+        # memoryviews into it, so a frame is never copied on its way through
+        # here. _start is how much of _buffer we have already parsed: that
+        # prefix is only discarded (by _add) once it's at least half of the
+        # buffer, so a read full of small frames doesn't move the rest of the
+        # buffer down once per frame.
+        self._buffer = bytearray()
+        self._start = 0
+
     # in: use_relay
     # in: connectionMade, dataReceived
     # out: prologue_received, frame_received
@@ -161,14 +173,7 @@ class _Framer:
 
     @m.output()
     def parse_frame(self):
-        if len(self._buffer) < 4:
-            return None
-        frame_length = from_be4(self._buffer[0:4])
-        if len(self._buffer) < 4 + frame_length:
-            return None
-        frame = self._buffer[4:4 + frame_length]
-        self._buffer = self._buffer[4 + frame_length:]  # TODO: avoid copy
-        return Frame(frame=frame)
+        return self._parse_frame()
 
     want_prologue.upon(use_relay, outputs=[store_relay_handshake],
                        enter=want_relay)
@@ -189,12 +194,13 @@ class _Framer:
                     collector=first)
 
     def _get_expected(self, name, expected):
+        # this is only used before the first frame, so _start is still 0
         lb = len(self._buffer)
         le = len(expected)
         if self._buffer.startswith(expected):
             # if the buffer starts with the expected string, consume it and
             # return True
-            self._buffer = self._buffer[le:]
+            del self._buffer[:le]
             return True
         if not expected.startswith(self._buffer):
             # we're not on track: the data we've received so far does not
@@ -202,20 +208,50 @@ class _Framer:
             # Don't complain until we see the expected length, or a newline,
             # so we can capture the weird input in the log for debugging.
             if (b"\n" in self._buffer or lb >= le):
-                log.msg(f"bad {name}: {self._buffer[:le]}")
+                log.msg(f"bad {name}: {bytes(self._buffer[:le])}")
                 raise Disconnect()
             return False  # wait a bit longer
         # good so far, just waiting for the rest
         return False
 
+    def _add(self, data):
+        buf = self._buffer
+        try:
+            if self._start and self._start * 2 >= len(buf):
+                del buf[:self._start]
+                self._start = 0
+            buf += data
+        except BufferError:
+            # somebody is still holding a Frame from this buffer, which
+            # means it can't be resized. Leave it to them, and carry on with
+            # a new one.
+            self._buffer = buf[self._start:] + data
+            self._start = 0
+
+    def _parse_frame(self):
+        start = self._start
+        if len(self._buffer) - start < FRAME_LENGTH.size:
+            return None
+        (frame_length,) = FRAME_LENGTH.unpack_from(self._buffer, start)
+        end = start + FRAME_LENGTH.size + frame_length
+        if len(self._buffer) < end:
+            return None
+        frame = memoryview(self._buffer)[start + FRAME_LENGTH.size:end]
+        self._start = end
+        return Frame(frame=frame)
+
     # external API is: connectionMade, add_and_parse, and send_frame
 
     def add_and_parse(self, data):
         # we can't make this an @m.input because we can't change the state
         # from within an input. Instead, let the state choose the parser to
         # use, then use the parsed token to drive a state transition.
-        self._buffer += data
-        while True:
+        #
+        # Each Frame we yield is a memoryview into our buffer, which stays
+        # valid for as long as the caller holds it. Callers that want to keep
+        # it for longer than it takes to process it should copy it.
+        self._add(data)
+        while not self._can_send_frames:
             # it'd be nice to use an iterator here, but since self.parse()
             # dispatches to a different parser (depending upon the current
             # state), we'd be using multiple iterators
@@ -225,15 +261,29 @@ class _Framer:
             elif isinstance(token, Prologue):
                 self.got_prologue()
                 yield token  # triggers send_handshake
-            elif isinstance(token, Frame):
-                yield token
             else:
+                return
+        # We're in want_frame now, which we never leave, and where parse()
+        # always means parse_frame(). So rather than paying for a trip
+        # through the state machine for every frame, we call it directly.
+        while True:
+            token = self._parse_frame()
+            if token is None:
                 break
+            yield token
 
     def send_frame(self, frame):
         assert self._can_send_frames
         self._transport.write(to_be4(len(frame)) + frame)
 
+    def send_frame_parts(self, parts):
+        # 'parts' (each of them bytes) make up a single large frame. They go
+        # out as they are, after the length prefix, rather than being
+        # joined together (which would copy all of them again).
+        assert self._can_send_frames
+        length = sum(len(part) for part in parts)
+        self._transport.writeSequence([to_be4(length)] + parts)
+
 # RelayOK: Newline-terminated buddy-is-connected response from Relay.
 #          First data received from relay.
 # Prologue: double-newline-terminated this-is-really-wormhole response
@@ -243,18 +293,55 @@ class _Framer:
 # Message: plaintext: encoded KCM/PING/PONG/OPEN/DATA/CLOSE/ACK
 # KCM: Key Confirmation Message (encrypted b"\x00"). First frame
 #      from peer. Sent immediately by Follower, after Selection by Leader.
-# Record: namedtuple of KCM/Open/Data/Close/Ack/Ping/Pong
+# Record: KCM/Open/Data/Close/Ack/Ping/Pong (small slotted classes)
 
 
 Handshake = namedtuple("Handshake", [])
 # decrypted frames: produces KCM, Ping, Pong, Open, Data, Close, Ack
-KCM = namedtuple("KCM", [])
-Ping = namedtuple("Ping", ["ping_id"])  # ping_id is arbitrary 4-byte value
-Pong = namedtuple("Pong", ["ping_id"])
-Open = namedtuple("Open", ["seqnum", "scid", "subprotocol"])  # seqnum is integer, subprotocol is str
-Data = namedtuple("Data", ["seqnum", "scid", "data"])
-Close = namedtuple("Close", ["seqnum", "scid"])  # scid is integer
-Ack = namedtuple("Ack", ["resp_seqnum"])  # resp_seqnum is integer
+# (thousands of these go by every second, so they're slotted, and the fields
+# of the ones with a seqnum are in the order Outbound.build_record passes them)
+
+
+@attrs(slots=True)
+class KCM:
+    pass
+
+
+@attrs(slots=True)
+class Ping:
+    ping_id = attrib()  # bytes: arbitrary 4-byte value
+
+
+@attrs(slots=True)
+class Pong:
+    ping_id = attrib()  # bytes
+
+
+@attrs(slots=True)
+class Open:
+    seqnum = attrib()  # int
+    scid = attrib()  # int
+    subprotocol = attrib()  # str
+
+
+@attrs(slots=True)
+class Data:
+    seqnum = attrib()  # int
+    scid = attrib()  # int
+    data = attrib()  # bytes, or (inbound) a memoryview into the message
+
+
+@attrs(slots=True)
+class Close:
+    seqnum = attrib()  # int
+    scid = attrib()  # int
+
+
+@attrs(slots=True)
+class Ack:
+    resp_seqnum = attrib()  # int
+
+
 Records = (KCM, Ping, Pong, Open, Data, Close, Ack)
 Handshake_or_Records = (Handshake,) + Records
 
@@ -266,39 +353,71 @@ T_DATA = b"\x04"
 T_CLOSE = b"\x05"
 T_ACK = b"\x06"
 
+# message type, scid, seqnum: the header of Open, Data, and Close
+SEQ_HEADER = struct.Struct(">BLL")
+# message type, resp_seqnum
+ACK_HEADER = struct.Struct(">BL")
+MAX_SEQNUM = 2**32 - 1
+# the shortest well-formed record of each type that has a header (the others
+# need at least their type byte)
+MIN_RECORD_SIZE = {
+    T_OPEN[0]: SEQ_HEADER.size,
+    T_DATA[0]: SEQ_HEADER.size,
+    T_CLOSE[0]: SEQ_HEADER.size,
+    T_ACK[0]: ACK_HEADER.size,
+}
+
 
 def parse_record(plaintext):
-    msgtype = plaintext[0:1]
-    if msgtype == T_KCM:
+    # 'plaintext' is bytes, or a memoryview (of a large message). Data
+    # payloads (and subprotocol names) are views into it, not copies.
+    msgtype = plaintext[0] if len(plaintext) else None
+    if len(plaintext) < MIN_RECORD_SIZE.get(msgtype, 1):
+        log.err(f"received short message: {bytes(plaintext)}")
+        raise ValueError()
+    if msgtype == T_DATA[0]:
+        _, scid, seqnum = SEQ_HEADER.unpack_from(plaintext)
+        return Data(seqnum, scid, memoryview(plaintext)[SEQ_HEADER.size:])
+    if msgtype == T_ACK[0]:
+        (_, resp_seqnum) = ACK_HEADER.unpack_from(plaintext)
+        return Ack(resp_seqnum)
+    if msgtype == T_KCM[0]:
         return KCM()
-    if msgtype == T_PING:
-        ping_id = plaintext[1:5]
+    if msgtype == T_PING[0]:
+        ping_id = bytes(plaintext[1:5])
         return Ping(ping_id)
-    if msgtype == T_PONG:
-        ping_id = plaintext[1:5]
+    if msgtype == T_PONG[0]:
+        ping_id = bytes(plaintext[1:5])
         return Pong(ping_id)
-    if msgtype == T_OPEN:
-        scid = from_be4(plaintext[1:5])
-        seqnum = from_be4(plaintext[5:9])
-        subprotocol = str(plaintext[9:], "utf8")
+    if msgtype == T_OPEN[0]:
+        _, scid, seqnum = SEQ_HEADER.unpack_from(plaintext)
+        subprotocol = str(plaintext[SEQ_HEADER.size:], "utf8")
         return Open(seqnum, scid, subprotocol)
-    if msgtype == T_DATA:
-        scid = from_be4(plaintext[1:5])
-        seqnum = from_be4(plaintext[5:9])
-        data = plaintext[9:]
-        return Data(seqnum, scid, data)
-    if msgtype == T_CLOSE:
-        scid = from_be4(plaintext[1:5])
-        seqnum = from_be4(plaintext[5:9])
+    if msgtype == T_CLOSE[0]:
+        _, scid, seqnum = SEQ_HEADER.unpack_from(plaintext)
         return Close(seqnum, scid)
-    if msgtype == T_ACK:
-        resp_seqnum = from_be4(plaintext[1:5])
-        return Ack(resp_seqnum)
-    log.err(f"received unknown message type: {plaintext}")
+    log.err(f"received unknown message type: {bytes(plaintext)}")
     raise ValueError()
 
 
+def _seq_header(msgtype, r):
+    assert isinstance(r.scid, int)
+    assert isinstance(r.seqnum, int)
+    if not (0 <= r.scid <= MAX_SEQNUM and 0 <= r.seqnum <= MAX_SEQNUM):
+        raise ValueError
+    return SEQ_HEADER.pack(msgtype[0], r.scid, r.seqnum)
+
+
 def encode_record(r):
+    # Noise only encrypts bytes, so each message is built with a single
+    # concatenation: the payload is copied once, straight after its header
+    if isinstance(r, Data):
+        return _seq_header(T_DATA, r) + r.data
+    if isinstance(r, Ack):
+        assert isinstance(r.resp_seqnum, int)
+        if not 0 <= r.resp_seqnum <= MAX_SEQNUM:
+            raise ValueError
+        return ACK_HEADER.pack(T_ACK[0], r.resp_seqnum)
     if isinstance(r, KCM):
         return T_KCM
     if isinstance(r, Ping):
@@ -306,21 +425,10 @@ def encode_record(r):
     if isinstance(r, Pong):
         return T_PONG + r.ping_id
     if isinstance(r, Open):
-        assert isinstance(r.scid, int)
-        assert isinstance(r.seqnum, int)
         assert isinstance(r.subprotocol, str)
-        return T_OPEN + to_be4(r.scid) + to_be4(r.seqnum) + r.subprotocol.encode("utf8")
-    if isinstance(r, Data):
-        assert isinstance(r.scid, int)
-        assert isinstance(r.seqnum, int)
-        return T_DATA + to_be4(r.scid) + to_be4(r.seqnum) + r.data
+        return _seq_header(T_OPEN, r) + r.subprotocol.encode("utf8")
     if isinstance(r, Close):
-        assert isinstance(r.scid, int)
-        assert isinstance(r.seqnum, int)
-        return T_CLOSE + to_be4(r.scid) + to_be4(r.seqnum)
-    if isinstance(r, Ack):
-        assert isinstance(r.resp_seqnum, int)
-        return T_ACK + to_be4(r.resp_seqnum)
+        return _seq_header(T_CLOSE, r)
     raise TypeError(r)
 
 
@@ -342,6 +450,7 @@ class _Record:
 
     def __attrs_post_init__(self):
         self._noise.start_handshake()
+        self._want_message = False  # set when we reach want_message
 
     # in: role=
     # in: prologue_received, frame_received
@@ -408,7 +517,7 @@ class _Record:
     @n.output()
     def process_handshake(self, frame):
         try:
-            payload = self._noise.read_message(frame)
+            payload = self._noise.read_message(bytes(frame))
             # Noise can include unencrypted data in the handshake, but we don't
             # use it
             del payload
@@ -419,37 +528,57 @@ class _Record:
 
     @n.output()
     def decrypt_message(self, frame):
+        return self._decrypt_message(frame)
+
+    @n.output()
+    def start_decrypting_directly(self, frame):
+        self._want_message = True
+
+    def _decrypt_message(self, frame):
         # opposite of the encoding: if we have _more_ than what a
         # single Noise packet can hold, we have to build up the real
         # plaintext incrementally.
-        size = len(frame)
         try:
-            if size <= NOISE_MAX_CIPHERTEXT:
-                message = self._noise.decrypt(frame)
+            # Noise wants bytes, so this is where each byte of the frame
+            # gets copied out of the framer's buffer (exactly once)
+            if len(frame) <= NOISE_MAX_CIPHERTEXT:
+                message = self._noise.decrypt(bytes(frame))
             else:
-                start = 0
-                message = b""
-                while start < size:
-                    ciphertext = frame[start:start + NOISE_MAX_CIPHERTEXT]
-                    message += self._noise.decrypt(ciphertext)
-                    start += NOISE_MAX_CIPHERTEXT
+                message = self._decrypt_chunks(frame)
         except NoiseInvalidMessage as e:
             # if this happens during tests, flunk the test
             log.err(e, "bad inbound noise frame")
             raise Disconnect()
         return parse_record(message)
 
+    def _decrypt_chunks(self, frame):
+        # each chunk's plaintext goes straight into its place in one
+        # preallocated buffer, rather than being appended to a growing
+        # bytestring (which would copy everything before it, every time)
+        size = len(frame)
+        chunks = -(-size // NOISE_MAX_CIPHERTEXT)
+        message = bytearray(max(size - chunks * NOISE_OVERHEAD, 0))
+        out = 0
+        for start in range(0, size, NOISE_MAX_CIPHERTEXT):
+            ciphertext = bytes(frame[start:start + NOISE_MAX_CIPHERTEXT])
+            plaintext = self._noise.decrypt(ciphertext)
+            message[out:out + len(plaintext)] = plaintext
+            out += len(plaintext)
+        return memoryview(message)
+
     no_role_set.upon(set_role_leader, outputs=[], enter=want_prologue_leader)
     want_prologue_leader.upon(got_prologue, outputs=[send_handshake],
                               enter=want_handshake_leader)
-    want_handshake_leader.upon(got_frame, outputs=[process_handshake],
+    want_handshake_leader.upon(got_frame, outputs=[process_handshake,
+                                                   start_decrypting_directly],
                                collector=first, enter=want_message)
 
     no_role_set.upon(set_role_follower, outputs=[], enter=want_prologue_follower)
     want_prologue_follower.upon(got_prologue, outputs=[],
                                 enter=want_handshake_follower)
     want_handshake_follower.upon(got_frame, outputs=[process_handshake,
-                                                     ignore_and_send_handshake],
+                                                     ignore_and_send_handshake,
+                                                     start_decrypting_directly],
                                  collector=first, enter=want_message)
 
     want_message.upon(got_frame, outputs=[decrypt_message],
@@ -462,7 +591,11 @@ class _Record:
 
     def add_and_unframe(self, data):
         for token in self._framer.add_and_parse(data):
-            if isinstance(token, Prologue):
+            if self._want_message:
+                # want_message never leaves itself, and got_frame() there
+                # only means decrypt_message(), so skip the state machine
+                yield self._decrypt_message(token.frame)
+            elif isinstance(token, Prologue):
                 self.got_prologue()  # triggers send_handshake
             else:
                 assert isinstance(token, Frame)
@@ -471,19 +604,16 @@ class _Record:
     def send_record(self, r):
         message = encode_record(r)
         if len(message) <= NOISE_MAX_PAYLOAD:
-            frame = self._noise.encrypt(message)
-        else:
-            # we want to put all the encrypted bytes into one "frame",
-            # but there are more bytes than we can fit in a Noise
-            # message .. so we chop them up
-            start = 0
-            frame = b""
-            while start < len(message):
-                this_msg = message[start:start + NOISE_MAX_PAYLOAD]
-                cip = self._noise.encrypt(this_msg)
-                frame += cip
-                start += NOISE_MAX_PAYLOAD
-        self._framer.send_frame(frame)
+            self._framer.send_frame(self._noise.encrypt(message))
+            return
+        # we want to put all the encrypted bytes into one "frame", but
+        # there are more bytes than we can fit in a Noise message .. so we
+        # chop them up, encrypt each piece, and the framer sends the
+        # pieces one after another without joining them together
+        self._framer.send_frame_parts([
+            self._noise.encrypt(message[start:start + NOISE_MAX_PAYLOAD])
+            for start in range(0, len(message), NOISE_MAX_PAYLOAD)
+        ])
 
 
 @attrs(eq=False)
@@ -520,6 +650,7 @@ class DilatedConnectionProtocol(Protocol):
         self._disconnected = OneShotObserver(self._eventual_queue)
         self._can_send_records = False
         self._inbound_record_queue = []
+        self._selected = False  # set when we reach 'selected'
 
     @m.state(initial=True)
     def unselected(self):
@@ -586,10 +717,15 @@ class DilatedConnectionProtocol(Protocol):
     def deliver_record(self, record):
         self._manager.got_record(record)
 
+    @m.output()
+    def start_delivering_directly(self, manager):
+        self._selected = True
+
     unselected.upon(got_kcm, outputs=[add_candidate], enter=selecting)
     selecting.upon(got_record, outputs=[queue_inbound_record], enter=selecting)
     selecting.upon(select,
-                   outputs=[set_manager, send_status_have_peer, can_send_records, process_inbound_queue],
+                   outputs=[set_manager, send_status_have_peer, can_send_records, process_inbound_queue,
+                            start_delivering_directly],
                    enter=selected)
     selected.upon(got_record, outputs=[deliver_record], enter=selected)
 
@@ -643,6 +779,10 @@ class DilatedConnectionProtocol(Protocol):
                     # if we're the leader, add this connection as a candidate.
                     # if we're the follower, accept this connection.
                     self.got_kcm()  # connector.add_candidate()
+                elif self._selected:
+                    # 'selected' never leaves itself, and got_record() there
+                    # only means deliver_record(), so skip the state machine
+                    self._manager.got_record(token)
                 else:
                     self.got_record(token)  # manager.got_record()
         except Disconnect:
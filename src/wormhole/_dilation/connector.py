@@ -38,6 +38,15 @@ def build_sided_relay_handshake(key, side):
 
 PROLOGUE_LEADER = b"Magic-Wormhole Dilation Handshake v1 Leader\n\n"
 PROLOGUE_FOLLOWER = b"Magic-Wormhole Dilation Handshake v1 Follower\n\n"
+
+
+def build_routed_prologue(prologue, key):
+    # newer peers follow the prologue with a token that is unique to this
+    # wormhole, for the benefit of a SharedListener
+    token = HKDF(key, 16, CTXinfo=b"dilation_routing_token")
+    return prologue + b"route " + hexlify(token) + b"\n\n"
+
+
 NOISEPROTO = b"Noise_NNpsk0_25519_ChaChaPoly_BLAKE2s"
 
 
@@ -86,6 +95,10 @@ class Connector:
     _side = attrib(validator=instance_of(str))
     # was self._side = bytes_to_hexstr(os.urandom(8)) # unicode
     _role = attrib()
+    # a listener.SharedListener, to use instead of a port of our own
+    _listener = attrib(default=None)
+    # whether the prologues carry a routing token (see build_routed_prologue)
+    _routed = attrib(validator=instance_of(bool), default=False)
 
     m = MethodicalMachine()
     set_trace = getattr(m, "_setTrace", lambda self, f: None)  # pragma: no cover
@@ -108,6 +121,14 @@ class Connector:
         self._winning_connection = None
         self._timing = self._timing or DebugTiming()
         self._timing.add("transit")
+        if self._role is LEADER:
+            prologues = (PROLOGUE_LEADER, PROLOGUE_FOLLOWER)
+        else:
+            prologues = (PROLOGUE_FOLLOWER, PROLOGUE_LEADER)
+        if self._routed:
+            prologues = tuple(build_routed_prologue(p, self._dilation_key)
+                              for p in prologues)
+        self._outbound_prologue, self._inbound_prologue = prologues
 
     # this describes what our Connector can do, for the initial advertisement
     @classmethod
@@ -124,16 +145,13 @@ class Connector:
         noise.set_psks(self._dilation_key)
         if self._role is LEADER:
             noise.set_as_initiator()
-            outbound_prologue = PROLOGUE_LEADER
-            inbound_prologue = PROLOGUE_FOLLOWER
         else:
             noise.set_as_responder()
-            outbound_prologue = PROLOGUE_FOLLOWER
-            inbound_prologue = PROLOGUE_LEADER
         p = DilatedConnectionProtocol(self._eventual_queue, self._role,
                                       description,
                                       self, noise,
-                                      outbound_prologue, inbound_prologue)
+                                      self._outbound_prologue,
+                                      self._inbound_prologue)
         return p
 
     @m.state(initial=True)
@@ -281,10 +299,15 @@ class Connector:
         return addresses
 
     def _start_listener(self, addresses):
-        # TODO: listen on a fixed port, if possible, for NAT/p2p benefits, also
-        # to make firewall configs easier
-        # TODO: retain listening port between connection generations?
-        ep = serverFromString(self._reactor, "tcp:0")
+        # To listen on a fixed port (for NAT/p2p benefits, and to make
+        # firewall configs easier), and keep it between connection
+        # generations, give us a SharedListener.
+        if self._listener:
+            # the peer will start with their prologue, which (with a routing
+            # token) only they can send
+            ep = self._listener.endpoint(self._inbound_prologue)
+        else:
+            ep = serverFromString(self._reactor, "tcp:0")
         f = InboundConnectionFactory(self)
         d = ep.listen(f)
 
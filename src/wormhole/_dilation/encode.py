@@ -11,7 +11,7 @@ def to_be4(value):
 
 
 def from_be4(b):
-    if not isinstance(b, bytes):
+    if not isinstance(b, (bytes, bytearray, memoryview)):
         raise TypeError(repr(b))
     if len(b) != 4:
         raise ValueError
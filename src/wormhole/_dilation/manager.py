@@ -30,7 +30,20 @@ from .._status import (DilationStatus, WormholeStatus,
 # experimentation or non-standard versions; the _order_ of versions in
 # "can-dilate" is important!
 # versions shall be named after wizards from the "Earthsea" series by le Guin
-DILATION_VERSIONS = ["ged"]
+DILATION_VERSIONS = ["ogion", "ged"]
+
+# Versions in which the receiver may acknowledge OPEN/DATA/CLOSE records
+# cumulatively: one ACK (of the highest seqnum so far) for up to ACK_EVERY
+# records, sent at most ACK_DELAY seconds after the first of them arrived.
+# "ged" peers expect an ACK for every record.
+DELAYED_ACK_VERSIONS = {"ogion"}
+ACK_EVERY = 16
+ACK_DELAY = 0.02
+
+# Versions in which each prologue is followed by a routing token derived from
+# the dilation key, so a listener.SharedListener can tell which wormhole an
+# inbound connection belongs to.
+ROUTED_PROLOGUE_VERSIONS = {"ogion"}
 
 
 class OldPeerCannotDilateError(Exception):
@@ -319,6 +332,7 @@ class Manager:
     _no_listen = attrib(validator=instance_of(bool), default=False)
     _status = attrib(default=None)  # callable([DilationStatus])
     _initial_mailbox_status = attrib(default=None)  # WormholeStatus
+    _listener = attrib(default=None)  # listener.SharedListener
 
     _dilation_key = None
     _tor = None  # TODO
@@ -372,6 +386,12 @@ class Manager:
         self._traffic = None
         self._timer = None
 
+        # delayed acks (see DELAYED_ACK_VERSIONS)
+        self._delay_acks = False
+        self._ack_seqnum = -1  # the highest seqnum we've received
+        self._unacked = 0  # records received since we last sent an ACK
+        self._ack_timer = None
+
     def _signal_reconnect(self):
         """
         Called by the TrafficTimer machine if we should re-connect (due to
@@ -414,10 +434,10 @@ class Manager:
 
     def got_wormhole_versions(self, their_wormhole_versions):
         # this always happens before received_dilation_message
-        self._dilation_version = _find_shared_versions(
+        self._use_version(_find_shared_versions(
             self._acceptable_versions,
             their_wormhole_versions.get("can-dilate", [])
-        )
+        ))
 
         if not self._dilation_version:  # "ged" or None
             # TODO: be more specific about the error. dilation_version==None
@@ -428,6 +448,10 @@ class Manager:
 
         self.start()
 
+    def _use_version(self, dilation_version):
+        self._dilation_version = dilation_version
+        self._delay_acks = dilation_version in DELAYED_ACK_VERSIONS
+
     # from _boss.Boss
     def _wormhole_status(self, wormhole_status):
         self._maybe_send_status(
@@ -574,6 +598,12 @@ class Manager:
         if self._timer is not None:
             self._timer.cancel()
             self._timer = None
+        # the peer will re-send anything we haven't acked yet, and then we'll
+        # ack it
+        if self._ack_timer is not None:
+            self._ack_timer.cancel()
+            self._ack_timer = None
+        self._unacked = 0
         self._connection = None
         self._inbound.stop_using_connection()
         self._outbound.stop_using_connection()  # does c.unregisterProducer
@@ -583,7 +613,10 @@ class Manager:
     def got_record(self, r):
         # records with sequence numbers: always ack, ignore old ones
         if isinstance(r, (Open, Data, Close)):
-            self.send_ack(r.seqnum)  # always ack, even for old ones
+            if self._delay_acks:
+                self._ack_later(r.seqnum)
+            else:
+                self.send_ack(r.seqnum)  # always ack, even for old ones
             if self._inbound.is_record_old(r):
                 return
             self._inbound.update_ack_watermark(r.seqnum)
@@ -623,6 +656,24 @@ class Manager:
     def send_ack(self, resp_seqnum):
         self._outbound.send_if_connected(Ack(resp_seqnum))
 
+    def _ack_later(self, seqnum):
+        # old (re-sent) records get acked too, by the same cumulative ACK
+        self._ack_seqnum = max(self._ack_seqnum, seqnum)
+        self._unacked += 1
+        if self._unacked >= ACK_EVERY:
+            self._send_delayed_ack()
+        elif self._ack_timer is None:
+            self._ack_timer = self._reactor.callLater(ACK_DELAY,
+                                                      self._send_delayed_ack)
+
+    def _send_delayed_ack(self):
+        if self._ack_timer is not None:
+            if self._ack_timer.active():
+                self._ack_timer.cancel()
+            self._ack_timer = None
+        self._unacked = 0
+        self.send_ack(self._ack_seqnum)
+
     def handle_ping(self, ping_id):
         self._peer_saw_ping()
         self.send_pong(ping_id)
@@ -770,6 +821,11 @@ class Manager:
     @m.output()
     def choose_role(self, message):
         their_side = message["side"]
+        if their_side > self._my_side:
+            # the Leader's choice of version wins
+            their_version = message.get("use-version")
+            if their_version in self._acceptable_versions:
+                self._use_version(their_version)
         if self._my_side > their_side:
             self._my_role = LEADER
             # scid 0 is reserved for the control channel. the leader uses odd
@@ -803,7 +859,10 @@ class Manager:
                                     self._no_listen, self._tor,
                                     self._timing,
                                     self._my_side,  # needed for relay handshake
-                                    self._my_role)
+                                    self._my_role,
+                                    listener=self._listener,
+                                    routed=(self._dilation_version in
+                                            ROUTED_PROLOGUE_VERSIONS))
         if self._debug_stall_connector:
             # unit tests use this hook to send messages while we know we
             # don't have a connection
@@ -975,7 +1034,7 @@ class Dilator:
     # invoked; upstream calls are basically just call-through -- so
     # all these inputs should be validated.
     def dilate(self, transit_relay_location=None, no_listen=False, wormhole_status=None, status_update=None,
-               ping_interval=None, expected_subprotocols=None):
+               ping_interval=None, expected_subprotocols=None, listener=None):
         # ensure users can only call this API once -- in the past, it
         # was possible to call the API more than once but any cal
         # after the first would have no real effect:
@@ -1000,6 +1059,7 @@ class Dilator:
                 no_listen,
                 status_update,
                 initial_mailbox_status=wormhole_status,
+                listener=listener,
             )
             self._manager = m
             if self._pending_dilation_key is not None:
@@ -171,7 +171,9 @@ class SubChannel:
     @m.output()
     def signal_dataReceived(self, data):
         assert self._protocol
-        self._protocol.dataReceived(data)
+        # inbound payloads are memoryviews into the decrypted message, and
+        # this is where they become bytes (like from any other transport)
+        self._protocol.dataReceived(bytes(data))
 
     @m.output()
     def signal_readConnectionLost(self):
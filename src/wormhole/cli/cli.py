@@ -217,11 +217,25 @@ CommonArgs = _compose(
         default=False,
         help="suppress progress-bar display",
     ),
+    click.option(
+        "--progress-fd",
+        default=None,
+        type=click.IntRange(min=0),
+        metavar="FD",
+        help="write transfer progress to file descriptor FD, as JSON lines",
+    ),
     click.option(
         "--listen/--no-listen",
         default=True,
         help="(debug) don't open a listening socket for Transit",
     ),
+    click.option(
+        "--listen-port",
+        default=None,
+        type=click.IntRange(min=1, max=65535),
+        metavar="PORT",
+        help="listen for Transit connections on PORT, rather than a random one",
+    ),
 )
 
 TorArgs = _compose(
@@ -286,6 +300,32 @@ def help(context, **kwargs):
         "any of: B,N,M,S,O,K,SK,R,RC,L,C,T"
     )
 )
+@click.option(
+    "--stripes",
+    default=1,
+    type=click.IntRange(min=1),
+    metavar="N",
+    help=("use up to N parallel Transit connections for file data,"
+          " if the receiver supports it"),
+)
+@click.option(
+    "--select-window",
+    default=0.0,
+    type=click.FloatRange(min=0),
+    metavar="SECONDS",
+    help=("measure the Transit connections that are made within SECONDS"
+          " and use the fastest, rather than the first"),
+)
+@click.option(
+    "--compress-level",
+    default=0,
+    type=click.IntRange(0, 9),
+    metavar="LEVEL",
+    help=("compress a directory at LEVEL, from 1 (fastest) to 9 (smallest):"
+          " as tar/zstd if both sides have zstandard, otherwise by"
+          " deflating the files in the zipfile that are worth it."
+          " 0 (the default) stores them uncompressed"),
+)
 @click.option(
     "--qr/--no-qr",
     default=True,
@@ -340,6 +380,13 @@ def go(f, cfg):
           " will be put inside the specified directory."
     ),
 )
+@click.option(
+    "--sync",
+    is_flag=True,
+    help=("If the directory being received exists already, update it:"
+          " only new and changed files are transferred, and files the"
+          " sender doesn't have are deleted."),
+)
 @click.option(
     "--allocate",
     "-a",
@@ -1,20 +1,27 @@
 import hashlib
 import os
+import shutil
 import sys
 import tempfile
-import zipfile
 
 from humanize import naturalsize
 from tqdm import tqdm
-from twisted.internet import reactor
+from twisted.internet import error, reactor
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.threads import deferToThread
 from twisted.python import log
 from wormhole import __version__, create, input_with_completion
 
 from ..errors import TransferError
-from ..transit import TransitReceiver
-from ..util import (bytes_to_dict, bytes_to_hexstr, dict_to_bytes,
-                    estimate_free_space)
+from ..listener import SharedListener
+from ..transit import (DEFAULT_CRYPTO_WORKERS, MAX_RECORD_SIZE, MAX_STRIPES,
+                       TransitReceiver, WriteBehindFileConsumer)
+from ..util import (ThreadedHasher, bytes_to_dict, bytes_to_hexstr,
+                    dict_to_bytes, estimate_free_space, hash_prefix,
+                    preallocate)
+from . import sync, tarzstd
+from .progress import Progress, open_progress_stream
+from .unzip import StreamingUnzipper, extract_parallel, extract_path
 from .welcome import handle_welcome
 
 APPID = "lothar.com/wormhole/text-or-file-xfer"
@@ -22,6 +29,13 @@ APPID = "lothar.com/wormhole/text-or-file-xfer"
 KEY_TIMER = float(os.environ.get("_MAGIC_WORMHOLE_TEST_KEY_TIMER", 1.0))
 VERIFY_TIMER = float(os.environ.get("_MAGIC_WORMHOLE_TEST_VERIFY_TIMER", 1.0))
 
+# While receiving a file, we record how much of it has safely landed in the
+# .tmp file (and its hash) in a sidecar file next to it, at least this often,
+# and when the connection drops. If the same file is offered again later, we
+# can ask the sender to resume from there.
+RESUME_SUFFIX = ".resume"
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+
 
 class RespondError(Exception):
     def __init__(self, response):
@@ -55,6 +69,20 @@ class Receiver:
         self._reactor = reactor
         self._tor = None
         self._transit_receiver = None
+        self._listener = None  # for --listen-port
+        self._offered_filename = None
+        self._offered_mtime = None  # of the sender's file, if it says
+        self._resume_name = None  # the checkpoint sidecar, for files
+        self._checkpoint = None
+        self._resume_from = 0
+        self._prefix_hasher = None
+        self._directory_mode = None  # if the sender offered us a choice
+        self._syncing = False  # updating an existing directory
+        # a directory is extracted here, then renamed into place (or, when
+        # syncing, each of the files in it is)
+        self._staging_dir = None
+        self._manifest = None
+        self._stale = []  # what to delete once a sync has succeeded
 
     def _msg(self, *args, **kwargs):
         print(*args, file=self.args.stderr, **kwargs)
@@ -116,8 +144,19 @@ class Receiver:
             return f
 
         d.addCallbacks(_good, _bad)
+        d.addBoth(self._stop_listening)
         yield d
 
+    def _stop_listening(self, res):
+        # a --listen-port listener outlives the Transit object that used it,
+        # so we close it ourselves once the transfer is over
+        listener, self._listener = self._listener, None
+        if not listener:
+            return res
+        d = listener.stopListening()
+        d.addBoth(lambda _: res)
+        return d
+
     @inlineCallbacks
     def _go(self, w):
         welcome = yield w.get_welcome()
@@ -244,12 +283,18 @@ class Receiver:
 
     @inlineCallbacks
     def _build_transit(self, w, sender_transit):
+        if self.args.listen_port:
+            self._listener = SharedListener(self._reactor,
+                                            port=self.args.listen_port)
         tr = TransitReceiver(
             self.args.transit_helper,
             no_listen=(not self.args.listen),
             tor=self._tor,
             reactor=self._reactor,
-            timing=self.args.timing)
+            timing=self.args.timing,
+            stripes=MAX_STRIPES,  # if the sender wants them
+            crypto_workers=DEFAULT_CRYPTO_WORKERS,
+            listener=self._listener)
         self._transit_receiver = tr
         # When I made it possible to override APPID with a CLI argument
         # (issue #113), I forgot to also change this w.derive_key() (issue
@@ -260,6 +305,7 @@ class Receiver:
                                    tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
 
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
         tr.add_connection_hints(sender_transit.get("hints-v1", []))
         receiver_abilities = tr.get_connection_abilities()
         receiver_hints = yield tr.get_connection_hints()
@@ -278,18 +324,42 @@ class Receiver:
         # transit will be created by this point, but not connected
         if "file" in them_d:
             f = self._handle_file(them_d)
+            yield self._check_resume(f)
+            with self.args.timing.add("preallocate"):
+                yield deferToThread(preallocate, f, self.xfersize)
             self._send_permission(w)
             rp = yield self._establish_transit()
             datahash = yield self._transfer_data(rp, f)
-            self._write_file(f)
-            yield self._close_transit(rp, datahash)
+            if self._resume_from:
+                yield self._check_resumed_hash(rp, f, datahash)
+                self._write_file(f)
+                yield rp.close()
+            else:
+                self._write_file(f)
+                yield self._close_transit(rp, datahash)
         elif "directory" in them_d:
             f = self._handle_directory(them_d)
-            self._send_permission(w)
-            rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
-            self._write_directory(f)
+            try:
+                if self._syncing:
+                    with self.args.timing.add("build manifest"):
+                        self._manifest = yield deferToThread(
+                            sync.build_manifest, self.abs_destname)
+                self._send_permission(w)
+                rp = yield self._establish_transit()
+                if self._syncing:
+                    yield self._receive_sync_plan(rp)
+                datahash = yield self._transfer_data(rp, f)
+                self._write_directory(f)
+            except Exception:
+                # don't leave a partly-extracted directory behind
+                self._discard_staging_dir(f)
+                raise
             yield self._close_transit(rp, datahash)
+            if self._stale:
+                # only now that everything else has worked
+                with self.args.timing.add("remove stale"):
+                    yield deferToThread(sync.remove_stale, self.abs_destname,
+                                        self._stale)
         else:
             self._msg("I don't know what they're offering\n")
             self._msg(f"Offer details: {them_d!r}")
@@ -321,19 +391,126 @@ class Receiver:
                    repr(os.path.basename(self.abs_destname))))
         self._ask_permission()
         tmp_destname = self.abs_destname + ".tmp"
+        self._offered_filename = file_data["filename"]
+        self._offered_mtime = file_data.get("mtime")
+        self._resume_name = tmp_destname + RESUME_SUFFIX
+        self._checkpoint = self._load_checkpoint(file_data, tmp_destname)
+        if self._checkpoint is not None:
+            return open(tmp_destname, "r+b")
         return open(tmp_destname, "wb")
 
+    def _load_checkpoint(self, file_data, tmp_destname):
+        """Return the checkpoint left behind by an earlier attempt to receive
+        this same file, or None if there isn't a usable one."""
+        if not file_data.get("resumable"):
+            return None  # older senders can't skip ahead
+        try:
+            with open(self._resume_name, "rb") as f:
+                checkpoint = bytes_to_dict(f.read())
+        except (OSError, ValueError, AssertionError):
+            return None
+        received = checkpoint.get("received")
+        # the same name and size isn't enough: it must be the same version
+        # of the file, as far as the sender's mtime can tell us
+        if (checkpoint.get("filename") != file_data["filename"]
+                or checkpoint.get("filesize") != file_data["filesize"]
+                or checkpoint.get("mtime") != file_data.get("mtime")
+                or not isinstance(received, int)
+                or not 0 < received < file_data["filesize"]
+                or not isinstance(checkpoint.get("sha256"), str)):
+            return None
+        try:
+            if os.stat(tmp_destname).st_size < received:
+                return None
+        except OSError:
+            return None
+        return checkpoint
+
+    @inlineCallbacks
+    def _check_resume(self, f):
+        # make sure the .tmp file still holds what the checkpoint says it
+        # does, by re-hashing it (this also gives us the hash state to carry
+        # on from)
+        checkpoint = self._checkpoint
+        if checkpoint is not None:
+            received = checkpoint["received"]
+            with self.args.timing.add("check resume"):
+                try:
+                    hasher = yield deferToThread(hash_prefix, f, received)
+                except ValueError:
+                    hasher = None
+            if hasher and hasher.hexdigest() == checkpoint["sha256"]:
+                f.seek(received)
+                f.truncate()
+                self._resume_from = received
+                self._prefix_hasher = hasher
+                self._msg("Resuming after %s already received" %
+                          naturalsize(received))
+                return
+            f.seek(0)
+            f.truncate()
+        self._remove_checkpoint()
+
+    def _write_checkpoint(self, f, received, hasher):
+        # the sidecar must never claim more than the .tmp file really holds
+        f.flush()
+        checkpoint = {
+            "filename": self._offered_filename,
+            "filesize": self.xfersize,
+            "mtime": self._offered_mtime,
+            "received": received,
+            "sha256": hasher.copy().hexdigest(),
+        }
+        tmp_name = self._resume_name + ".new"
+        with open(tmp_name, "wb") as cf:
+            cf.write(dict_to_bytes(checkpoint))
+        os.replace(tmp_name, self._resume_name)
+
+    @inlineCallbacks
+    def _check_resumed_hash(self, record_pipe, f, datahash):
+        # The start of the file came from an earlier attempt, so before we
+        # keep it, make sure the sender's whole file hashed the same as
+        # ours: if the file changed in between, what we have is a mixture
+        # of the two versions. The sender answers our ack with its hash
+        # (only once all the data is here, so it can't get mixed up with
+        # data still arriving on other stripes).
+        yield self._send_ack(record_pipe, datahash)
+        theirs = bytes_to_dict((yield record_pipe.receive_record()))
+        if theirs.get("sha256") == bytes_to_hexstr(datahash):
+            return
+        # don't keep it, or resume from it again (preallocation left it at
+        # full size, so it would pass for a good start next time)
+        tmp_name = f.name
+        f.close()
+        os.remove(tmp_name)
+        self._remove_checkpoint()
+        self._msg("Error: the file changed since the transfer we resumed "
+                  "was interrupted, so what we received has been discarded")
+        yield record_pipe.close()
+        raise TransferError("resumed file does not match the sender's")
+
+    def _remove_checkpoint(self):
+        if self._resume_name and os.path.exists(self._resume_name):
+            os.remove(self._resume_name)
+
     def _handle_directory(self, them_d):
         file_data = them_d["directory"]
         zipmode = file_data["mode"]
         if not zipmode.startswith("zipfile"):
             self._msg(f"Error: unknown directory-transfer mode '{zipmode}'")
             raise RespondError("unknown mode")
-        self.abs_destname = self._decide_destname("directory",
-                                                  file_data["dirname"])
+        # with --sync, we update an existing directory instead of refusing
+        # to overwrite it (if the sender knows how)
+        update = bool(self.args.sync and file_data.get("sync"))
+        self.abs_destname = self._decide_destname(
+            "directory", file_data["dirname"], update=update)
+        self._syncing = update and os.path.isdir(self.abs_destname)
         self.xfersize = file_data["zipsize"]
+        # when syncing, we only need room for the new and changed files,
+        # which we check once the sender tells us (_receive_sync_plan)
         free = estimate_free_space(self.abs_destname)
-        if free is not None and free < file_data["numbytes"]:
+        if (free is not None and not self._syncing
+                and free < file_data["numbytes"]):
             self._msg(
                 "Error: insufficient free space (%sB) for directory (%sB)" %
                 (free, file_data["numbytes"]))
@@ -345,6 +522,22 @@ class Receiver:
         self._msg("%d files, %s (uncompressed)" %
                   (file_data["numfiles"], naturalsize(file_data["numbytes"])))
         self._ask_permission()
+        # everything lands in a hidden directory next to the destination
+        # first, so a failed transfer leaves nothing behind under the name
+        # the user expects (or, when syncing, leaves the old copy as it was)
+        self._staging_dir = extract_dir = tempfile.mkdtemp(
+            prefix="." + os.path.basename(self.abs_destname) + ".",
+            suffix=".tmp", dir=os.path.dirname(self.abs_destname))
+        if (tarzstd.MODE in file_data.get("other-modes", [])
+                and tarzstd.available()):
+            # the sender can send us tar/zstd instead, if we ask for it in
+            # our answer. It won't know how big that is until it's done.
+            self._directory_mode = tarzstd.MODE
+            self.xfersize = None
+            return tarzstd.StreamingUntarrer(extract_dir)
+        if file_data.get("streamable"):
+            # the sender promises a zip file we can extract as it arrives
+            return StreamingUnzipper(extract_dir)
         # max_size here matches the magic-number in cmd_send and will
         # use up to 10MB of memory before putting the file on disk
         # instead.
@@ -357,10 +550,11 @@ class Receiver:
             f.seekable = lambda: True
         return f
 
-    def _decide_destname(self, mode, destname):
+    def _decide_destname(self, mode, destname, update=False):
         """
         Resolve any user options (--output-file) and convert to an
-        absolute destination path.
+        absolute destination path. If 'update' is true, an existing
+        directory there is fine: we'll update it (--sync).
         """
         # the basename() is intended to protect us against
         # "~/.ssh/authorized_keys" and other attacks
@@ -384,6 +578,10 @@ class Receiver:
                     # overwrite it
                     overwrite_allowed = True
 
+        if update and os.path.isdir(abs_destname):
+            self._msg(f"Updating existing directory {repr(destname)}")
+            return abs_destname
+
         # get confirmation from the user before writing to the local directory
         if os.path.exists(abs_destname):
             if overwrite_allowed:  # overwrite is intentional
@@ -408,7 +606,8 @@ class Receiver:
             while True and not self.args.accept_file:
                 ok = input("ok? (Y/n): ")
                 if ok.lower().startswith("y") or len(ok) == 0:
-                    if os.path.exists(self.abs_destname):
+                    if (os.path.exists(self.abs_destname)
+                            and not self._syncing):
                         self._remove_existing(self.abs_destname)
                     break
                 print("transfer rejected", file=sys.stderr)
@@ -417,7 +616,36 @@ class Receiver:
             t.detail(answer="yes")
 
     def _send_permission(self, w):
-        self._send_data({"answer": {"file_ack": "ok"}}, w)
+        answer = {
+            "file_ack": "ok",
+            "max-record-size": MAX_RECORD_SIZE,
+        }
+        if self._resume_from:
+            answer["resume-from"] = self._resume_from
+        if self._directory_mode:
+            answer["directory-mode"] = self._directory_mode
+        if self._manifest is not None:
+            answer["sync-manifest"] = self._manifest
+        self._send_data({"answer": answer}, w)
+
+    @inlineCallbacks
+    def _receive_sync_plan(self, record_pipe):
+        # before the data, the sender tells us which of our files to delete
+        # once it's done, how much it is sending, and (for a zip file) its
+        # new size
+        plan = bytes_to_dict((yield record_pipe.receive_record()))
+        delete, numbytes, zipsize = sync.parse_plan(plan, self._manifest)
+        if self.xfersize is not None:
+            if zipsize is None:
+                raise TransferError("bad sync plan")
+            self.xfersize = zipsize
+        free = estimate_free_space(self.abs_destname)
+        if free is not None and free < numbytes:
+            self._msg(
+                "Error: insufficient free space (%sB) for directory (%sB)" %
+                (free, numbytes))
+            raise TransferError("insufficient free space")
+        self._stale = delete
 
     @inlineCallbacks
     def _establish_transit(self):
@@ -431,21 +659,70 @@ class Receiver:
         self._msg(f"Receiving ({record_pipe.describe()})..")
 
         with self.args.timing.add("rx file"):
-            progress = tqdm(
+            bar = tqdm(
                 file=self.args.stderr,
                 disable=self.args.hide_progress,
                 unit="B",
                 unit_scale=True,
                 dynamic_ncols=True,
+                initial=self._resume_from,
                 total=self.xfersize)
-            hasher = hashlib.sha256()
-            with progress:
-                received = yield record_pipe.writeToFile(
-                    f, self.xfersize, progress.update, hasher.update)
-            datahash = hasher.digest()
-
+            progress = Progress(self._reactor, bar,
+                                open_progress_stream(self.args.progress_fd),
+                                total=self.xfersize,
+                                initial=self._resume_from)
+            # the hash covers the whole file, including any part we already
+            # had from an earlier attempt
+            hasher = ThreadedHasher(self._prefix_hasher or hashlib.sha256(),
+                                    self.args.timing)
+            received = self._resume_from
+            checkpointed = received
+            complete = False  # for tar/zstd, whose size we don't know
+
+            def _progress(length):
+                nonlocal received, checkpointed
+                progress.update(length)
+                received += length
+                if (self._resume_name
+                        and received - checkpointed >= CHECKPOINT_INTERVAL):
+                    # the writer thread does this once it has caught up, so
+                    # the file and the hash match what the checkpoint says
+                    fc.call_in_writer(self._write_checkpoint, f, received,
+                                      hasher)
+                    checkpointed = received
+
+            # the writer thread feeds the hasher, so it can wait for it
+            fc = WriteBehindFileConsumer(f, _progress, hasher.update,
+                                         self._reactor)
+            try:
+                with progress:
+                    try:
+                        if self.xfersize is None:
+                            complete = yield self._receive_frame(record_pipe,
+                                                                 fc)
+                        else:
+                            yield record_pipe.connectConsumer(
+                                fc, self.xfersize - self._resume_from)
+                    except error.ConnectionClosed:
+                        pass  # 'received' tells us how far we got
+                    finally:
+                        yield fc.close()
+            except Exception:
+                hasher.close()
+                raise
+            datahash = yield deferToThread(hasher.digest)
+
+        if self.xfersize is None:
+            if not complete:
+                self._msg()
+                self._msg("Connection dropped before full file received")
+                raise TransferError(
+                    "Connection dropped before full file received")
+            return datahash
         # except TransitError
         if received < self.xfersize:
+            if self._resume_name:
+                self._write_checkpoint(f, received, hasher)
             self._msg()
             self._msg("Connection dropped before full file received")
             self._msg("got %d bytes, wanted %d" % (received, self.xfersize))
@@ -453,10 +730,25 @@ class Receiver:
         assert received == self.xfersize
         return datahash
 
+    @inlineCallbacks
+    def _receive_frame(self, record_pipe, consumer):
+        """Pass the data from 'record_pipe' to 'consumer' until the zstd
+        frame it carries (a tar/zstd directory) ends. Returns a Deferred that
+        fires with True, or False if the connection was lost first."""
+        fc = tarzstd.FrameEndConsumer(consumer)
+        record_pipe.whenClosed().addCallback(lambda _: fc.lost())
+        record_pipe.connectConsumer(fc)
+        try:
+            complete = yield fc.ended
+        finally:
+            record_pipe.disconnectConsumer()
+        return complete
+
     def _write_file(self, f):
         tmp_name = f.name
         f.close()
         os.rename(tmp_name, self.abs_destname)
+        self._remove_checkpoint()
         self._msg(f"Received file written to: {self.abs_destname}")
 
     def _extract_file(self, zf, info, extract_dir):
@@ -464,12 +756,7 @@ class Receiver:
         the zipfile module does not restore file permissions
         so we'll do it manually
         """
-        out_path = os.path.join(extract_dir, info.filename)
-        out_path = os.path.abspath(out_path)
-        if not out_path.startswith(extract_dir + os.sep):
-            raise ValueError(
-                "malicious zipfile, %s outside of extract_dir %s" %
-                (info.filename, extract_dir))
+        out_path = extract_path(extract_dir, info.filename)
 
         zf.extract(info.filename, path=extract_dir)
 
@@ -478,20 +765,45 @@ class Receiver:
         os.chmod(out_path, perm)
 
     def _write_directory(self, f):
-        self._msg("Unpacking zipfile..")
-        with self.args.timing.add("unpack zip"):
-            with zipfile.ZipFile(f, "r") as zf:
-                for info in zf.infolist():
-                    self._extract_file(zf, info, self.abs_destname)
-
-            self._msg(f"Received files written to: {self.abs_destname}")
+        if isinstance(f, (StreamingUnzipper, tarzstd.StreamingUntarrer)):
+            # everything is already extracted, apart from the permissions
             f.close()
+        else:
+            self._msg("Unpacking zipfile..")
+            with self.args.timing.add("unpack zip"):
+                extract_parallel(f, self._staging_dir, self._extract_file)
+                f.close()
+        if self._syncing:
+            with self.args.timing.add("install"):
+                installed = sync.install(self._staging_dir,
+                                         self.abs_destname, self._stale)
+            # whatever the sender said, don't delete what we just received
+            self._stale = [name for name in self._stale
+                           if name not in installed]
+        else:
+            os.rename(self._staging_dir, self.abs_destname)
+        # (if that failed partway, _discard_staging_dir cleans up)
+        self._staging_dir = None
+        self._msg(f"Received files written to: {self.abs_destname}")
+
+    def _discard_staging_dir(self, f):
+        staging, self._staging_dir = self._staging_dir, None
+        if not staging:
+            return
+        try:
+            f.close()  # so no file in there is still open
+        except Exception:
+            pass  # it was incomplete, which we already know
+        shutil.rmtree(staging, ignore_errors=True)
 
     @inlineCallbacks
     def _close_transit(self, record_pipe, datahash):
+        yield self._send_ack(record_pipe, datahash)
+        yield record_pipe.close()
+
+    def _send_ack(self, record_pipe, datahash):
         datahash_hex = bytes_to_hexstr(datahash)
         ack = {"ack": "ok", "sha256": datahash_hex}
         ack_bytes = dict_to_bytes(ack)
         with self.args.timing.add("send ack"):
-            yield record_pipe.send_record(ack_bytes)
-            yield record_pipe.close()
+            return record_pipe.send_record(ack_bytes)
@@ -4,27 +4,36 @@ import os
 import sys
 
 import stat
+from concurrent.futures import ThreadPoolExecutor
 
 from humanize import naturalsize
 from qrcode import QRCode
 from tqdm import tqdm
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, Deferred
-from twisted.protocols import basic
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
+from twisted.internet.threads import deferToThread
 from twisted.python import log
 from wormhole import __version__, create
 
 from ..errors import TransferError, UnsendableFileError
+from ..listener import SharedListener
 from .._status import WormholeStatus, ConsumedCode
-from ..transit import TransitSender
-from ..util import bytes_to_dict, bytes_to_hexstr, dict_to_bytes
+from ..transit import (DEFAULT_CRYPTO_WORKERS, DEFAULT_RECORD_SIZE,
+                       MAX_RECORD_SIZE, ReadAheadFileSender,
+                       TransitSender)
+from ..util import (ThreadedHasher, bytes_to_dict, bytes_to_hexstr,
+                    dict_to_bytes, hash_prefix)
+from . import sync, tarzstd
+from .zipwriter import ZipWriter
+from .progress import Progress, open_progress_stream
 from .welcome import handle_welcome
 
 from iterableio import open_iterable
-from zipstream.ng import ZipStream, walk
 
 APPID = "lothar.com/wormhole/text-or-file-xfer"
 VERIFY_TIMER = float(os.environ.get("_MAGIC_WORMHOLE_TEST_VERIFY_TIMER", 1.0))
+# how many threads list directories at once, when sending a directory
+SCAN_WORKERS = 8
 
 
 def send(args, reactor=reactor):
@@ -39,6 +48,87 @@ def send(args, reactor=reactor):
     return Sender(args, reactor).go()
 
 
+def choose_record_size(them_answer):
+    """Pick the size of the transit records we'll send, based on the
+    'max-record-size' the receiver put in its answer (if any)."""
+    their_max = them_answer.get("max-record-size")
+    if not isinstance(their_max, int) or isinstance(their_max, bool):
+        return DEFAULT_RECORD_SIZE  # older receivers
+    if their_max < 1:
+        return DEFAULT_RECORD_SIZE
+    return min(their_max, MAX_RECORD_SIZE)
+
+
+def choose_resume_offset(them_answer, filesize):
+    """Return how far into the file the receiver already is, from the
+    'resume-from' in its answer (if any)."""
+    resume_from = them_answer.get("resume-from", 0)
+    if (not isinstance(resume_from, int) or isinstance(resume_from, bool)
+            or not 0 <= resume_from <= filesize):
+        raise TransferError(f"bad resume-from in answer: {resume_from!r}")
+    return resume_from
+
+
+def _scan_one(dirpath):
+    """List one directory the way os.walk(followlinks=True) would: return
+    (subdirs, files), sorted by name, where subdirs is a list of (path,
+    (st_dev, st_ino)). Returns None if the directory can't be listed (os.walk
+    skips those)."""
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.path)
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                subdirs.append((entry.path, (st.st_dev, st.st_ino)))
+    except OSError:
+        return None
+    subdirs.sort()
+    files.sort()
+    return subdirs, files
+
+
+def walk_parallel(path, workers=SCAN_WORKERS):
+    """Yield the path of every file under 'path' (following symlinks), and
+    of every empty directory (with a trailing separator). Each level of the
+    tree is listed by a pool of 'workers' threads, so wide trees (and slow
+    filesystems) are scanned in parallel. Directories
+    are visited breadth-first, in name order, and one that has been seen
+    before (through a symlink) is only visited the first time, so the result
+    doesn't depend on thread scheduling."""
+    st = os.stat(path)
+    visited = {(st.st_dev, st.st_ino)}
+    level = [path]
+    with ThreadPoolExecutor(workers) as pool:
+        while level:
+            next_level = []
+            for dirpath, scanned in zip(level, pool.map(_scan_one, level)):
+                if scanned is None:
+                    continue
+                subdirs, files = scanned
+                new_subdirs = 0
+                for subdir, key in subdirs:
+                    if key not in visited:
+                        visited.add(key)
+                        next_level.append(subdir)
+                        new_subdirs += 1
+                if not files and not new_subdirs:
+                    # an empty directory, which we send as "dir/"
+                    files = [os.path.join(dirpath, "")]
+                yield from files
+            level = next_level
+
+
 class Sender:
     def __init__(self, args, reactor):
         self._args = args
@@ -46,7 +136,19 @@ class Sender:
         self._tor = None
         self._timing = args.timing
         self._fd_to_send = None
+        # (path, arcname) of everything in a directory, in case the receiver
+        # asks for it as tar/zstd instead of as a zip file, or only wants
+        # some of it
+        self._entries = None
+        self._other_modes = []
+        self._zip_level = 0  # the deflate level of the zip file we offer
+        self._directory_mode = None
+        self._sync_plan = None
         self._transit_sender = None
+        self._listener = None  # for --listen-port
+        self._pending_offer = None  # the offer, until _go() is ready for it
+        self._record_size = DEFAULT_RECORD_SIZE
+        self._them_answer = {}
         self._status = WormholeStatus()
 
     @inlineCallbacks
@@ -89,6 +191,7 @@ class Sender:
         # as the original one)
         @inlineCallbacks
         def _bad(f):
+            self._abandon_offer()
             try:
                 yield w.close()  # might be an error too
             except Exception:
@@ -96,8 +199,27 @@ class Sender:
             return f
 
         d.addCallbacks(_good, _bad)
+        d.addBoth(self._stop_listening)
         yield d
 
+    def _abandon_offer(self):
+        # _go() failed before it got as far as the offer, which might still
+        # be scanning a directory: whatever that scan finds (or fails with)
+        # is no longer interesting, and must not be logged as unhandled
+        d, self._pending_offer = self._pending_offer, None
+        if d is not None:
+            d.addErrback(lambda f: None)
+
+    def _stop_listening(self, res):
+        # a --listen-port listener outlives the Transit object that used it,
+        # so we close it ourselves once the transfer is over
+        listener, self._listener = self._listener, None
+        if not listener:
+            return res
+        d = listener.stopListening()
+        d.addBoth(lambda _: res)
+        return d
+
     def _send_data(self, data, w):
         data_bytes = dict_to_bytes(data)
         w.send_message(data_bytes)
@@ -113,9 +235,10 @@ class Sender:
         handle_welcome(welcome, self._args.relay_url, __version__,
                        self._args.stderr)
 
-        # TODO: run the blocking zip-the-directory IO in a thread, let the
-        # wormhole exchange happen in parallel
-        offer, self._fd_to_send = self._build_offer()
+        # scanning a directory can take a while, so that happens in a thread
+        # while we get a code and the receiver types it in
+        offer_d = self._build_offer()
+        self._pending_offer = offer_d
         args = self._args
 
         other_cmd = "wormhole receive"
@@ -198,13 +321,22 @@ class Sender:
             self._check_verifier(w,
                                  verifier_bytes)  # blocks, can TransferError
 
+        self._pending_offer = None  # we're handling it now
+        offer, self._fd_to_send = yield offer_d
         if self._fd_to_send:
+            if args.listen_port:
+                self._listener = SharedListener(self._reactor,
+                                                port=args.listen_port)
             ts = TransitSender(
                 args.transit_helper,
                 no_listen=(not args.listen),
                 tor=self._tor,
                 reactor=self._reactor,
-                timing=self._timing)
+                timing=self._timing,
+                stripes=args.stripes,
+                crypto_workers=DEFAULT_CRYPTO_WORKERS,
+                select_window=args.select_window,
+                listener=self._listener)
             self._transit_sender = ts
 
             # for now, send this before the main offer
@@ -268,9 +400,13 @@ class Sender:
 
     def _handle_transit(self, receiver_transit):
         ts = self._transit_sender
+        ts.add_connection_abilities(receiver_transit.get("abilities-v1", []))
         ts.add_connection_hints(receiver_transit.get("hints-v1", []))
 
     def _build_offer(self):
+        """Return a Deferred that fires with (offer, fd_to_send). Problems
+        with the thing to be sent are raised right away, except for those
+        found while scanning a directory (in a thread)."""
         offer = {}
 
         args = self._args
@@ -287,7 +423,7 @@ class Sender:
                 file=args.stderr)
             offer = {"message": text}
             fd_to_send = None
-            return offer, fd_to_send
+            return succeed((offer, fd_to_send))
 
         # click.Path (with resolve_path=False, the default) does not do path
         # resolution, so we must join it to cwd ourselves. We could use
@@ -340,54 +476,62 @@ class Sender:
 
         if os.path.isfile(what):
             # we're sending a file
-            filesize = os.stat(what).st_size
+            st = os.stat(what)
+            filesize = st.st_size
             offer["file"] = {
                 "filename": basename,
                 "filesize": filesize,
+                "resumable": True,
+                # so a receiver only resumes from the same version of it
+                "mtime": st.st_mtime,
             }
             print(
                 f"Sending {naturalsize(filesize)} file named '{basename}'",
                 file=args.stderr)
             fd_to_send = open(what, "rb")
-            return offer, fd_to_send
+            return succeed((offer, fd_to_send))
 
         if os.path.isdir(what):
             print("Building zipfile..", file=args.stderr)
             # We're sending a directory, stream it as a zipfile
-
-            zs = ZipStream(sized=True)
-            for filepath in walk(what, preserve_empty=True, followlinks=True):
-                try:
-                    if not os.access(filepath, os.R_OK):
-                        raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), filepath)
-                    zs.add_path(
-                        filepath,
-                        arcname=os.path.relpath(filepath, what),
-                        recurse=False,
-                    )
-                except OSError as e:
-                    errmsg = f"{filepath}: {e.strerror}"
-                    if not self._args.ignore_unsendable_files:
-                        raise UnsendableFileError(errmsg)
-                    print(
-                        f"{errmsg} (ignoring error)",
-                        file=args.stderr
-                    )
-
-            filesizes = [x["size"] for x in zs.info_list() if not x["is_dir"]]
-            filesize = len(zs)
-            offer["directory"] = {
-                "mode": "zipfile/deflated",
-                "dirname": basename,
-                "zipsize": filesize,
-                "numbytes": sum(filesizes),
-                "numfiles": len(filesizes),
-            }
-            print(
-                "Sending directory (%s compressed) named '%s'" %
-                (naturalsize(filesize), basename),
-                file=args.stderr)
-            return offer, zs
+            self._zip_level = args.compress_level
+            if tarzstd.available() and args.compress_level:
+                # newer receivers may ask for this instead. Until we know
+                # which they want, we don't compress anything: the zip
+                # file we offer to older receivers stores every file, so
+                # it can be sized without reading them.
+                self._other_modes = [tarzstd.MODE]
+                self._zip_level = 0
+            d = deferToThread(self._build_zipstream, what)
+
+            def _built(built):
+                zs, entries = built
+                filesizes = [x["size"] for x in zs.info_list()
+                             if not x["is_dir"]]
+                filesize = len(zs)
+                offer["directory"] = {
+                    "mode": "zipfile/deflated",
+                    "dirname": basename,
+                    "zipsize": filesize,
+                    "numbytes": sum(filesizes),
+                    "numfiles": len(filesizes),
+                    # every local header has the entry's real sizes, so
+                    # each entry can be extracted as soon as it arrives
+                    "streamable": True,
+                    # we'll leave out what the receiver already has, if its
+                    # answer tells us
+                    "sync": True,
+                }
+                self._entries = entries
+                if self._other_modes:
+                    offer["directory"]["other-modes"] = self._other_modes
+                print(
+                    "Sending directory (%s compressed) named '%s'" %
+                    (naturalsize(filesize), basename),
+                    file=args.stderr)
+                return offer, zs
+            d.addCallback(_built)
+            return d
 
         if stat.S_ISBLK(os.stat(what).st_mode):
             fd_to_send = open(what, "rb")
@@ -396,16 +540,39 @@ class Sender:
             offer["file"] = {
                 "filename": basename,
                 "filesize": filesize,
+                "resumable": True,
             }
             print(
                 f"Sending {naturalsize(filesize)} block device named '{basename}'",
                 file=args.stderr)
 
             fd_to_send.seek(0)
-            return offer, fd_to_send
+            return succeed((offer, fd_to_send))
 
         raise TypeError(f"'{args.what}' is neither file nor directory")
 
+    def _build_zipstream(self, what):
+        # this runs in a thread
+        level = self._zip_level
+        zs = ZipWriter(level)
+        entries = []
+        for filepath in walk_parallel(what):
+            try:
+                if not os.access(filepath, os.R_OK):
+                    raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), filepath)
+                arcname = os.path.relpath(filepath, what)
+                zs.add_path(filepath, arcname)
+                entries.append((filepath, arcname))
+            except OSError as e:
+                errmsg = f"{filepath}: {e.strerror}"
+                if not self._args.ignore_unsendable_files:
+                    raise UnsendableFileError(errmsg)
+                print(
+                    f"{errmsg} (ignoring error)",
+                    file=self._args.stderr
+                )
+        return zs, entries
+
     @inlineCallbacks
     def _handle_answer(self, them_answer):
         if self._fd_to_send is None:
@@ -418,56 +585,135 @@ class Sender:
             raise TransferError("ambiguous response from remote, "
                                 "transfer abandoned: %s" % (them_answer, ))
 
+        mode = them_answer.get("directory-mode")
+        if mode is not None and mode not in self._other_modes:
+            raise TransferError(
+                f"receiver asked for a directory mode we didn't offer: {mode!r}")
+        self._directory_mode = mode
+        if "sync-manifest" in them_answer:
+            if self._entries is None:
+                raise TransferError("receiver sent a sync-manifest, "
+                                    "but we aren't sending a directory")
+            yield self._plan_sync(them_answer["sync-manifest"])
+        self._record_size = choose_record_size(them_answer)
+        self._them_answer = them_answer
         yield self._send_file()
 
+    @inlineCallbacks
+    def _plan_sync(self, manifest):
+        with self._timing.add("plan sync"):
+            changed, stale, unchanged = yield deferToThread(
+                sync.plan, self._entries, manifest)
+            numbytes = yield deferToThread(sync.total_size, changed)
+            if self._directory_mode != tarzstd.MODE:
+                # everything in it was sized (and maybe deflated) already
+                self._fd_to_send = self._fd_to_send.select(changed)
+        print(f"Receiver already has {unchanged} of the files: sending "
+              f"{len(changed)} new or changed, deleting {len(stale)}",
+              file=self._args.stderr)
+        self._entries = changed
+        self._sync_plan = {"delete": stale, "numbytes": numbytes}
+
     @inlineCallbacks
     def _send_file(self):
         ts = self._transit_sender
 
-        if isinstance(self._fd_to_send, ZipStream):
+        resume_from = 0
+        if self._directory_mode == tarzstd.MODE:
+            # we won't know how big this is until it's all been sent (the
+            # receiver looks for the end of the zstd frame instead)
+            filesize = None
+            self._fd_to_send = open_iterable(
+                tarzstd.compressed_stream(
+                    self._entries,
+                    tarzstd.zstd_level(self._args.compress_level)),
+                "rb")
+            if "resume-from" in self._them_answer:
+                raise TransferError("cannot resume a directory transfer")
+        elif isinstance(self._fd_to_send, ZipWriter):
             filesize = len(self._fd_to_send)
             self._fd_to_send = open_iterable(self._fd_to_send, "rb")
+            if "resume-from" in self._them_answer:
+                raise TransferError("cannot resume a directory transfer")
         else:
             self._fd_to_send.seek(0, 2)
             filesize = self._fd_to_send.tell()
             self._fd_to_send.seek(0, 0)
-
+            resume_from = choose_resume_offset(self._them_answer, filesize)
+
+        # The receiver already has the first 'resume_from' bytes, but the
+        # hash we compare at the end covers the whole file, so we hash that
+        # part (in a thread, while transit connects) without sending it.
+        if resume_from:
+            hasher_d = deferToThread(hash_prefix, self._fd_to_send,
+                                     resume_from)
         record_pipe = yield ts.connect()
         self._timing.add("transit connected")
+        if self._sync_plan is not None:
+            # before the data, tell the receiver what to delete when we're
+            # done, how much room it needs, and how big the zip file is now
+            if filesize is not None:
+                self._sync_plan["zipsize"] = filesize
+            record_pipe.send_record(dict_to_bytes(self._sync_plan))
+        if resume_from:
+            with self._timing.add("hash resumed part"):
+                hasher = yield hasher_d
+            self._fd_to_send.seek(resume_from)
+        else:
+            hasher = hashlib.sha256()
+        hasher = ThreadedHasher(hasher, self._timing)
         # record_pipe should implement IConsumer, chunks are just records
         stderr = self._args.stderr
         print(f"Sending ({record_pipe.describe()})..", file=stderr)
+        if resume_from:
+            print(f"Resuming after {naturalsize(resume_from)} already sent",
+                  file=stderr)
 
-        hasher = hashlib.sha256()
-        progress = tqdm(
+        bar = tqdm(
             file=stderr,
             disable=self._args.hide_progress,
             unit="B",
             unit_scale=True,
             dynamic_ncols=True,
+            initial=resume_from,
             total=filesize)
+        progress = Progress(self._reactor, bar,
+                            open_progress_stream(self._args.progress_fd),
+                            total=filesize, initial=resume_from)
 
-        def _count_and_hash(data):
-            hasher.update(data)
+        def _count(data):
             progress.update(len(data))
             return data
 
-        fs = basic.FileSender()
+        fs = ReadAheadFileSender(self._reactor)
+        fs.CHUNK_SIZE = self._record_size
 
-        with self._timing.add("tx file"):
-            with progress:
-                if filesize:
-                    # don't send zero-length files
-                    yield fs.beginFileTransfer(
-                        self._fd_to_send,
-                        record_pipe,
-                        transform=_count_and_hash)
-
-        expected_hash = hasher.digest()
+        try:
+            with self._timing.add("tx file"):
+                with progress:
+                    if filesize is None or filesize > resume_from:
+                        # don't send zero-length files. The reader thread
+                        # feeds the hasher, so if hashing falls behind, it
+                        # is the read-ahead that waits, not the reactor.
+                        yield fs.beginFileTransfer(
+                            self._fd_to_send,
+                            record_pipe,
+                            transform=_count,
+                            hasher=hasher.update)
+        except Exception:
+            hasher.close()
+            raise
+
+        expected_hash = yield deferToThread(hasher.digest)
         expected_hex = bytes_to_hexstr(expected_hash)
         print("File sent.. waiting for confirmation", file=stderr)
         with self._timing.add("get ack") as t:
             ack_bytes = yield record_pipe.receive_record()
+            if resume_from:
+                # the receiver's first part came from an earlier attempt,
+                # so it checks our hash before keeping the file
+                record_pipe.send_record(
+                    dict_to_bytes({"sha256": expected_hex}))
             record_pipe.close()
             ack = bytes_to_dict(ack_bytes)
             ok = ack.get("ack", "")
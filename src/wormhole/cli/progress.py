@@ -0,0 +1,77 @@
+import json
+import os
+
+from twisted.internet import task
+
+# how often the byte count is passed on to the progress bar (and stream)
+PROGRESS_INTERVAL = 0.1
+
+
+def open_progress_stream(fd):
+    """Return a text file for --progress-fd, or None if it wasn't given."""
+    if fd is None:
+        return None
+    return os.fdopen(fd, "w", buffering=1, closefd=False)
+
+
+class Progress:
+    """I count the bytes of a file transfer. update() is called for every
+    record, so all it does is add to a counter: every PROGRESS_INTERVAL
+    seconds (and once more when the transfer is over) the bytes counted
+    since last time are passed on to the tqdm progress 'bar'.
+
+    If 'stream' is given, I also write one JSON object per line to it, for
+    other programs to read: {"event": "progress", "bytes": N, "total": T,
+    "elapsed": SECONDS} each time, then an "event": "done" line at the end,
+    with "ok" false if the transfer failed or came up short.
+
+    Use me as a context manager around the transfer, like a tqdm bar."""
+
+    def __init__(self, reactor, bar, stream=None, total=None, initial=0):
+        self._reactor = reactor
+        self._bar = bar
+        self._stream = stream
+        self._total = total
+        self.count = initial
+        self._reported = initial
+        self._started = None
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.clock = reactor
+
+    def update(self, length):
+        self.count += length
+
+    def flush(self):
+        new = self.count - self._reported
+        if not new:
+            return
+        self._reported = self.count
+        self._bar.update(new)
+        self._write("progress")
+
+    def _write(self, event, **details):
+        if not self._stream:
+            return
+        line = {
+            "event": event,
+            "bytes": self.count,
+            "total": self._total,
+            "elapsed": round(self._reactor.seconds() - self._started, 3),
+        }
+        line.update(details)
+        self._stream.write(json.dumps(line) + "\n")
+
+    def __enter__(self):
+        self._started = self._reactor.seconds()
+        self._bar.__enter__()
+        self._write("start")
+        self._loop.start(PROGRESS_INTERVAL, now=False)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self._loop.stop()
+        self.flush()
+        ok = exc_type is None and (self._total is None
+                                   or self.count >= self._total)
+        self._write("done", ok=ok)
+        return self._bar.__exit__(exc_type, exc_value, exc_tb)
@@ -0,0 +1,185 @@
+# Sending a directory again, to a receiver that already has an older copy
+# of it ("wormhole receive --sync"). The receiver's answer includes a
+# manifest of what it has (name, size, and SHA-256 of every file), the sender
+# leaves out every file that matches, and before the data it sends a
+# "plan" record listing the receiver's files that the sender no longer has.
+# The receiver extracts the new and changed files into a staging directory,
+# and only once they have all arrived does it move each one over its old
+# copy. It deletes the files in the plan after it has sent the final ack.
+
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from ..errors import TransferError
+from ..util import hash_prefix
+from .unzip import extract_path
+
+# how many files we hash at once
+HASH_WORKERS = 8
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hash_prefix(f, os.fstat(f.fileno()).st_size).hexdigest()
+
+
+def build_manifest(root, workers=HASH_WORKERS):
+    """Return the manifest of the directory 'root': a list of [name, size,
+    sha256-hex] for each file under it, where 'name' is relative to 'root'
+    and uses "/". Anything else that isn't a directory (like a symlink) is
+    listed with a size of -1 and no hash, so it never matches what the
+    sender has. This reads every file, so run it in a thread."""
+    files = []
+    others = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            arcname = os.path.relpath(path, root).replace(os.sep, "/")
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                files.append((arcname, path, st.st_size))
+            elif not stat.S_ISDIR(st.st_mode):
+                # os.walk doesn't follow symlinks to directories either
+                others.append([arcname, -1, None])
+    with ThreadPoolExecutor(workers) as pool:
+        hashes = pool.map(_file_hash, [path for _, path, _ in files])
+        manifest = [[arcname, size, h]
+                    for (arcname, _, size), h in zip(files, hashes)]
+    return manifest + others
+
+
+def _parse_manifest(manifest):
+    if not isinstance(manifest, list):
+        raise TransferError("bad sync-manifest in answer")
+    parsed = {}
+    for item in manifest:
+        if (not isinstance(item, list) or len(item) != 3
+                or not isinstance(item[0], str)
+                or not isinstance(item[1], int)):
+            raise TransferError(f"bad sync-manifest entry: {item!r}")
+        parsed[item[0]] = (item[1], item[2])
+    return parsed
+
+
+def plan(entries, manifest, workers=HASH_WORKERS):
+    """Compare 'entries' (the (path, arcname) list of what we're sending) with
+    the receiver's 'manifest'. Returns (changed, stale, unchanged), where
+    'changed' is the entries the receiver needs, 'stale' is the names of the
+    receiver's files that we don't have (which it should delete), and
+    'unchanged' counts the files we can leave out. This hashes our files
+    (the ones whose size matches), so run it in a thread."""
+    theirs = _parse_manifest(manifest)
+    names = {}
+    candidates = []
+    for path, arcname in entries:
+        name = arcname.replace(os.sep, "/")
+        names[name] = (path, arcname)
+        if name in theirs and theirs[name][1] is not None:
+            if os.stat(path).st_size == theirs[name][0]:
+                candidates.append(name)
+    with ThreadPoolExecutor(workers) as pool:
+        hashes = pool.map(_file_hash,
+                          [names[name][0] for name in candidates])
+        same = {name for name, h in zip(candidates, hashes)
+                if h == theirs[name][1]}
+    changed = [entry for name, entry in names.items() if name not in same]
+    stale = sorted(name for name in theirs if name not in names)
+    return changed, stale, len(same)
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_plan(plan, manifest):
+    """Check the sender's 'plan' (the record it sends before the data) and
+    return (delete, numbytes, zipsize), where 'zipsize' may be None (for
+    tar/zstd). 'delete' only keeps the names that are in our own
+    'manifest': we never delete anything else, whatever the sender says.
+    Raises TransferError if the plan is malformed."""
+    if (not isinstance(plan, dict)
+            or not isinstance(plan.get("delete"), list)
+            or not all(isinstance(name, str) for name in plan["delete"])
+            or not _is_int(plan.get("numbytes"))
+            or not _is_int(plan.get("zipsize", 0))):
+        raise TransferError("bad sync plan")
+    ours = {item[0] for item in manifest}
+    delete = [name for name in plan["delete"] if name in ours]
+    return delete, plan["numbytes"], plan.get("zipsize")
+
+
+def total_size(entries):
+    """Return the total size of the files among 'entries', a list of (path,
+    arcname). This stats every file, so run it in a thread."""
+    return sum(os.stat(path).st_size for path, _ in entries
+               if os.path.isfile(path))
+
+
+def install(staging, root, stale):
+    """Move everything under 'staging' (where the new and changed files were
+    extracted) into 'root', each file replacing its old copy (if any) with a
+    single rename, and then remove 'staging'. Returns the names installed.
+
+    Old files only go if they are in the way: one where we need a
+    directory, or the stale ones (as plan() returned them) under a
+    directory where we need a file. The rest are left for remove_stale()."""
+    installed = set()
+    for dirpath, dirnames, filenames in os.walk(staging):
+        rel = os.path.relpath(dirpath, staging)
+        if rel != os.curdir:
+            target = extract_path(root, rel)
+            if os.path.islink(target) or (os.path.lexists(target)
+                                          and not os.path.isdir(target)):
+                # it's being replaced by a directory. (And we must never
+                # write through a symlink, which might lead anywhere.)
+                os.remove(target)
+            os.makedirs(target, exist_ok=True)
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(dirpath, filename),
+                                   staging).replace(os.sep, "/")
+            target = extract_path(root, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                remove_stale(root, [n for n in stale
+                                    if n.startswith(name + "/")])
+            os.replace(os.path.join(dirpath, filename), target)
+            installed.add(name)
+    shutil.rmtree(staging)
+    return installed
+
+
+def _stale_path(root, name):
+    # like extract_path(), but symlinks count too: abspath() doesn't
+    # resolve them, so a name that goes through a symlinked directory
+    # would otherwise lead outside of 'root'
+    path = extract_path(root, name)
+    real_root = os.path.realpath(root)
+    parent = os.path.realpath(os.path.dirname(path))
+    if parent != real_root and not parent.startswith(real_root + os.sep):
+        raise ValueError(
+            "malicious name, %s outside of %s" % (name, root))
+    return path
+
+
+def remove_stale(root, names):
+    """Delete each of 'names' (as plan() returned them) from under 'root',
+    and then any directories that were left empty, apart from 'root'
+    itself. Raises ValueError (like the extractors) for a name that isn't
+    inside 'root', including through a symlink."""
+    parents = set()
+    for name in names:
+        path = _stale_path(root, name)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+            os.remove(path)
+            parents.add(os.path.dirname(path))
+    # deepest first, so a directory that only held empty directories goes too
+    for parent in sorted(parents, key=len, reverse=True):
+        while (parent != root and not os.path.islink(parent)
+               and os.path.isdir(parent) and not os.listdir(parent)):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
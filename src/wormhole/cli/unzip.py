@@ -0,0 +1,396 @@
+# Extract a zip file as it arrives, instead of spooling it to disk and
+# extracting it afterwards.
+#
+# A zip file is a series of entries, each a "local file header" followed by
+# the (stored or deflated) data, and then a "central directory" at the end
+# that lists them all again (with some extra details, like permissions).
+# zipfile.ZipFile starts by reading the central directory, so it needs the
+# whole file, but the local headers are enough to find and extract each
+# entry in one forward pass. A deflated entry ends where its deflate stream
+# does, and a stored one after the size in its local header, so that size
+# must be real: a stored entry can't be found from a "data descriptor" that
+# follows it without guessing, so one with zero sizes in its header (as
+# zipstream-ng and zipfile write to an unseekable file) is rejected rather
+# than cut short. ZipWriter writes the sizes, with the CRC in a descriptor.
+#
+# When the zip file had to be spooled to disk after all (because the sender
+# didn't promise us a streamable one), extract_parallel() at least unpacks
+# it with several threads.
+
+import io
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import BadZipFile
+
+STORED = 0
+DEFLATED = 8
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+DESCRIPTOR = struct.Struct("<4sIII")
+DESCRIPTOR64 = struct.Struct("<4sIQQ")
+END = struct.Struct("<4sHHHHIIH")
+ZIP64_LOCATOR_SIZE = 20
+
+LOCAL_SIG = b"PK\x03\x04"
+CENTRAL_SIG = b"PK\x01\x02"
+DESCRIPTOR_SIG = b"PK\x07\x08"
+ZIP64_END_SIG = b"PK\x06\x06"
+ZIP64_LOCATOR_SIG = b"PK\x06\x07"
+END_SIG = b"PK\x05\x06"
+
+# the most we inflate in one go, so a small input can't use lots of memory
+MAX_INFLATE = 2**20
+
+# how many threads extract_parallel() uses
+EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def extract_path(extract_dir, name):
+    """Return where the zip member 'name' belongs under 'extract_dir', or
+    raise ValueError if that is outside of it."""
+    out_path = os.path.abspath(os.path.join(extract_dir, name))
+    if not out_path.startswith(extract_dir + os.sep):
+        raise ValueError(
+            "malicious zipfile, %s outside of extract_dir %s" %
+            (name, extract_dir))
+    return out_path
+
+
+class _PositionalFile(io.RawIOBase):
+    """A read-only view of file descriptor 'fd' with its own position (it
+    uses pread), so several threads can each read a different part of the
+    same file at once."""
+
+    def __init__(self, fd):
+        super().__init__()
+        self._fd = fd
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = os.pread(self._fd, len(b), self._pos)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += os.fstat(self._fd).st_size
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+
+def _independent_opener(f):
+    """Return a function that opens another handle on the spooled (or real)
+    file 'f', with its own position, or None if we can't do that here."""
+    if not hasattr(os, "pread"):
+        return None  # Windows
+    if hasattr(f, "rollover"):
+        # a SpooledTemporaryFile might still be in memory (it's small, so
+        # this is cheap): now it has a real file that pread() can share
+        f.rollover()
+    fd = f.fileno()
+    return lambda: io.BufferedReader(_PositionalFile(fd))
+
+
+def extract_parallel(f, extract_dir, extract_one, workers=EXTRACT_WORKERS):
+    """Extract every member of the zip file 'f' into 'extract_dir', by
+    calling extract_one(zf, info, extract_dir) for each (that's
+    Receiver._extract_file, which also restores permissions). Directories
+    (and the parents of every file) are created first, then the files are
+    extracted by 'workers' threads, each with its own ZipFile on its own
+    handle of 'f', largest files first."""
+    opener = _independent_opener(f)
+    with zipfile.ZipFile(opener() if opener else f) as zf:
+        infos = zf.infolist()
+        # doing this now means the workers never race to create a directory
+        for info in infos:
+            if info.is_dir():
+                extract_one(zf, info, extract_dir)
+            else:
+                out_path = extract_path(extract_dir, info.filename)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        files = [info for info in infos if not info.is_dir()]
+        if opener is None or workers < 2 or len(files) < 2:
+            for info in files:
+                extract_one(zf, info, extract_dir)
+            return
+    files.sort(key=lambda info: info.file_size, reverse=True)
+
+    local = threading.local()
+    handles = []
+
+    def _extract(info):
+        zf = getattr(local, "zf", None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(opener())
+            handles.append(zf)
+        extract_one(zf, info, extract_dir)
+
+    pool = ThreadPoolExecutor(workers)
+    try:
+        for _ in pool.map(_extract, files):
+            pass
+    finally:
+        # if one failed, don't bother starting any more
+        pool.shutdown(cancel_futures=True)
+        for zf in handles:
+            zf.close()
+
+
+def _decode_name(raw, flags):
+    return raw.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+
+
+class _Entry:
+    def __init__(self, name, f, flags, method, crc, csize, usize, zip64):
+        self.name = name
+        self.f = f
+        self.flags = flags
+        # what the local header says (a descriptor overrides the CRC)
+        self.crc = crc
+        self.size = usize
+        self.zip64 = zip64
+        self.remaining = csize  # of stored data
+        self.inflater = zlib.decompressobj(-15) if method == DEFLATED else None
+        # what we've actually written
+        self.written_crc = 0
+        self.written = 0
+
+
+class StreamingUnzipper:
+    """A write-only file-like object which extracts the zip file written to
+    it into 'extract_dir', each entry landing at its final path as its bytes
+    arrive. Entries must be stored or deflated. Member names are checked
+    the same way Receiver._extract_file does. Raises BadZipFile (from
+    write() or close()) if the data isn't a zip file we can handle.
+
+    write() does blocking file IO, so call it from a thread (e.g. through
+    a WriteBehindFileConsumer). Call close() once everything has been
+    written: that checks the zip file was complete and restores the file
+    permissions, which only appear in the central directory at the end."""
+
+    def __init__(self, extract_dir):
+        self.name = extract_dir
+        self._extract_dir = extract_dir
+        self._buf = bytearray()
+        self._state = self._read_signature
+        self._entry = None
+        self._paths = {}  # member name -> where we put it
+        self._perms = {}  # member name -> mode, from the central directory
+        self._finished = False
+
+    def write(self, data):
+        self._buf += data
+        # each state returns True if it made progress, False if it needs
+        # more data
+        while self._state():
+            pass
+        return len(data)
+
+    def close(self):
+        if self._entry and self._entry.f:
+            self._entry.f.close()
+        if not self._finished:
+            raise BadZipFile("zip file ended early")
+        for name, perm in self._perms.items():
+            if name in self._paths:
+                os.chmod(self._paths[name], perm)
+
+    def _read_signature(self):
+        if len(self._buf) < 4:
+            return False
+        sig = bytes(self._buf[:4])
+        if sig == LOCAL_SIG:
+            self._state = self._read_local_header
+        elif sig == CENTRAL_SIG:
+            self._state = self._read_central_header
+        elif sig == ZIP64_END_SIG:
+            self._state = self._read_zip64_end
+        elif sig == ZIP64_LOCATOR_SIG:
+            self._state = self._read_zip64_locator
+        elif sig == END_SIG:
+            self._state = self._read_end
+        else:
+            raise BadZipFile(f"unexpected data in zip file: {sig!r}")
+        return True
+
+    def _read_local_header(self):
+        buf = self._buf
+        if len(buf) < LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, csize, usize, name_len,
+         extra_len) = LOCAL_HEADER.unpack_from(buf)
+        end = LOCAL_HEADER.size + name_len + extra_len
+        if len(buf) < end:
+            return False
+        name = _decode_name(bytes(buf[LOCAL_HEADER.size:
+                                      LOCAL_HEADER.size + name_len]), flags)
+        extra = bytes(buf[end - extra_len:end])
+        del buf[:end]
+        if flags & FLAG_ENCRYPTED:
+            raise BadZipFile(f"{name!r} is encrypted")
+        if method not in (STORED, DEFLATED):
+            raise BadZipFile(f"{name!r} uses compression method {method}")
+
+        zip64 = False
+        while len(extra) >= 4:
+            tag, size = struct.unpack_from("<HH", extra)
+            if tag == 0x0001 and size >= 16:
+                # a local header's zip64 field always has both sizes
+                zip64 = True
+                usize, csize = struct.unpack_from("<QQ", extra, 4)
+            extra = extra[4 + size:]
+        if method == STORED and csize != usize:
+            raise BadZipFile(f"Bad sizes for stored file {name!r}")
+
+        out_path = extract_path(self._extract_dir, name)
+        self._paths[name] = out_path
+        if name.endswith("/"):
+            os.makedirs(out_path, exist_ok=True)
+            f = None
+        else:
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            f = open(out_path, "wb")
+        self._entry = _Entry(name, f, flags, method, crc, csize, usize, zip64)
+
+        if method == DEFLATED:
+            self._state = self._inflate
+        else:
+            self._state = self._read_stored
+        return True
+
+    def _output(self, data):
+        e = self._entry
+        if data and e.f:
+            e.f.write(data)
+        e.written_crc = zlib.crc32(data, e.written_crc)
+        e.written += len(data)
+
+    def _read_stored(self):
+        e = self._entry
+        n = min(len(self._buf), e.remaining)
+        if n:
+            self._output(bytes(self._buf[:n]))
+            del self._buf[:n]
+            e.remaining -= n
+        if e.remaining:
+            return False
+        if e.flags & FLAG_DESCRIPTOR:
+            self._state = self._read_descriptor
+        else:
+            self._finish_entry(e.crc, e.size)
+        return True
+
+    def _inflate(self):
+        e = self._entry
+        if not self._buf:
+            return False
+        data = e.inflater.decompress(bytes(self._buf), MAX_INFLATE)
+        if e.inflater.eof:
+            self._buf[:] = e.inflater.unused_data
+        else:
+            self._buf[:] = e.inflater.unconsumed_tail
+        self._output(data)
+        if e.inflater.eof:
+            if e.flags & FLAG_DESCRIPTOR:
+                self._state = self._read_descriptor
+            else:
+                self._finish_entry(e.crc, e.size)
+            return True
+        return bool(data)
+
+    def _read_descriptor(self):
+        e = self._entry
+        buf = self._buf
+        if len(buf) < 4:
+            return False
+        start = 4 if buf[:4] == DESCRIPTOR_SIG else 0
+        fmt = "<IQQ" if e.zip64 else "<III"
+        end = start + struct.calcsize(fmt)
+        if len(buf) < end:
+            return False
+        crc, _, usize = struct.unpack_from(fmt, buf, start)
+        del buf[:end]
+        self._finish_entry(crc, usize)
+        return True
+
+    def _finish_entry(self, crc, size):
+        e = self._entry
+        if e.f:
+            e.f.close()
+        if e.written_crc != crc or e.written != size:
+            raise BadZipFile(f"Bad CRC-32 or size for file {e.name!r}")
+        self._entry = None
+        self._state = self._read_signature
+
+    def _read_central_header(self):
+        buf = self._buf
+        if len(buf) < CENTRAL_HEADER.size:
+            return False
+        fields = CENTRAL_HEADER.unpack_from(buf)
+        flags = fields[3]
+        name_len, extra_len, comment_len = fields[10:13]
+        external_attr = fields[15]
+        end = CENTRAL_HEADER.size + name_len + extra_len + comment_len
+        if len(buf) < end:
+            return False
+        name = _decode_name(bytes(buf[CENTRAL_HEADER.size:
+                                      CENTRAL_HEADER.size + name_len]), flags)
+        del buf[:end]
+        # not sure why zipfiles store the perms 16 bits away but they do
+        self._perms[name] = external_attr >> 16
+        self._state = self._read_signature
+        return True
+
+    def _read_zip64_end(self):
+        if len(self._buf) < 12:
+            return False
+        (size,) = struct.unpack_from("<Q", self._buf, 4)
+        if len(self._buf) < 12 + size:
+            return False
+        del self._buf[:12 + size]
+        self._state = self._read_signature
+        return True
+
+    def _read_zip64_locator(self):
+        if len(self._buf) < ZIP64_LOCATOR_SIZE:
+            return False
+        del self._buf[:ZIP64_LOCATOR_SIZE]
+        self._state = self._read_signature
+        return True
+
+    def _read_end(self):
+        if len(self._buf) < END.size:
+            return False
+        comment_len = END.unpack_from(self._buf)[7]
+        if len(self._buf) < END.size + comment_len:
+            return False
+        del self._buf[:END.size + comment_len]
+        self._finished = True
+        self._state = self._read_nothing
+        return True
+
+    def _read_nothing(self):
+        if self._buf:
+            raise BadZipFile("unexpected data after the end of the zip file")
+        return False
@@ -0,0 +1,273 @@
+# Write the zip file for 'wormhole send DIRECTORY' as a stream.
+#
+# A stored file's CRC isn't known until its data has been read, so it goes
+# in a "data descriptor" after the data, as usual for a streamed zip file.
+# But unlike most streaming writers (zipstream-ng writes zeros there), the
+# local header carries the file's real sizes, which we got from stat().
+# That is what lets unzip.StreamingUnzipper find the end of every entry as
+# it arrives, without guessing, and it also means the length of the whole
+# zip file is known before any of it has been read.
+#
+# A deflated file's compressed size can't be known without deflating it,
+# so add_path() does that once (keeping nothing but the CRC and the size),
+# and the file is deflated again as it is sent. zlib gives the same output
+# for the same input and settings, so the header we write first is right,
+# unless the file changed in between, which we notice at the end.
+
+import os
+import stat
+import struct
+import time
+import zlib
+
+from .unzip import (CENTRAL_HEADER, CENTRAL_SIG, DEFLATED, DESCRIPTOR,
+                    DESCRIPTOR64, DESCRIPTOR_SIG, END, END_SIG,
+                    FLAG_DESCRIPTOR, FLAG_UTF8, LOCAL_HEADER, LOCAL_SIG,
+                    STORED, ZIP64_END_SIG, ZIP64_LOCATOR_SIG)
+
+READ_SIZE = 2**16
+# files with these extensions are compressed already, so they're stored in
+# the zipfile as-is rather than spending CPU time deflating them again
+COMPRESSED_EXTENSIONS = frozenset("""
+    7z apk avi bz2 deb docx epub flac gif gz heic jar jpeg jpg lz lz4 lzma
+    m4a m4v mkv mov mp3 mp4 mpg odp ods odt ogg opus png pptx rar rpm tbz
+    tgz txz webm webp whl xlsx xz zip zst
+""".split())
+# we deflate the first DEFLATE_SAMPLE bytes of every other file, and only
+# deflate the whole thing if that shrank to DEFLATE_RATIO of its size or less
+DEFLATE_SAMPLE = 2**16
+DEFLATE_RATIO = 0.9
+# sizes and offsets this big (and entry counts of 0xFFFF) need zip64 fields,
+# and the ordinary fields then hold these markers instead
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+ZIP64_COUNT_MARKER = 0xFFFF
+ZIP64_EXTRA = 0x0001
+VERSION = 20
+VERSION_ZIP64 = 45
+# the "version made by" says Unix, so unzippers honour our permissions
+MADE_BY_UNIX = 3 << 8
+ZIP64_END = struct.Struct("<4sQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<4sIQI")
+
+
+def worth_deflating(path, level):
+    """Return True if the file at 'path' should be deflated at 'level', or
+    False if it should be stored as-is: because it's one of the
+    COMPRESSED_EXTENSIONS, or its first DEFLATE_SAMPLE bytes don't compress
+    well enough to be worth the CPU time."""
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    if not level or ext in COMPRESSED_EXTENSIONS:
+        return False
+    with open(path, "rb") as f:
+        sample = f.read(DEFLATE_SAMPLE)
+    if not sample:
+        return False
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return len(c.compress(sample) + c.flush()) <= len(sample) * DEFLATE_RATIO
+
+
+def _dos_date_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0x21, 0  # 1980-01-01, the earliest a zip file can say
+    date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    return date, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+
+class _Member:
+    __slots__ = ("path", "name", "is_dir", "mode", "size", "date", "time",
+                 "method", "crc", "csize", "offset")
+
+    def __init__(self, path, name, st):
+        self.path = path
+        self.is_dir = stat.S_ISDIR(st.st_mode)
+        self.name = name + "/" if self.is_dir else name
+        self.mode = st.st_mode
+        self.size = 0 if self.is_dir else st.st_size
+        self.date, self.time = _dos_date_time(st.st_mtime)
+        self.method = STORED
+        self.crc = 0
+        self.csize = self.size
+        self.offset = 0
+
+    @property
+    def zip64(self):
+        return max(self.size, self.csize) >= ZIP64_LIMIT
+
+    @property
+    def flags(self):
+        # only a stored file's CRC comes after its data
+        if self.is_dir or self.method == DEFLATED:
+            return FLAG_UTF8
+        return FLAG_UTF8 | FLAG_DESCRIPTOR
+
+    def local_header(self):
+        name = self.name.encode("utf-8")
+        extra = b""
+        crc = self.crc if self.method == DEFLATED else 0
+        size, csize = self.size, self.csize
+        if self.zip64:
+            extra = struct.pack("<HHQQ", ZIP64_EXTRA, 16, size, csize)
+            size = csize = ZIP64_MARKER
+        return LOCAL_HEADER.pack(
+            LOCAL_SIG, VERSION_ZIP64 if self.zip64 else VERSION, self.flags,
+            self.method, self.time, self.date, crc, csize, size, len(name),
+            len(extra)) + name + extra
+
+    def descriptor(self):
+        if not self.flags & FLAG_DESCRIPTOR:
+            return b""
+        if self.zip64:
+            return DESCRIPTOR64.pack(DESCRIPTOR_SIG, self.crc, self.size,
+                                     self.size)
+        return DESCRIPTOR.pack(DESCRIPTOR_SIG, self.crc, self.size, self.size)
+
+    def central_header(self):
+        name = self.name.encode("utf-8")
+        size, csize, offset = self.size, self.csize, self.offset
+        fields = []
+        if self.zip64:
+            fields += [size, csize]
+            size = csize = ZIP64_MARKER
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_MARKER
+        extra = b""
+        if fields:
+            extra = struct.pack("<HH%dQ" % len(fields), ZIP64_EXTRA,
+                                8 * len(fields), *fields)
+        external_attr = (self.mode & 0xFFFF) << 16
+        if self.is_dir:
+            external_attr |= 0x10  # the MS-DOS directory attribute
+        return CENTRAL_HEADER.pack(
+            CENTRAL_SIG, MADE_BY_UNIX | VERSION_ZIP64,
+            VERSION_ZIP64 if fields else VERSION, self.flags, self.method,
+            self.time, self.date, self.crc, csize, size, len(name),
+            len(extra), 0, 0, 0, external_attr, offset) + name + extra
+
+    def read(self):
+        """Yield the contents of my file, raising RuntimeError if it isn't
+        the size it was when we added it."""
+        sent = 0
+        with open(self.path, "rb") as f:
+            while sent < self.size:
+                data = f.read(min(READ_SIZE, self.size - sent))
+                if not data:
+                    break
+                sent += len(data)
+                yield data
+            if sent != self.size or f.read(1):
+                raise self.changed()
+
+    def deflate(self, level):
+        """Yield the contents of my file, deflated at 'level', and set my
+        CRC."""
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        crc = 0
+        for data in self.read():
+            crc = zlib.crc32(data, crc)
+            out = c.compress(data)
+            if out:
+                yield out
+        yield c.flush()
+        self.crc = crc
+
+    def changed(self):
+        return RuntimeError(f"Error adding '{self.name}' to the zipfile: "
+                            f"it changed while we were sending it")
+
+
+def _end_records(count, cd_offset, cd_size):
+    end = b""
+    if (count >= ZIP64_COUNT_LIMIT or cd_offset >= ZIP64_LIMIT
+            or cd_size >= ZIP64_LIMIT):
+        zip64_end_offset = cd_offset + cd_size
+        end += ZIP64_END.pack(ZIP64_END_SIG, ZIP64_END.size - 12,
+                              MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64,
+                              0, 0, count, count, cd_size, cd_offset)
+        end += ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIG, 0, zip64_end_offset, 1)
+        count = ZIP64_COUNT_MARKER
+        cd_size = cd_offset = ZIP64_MARKER
+    return end + END.pack(END_SIG, 0, 0, count, count, cd_size, cd_offset, 0)
+
+
+class ZipWriter:
+    """A zip file of files and (empty) directories. Add them with
+    add_path(), then iterate over me for the bytes of the zip file, whose
+    length len() knows in advance. With a 'compress_level', the files that
+    worth_deflating() picks are deflated (and add_path() deflates each of
+    those once, to find out how big it will be), and the rest are stored.
+    Files are read as they are sent, and one that has changed since it was
+    added raises RuntimeError."""
+
+    def __init__(self, compress_level=0):
+        self._level = compress_level
+        self._members = []
+        self._by_arcname = {}
+
+    def add_path(self, path, arcname):
+        """Add the file or (empty) directory at 'path' as 'arcname'."""
+        name = arcname.replace(os.sep, "/").rstrip("/")
+        m = _Member(path, name, os.stat(path))
+        if self._level and not m.is_dir and worth_deflating(path, self._level):
+            m.method = DEFLATED
+            m.csize = sum(len(out) for out in m.deflate(self._level))
+        self._members.append(m)
+        self._by_arcname[arcname] = m
+
+    def select(self, entries):
+        """Return a ZipWriter of just 'entries', some of the (path, arcname)
+        that were added to me, without reading any of them again."""
+        zw = ZipWriter(self._level)
+        for path, arcname in entries:
+            m = self._by_arcname[arcname]
+            zw._members.append(m)
+            zw._by_arcname[arcname] = m
+        return zw
+
+    def info_list(self):
+        return [{"size": m.size, "is_dir": m.is_dir} for m in self._members]
+
+    def __len__(self):
+        offset = 0
+        for m in self._members:
+            m.offset = offset
+            offset += (len(m.local_header()) + m.csize +
+                       len(m.descriptor()))
+        cd_size = sum(len(m.central_header()) for m in self._members)
+        return (offset + cd_size +
+                len(_end_records(len(self._members), offset, cd_size)))
+
+    def __iter__(self):
+        offset = 0
+        for m in self._members:
+            m.offset = offset
+            header = m.local_header()
+            offset += len(header)
+            yield header
+            if m.is_dir:
+                continue
+            if m.method == DEFLATED:
+                crc, sent = m.crc, 0
+                for out in m.deflate(self._level):
+                    sent += len(out)
+                    if sent > m.csize:
+                        raise m.changed()
+                    yield out
+                if sent != m.csize or m.crc != crc:
+                    raise m.changed()
+            else:
+                crc = 0
+                for data in m.read():
+                    crc = zlib.crc32(data, crc)
+                    yield data
+                m.crc = crc
+            descriptor = m.descriptor()
+            offset += m.csize + len(descriptor)
+            if descriptor:
+                yield descriptor
+        central = b"".join(m.central_header() for m in self._members)
+        yield central
+        yield _end_records(len(self._members), offset, len(central))
@@ -1,14 +1,25 @@
 # no unicode_literals
 # Find all of our ip addresses. From tahoe's src/allmydata/util/iputil.py
 
+import ctypes
 import errno
+import ipaddress
 import os
 import re
+import socket
 import subprocess
-from sys import platform
+import time
+from sys import byteorder, platform
 
 from twisted.python.procutils import which
 
+# Asking the OS directly (with getifaddrs) is much faster than running a
+# subprocess, and our callers ask every time they start listening, so we
+# remember the answer for a few seconds.
+CACHE_TTL = 5.0
+_clock = time.monotonic
+_cache = {}  # "addresses" -> (expiry, [(family, address), ..])
+
 # Wow, I'm really amazed at home much mileage we've gotten out of calling
 # the external route.exe program on windows...  It appears to work on all
 # versions so far.  Still, the real system calls would much be preferred...
@@ -34,7 +45,96 @@ _unix_commands = (
 )
 
 
-def find_addresses():
+def find_addresses(ipv6=False):
+    """Return a list of our IP addresses, as strings: just IPv4 by default,
+    or IPv4 followed by IPv6 (without the link-local ones, which are no use
+    in a hint) if ipv6=True. The loopback address is included, and if we
+    can't find anything else, we return ["127.0.0.1"]."""
+    now = _clock()
+    cached = _cache.get("addresses")
+    if cached and cached[0] > now:
+        found = cached[1]
+    else:
+        found = _getifaddrs()
+        if not found:
+            # the tools only tell us about IPv4
+            found = [(socket.AF_INET, a) for a in _find_addresses_by_tool()]
+        _cache["addresses"] = (now + CACHE_TTL, found)
+    addresses = [a for (family, a) in found if family == socket.AF_INET]
+    if ipv6:
+        addresses.extend(a for (family, a) in found
+                         if family == socket.AF_INET6
+                         and not ipaddress.ip_address(a).is_link_local)
+    return addresses or ["127.0.0.1"]
+
+
+# struct ifaddrs, from <ifaddrs.h>. The BSDs (including macOS) have a
+# separate ifa_dstaddr where Linux has a union, but the layout is the same.
+class _ifaddrs(ctypes.Structure):
+    pass
+
+
+_ifaddrs._fields_ = [
+    ("ifa_next", ctypes.POINTER(_ifaddrs)),
+    ("ifa_name", ctypes.c_char_p),
+    ("ifa_flags", ctypes.c_uint),
+    ("ifa_addr", ctypes.c_void_p),
+    ("ifa_netmask", ctypes.c_void_p),
+    ("ifa_dstaddr", ctypes.c_void_p),
+    ("ifa_data", ctypes.c_void_p),
+]
+
+IFF_UP = 0x1
+# offset of the address within struct sockaddr_in and sockaddr_in6
+_SOCKADDR_OFFSETS = {socket.AF_INET: (4, 4), socket.AF_INET6: (8, 16)}
+
+
+def _sockaddr_family(sa):
+    # Linux starts struct sockaddr with a 16-bit sa_family. BSD starts with
+    # an 8-bit sa_len, then an 8-bit sa_family.
+    head = ctypes.string_at(sa, 2)
+    if platform.startswith("linux"):
+        return int.from_bytes(head, byteorder)
+    return head[1]
+
+
+def _getifaddrs():
+    """Ask the kernel for the addresses of all interfaces that are up.
+    Returns a list of (family, address) tuples, or None if getifaddrs(3)
+    isn't available."""
+    if platform == "win32":
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        getifaddrs = libc.getifaddrs
+        freeifaddrs = libc.freeifaddrs
+    except (OSError, AttributeError, TypeError):
+        return None
+    getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(_ifaddrs))]
+    freeifaddrs.argtypes = [ctypes.POINTER(_ifaddrs)]
+    head = ctypes.POINTER(_ifaddrs)()
+    if getifaddrs(ctypes.byref(head)) != 0:
+        return None
+    found = []
+    try:
+        ifa = head
+        while ifa:
+            entry = ifa.contents
+            if entry.ifa_addr and entry.ifa_flags & IFF_UP:
+                family = _sockaddr_family(entry.ifa_addr)
+                if family in _SOCKADDR_OFFSETS:
+                    offset, length = _SOCKADDR_OFFSETS[family]
+                    packed = ctypes.string_at(entry.ifa_addr + offset, length)
+                    addr = socket.inet_ntop(family, packed)
+                    if (family, addr) not in found:
+                        found.append((family, addr))
+            ifa = entry.ifa_next
+    finally:
+        freeifaddrs(head)
+    return found
+
+
+def _find_addresses_by_tool():
     # originally by Greg Smith, hacked by Zooko and then Daira
 
     # We don't reach here for cygwin.
@@ -62,7 +162,7 @@ def find_addresses():
             if addresses:
                 return addresses
 
-    return ["127.0.0.1"]
+    return []
 
 
 def _query(path, args, regex):
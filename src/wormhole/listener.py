@@ -0,0 +1,196 @@
+# One long-lived listening port, shared by every Transit and Dilation object
+# that wants to accept inbound connections.
+#
+# Normally each TransitSender/TransitReceiver (and each generation of a
+# Dilation connector) binds a fresh random port, and closes it once it has a
+# connection. A SharedListener instead owns a single port (which may be fixed,
+# so firewall rules can be written for it, and NAT mappings get a chance to
+# stay warm) for as long as the application likes. Each user registers the
+# first bytes it expects an inbound peer to send, and the listener hands each
+# connection to whoever expects it once those bytes have arrived. For Transit
+# that is the peer's handshake, which is derived from the transit key, so it
+# is unique to one transfer. Dilation connections start with a prologue which
+# (in Dilation version "ogion") carries a token derived from the dilation key,
+# so it is unique to one wormhole too. Older ("ged") peers send a fixed
+# prologue, so if several of those Dilation connectors (with the same role)
+# are waiting at the same time, the oldest one gets the connection.
+
+from attr import attrs, attrib
+from twisted.internet import defer, protocol
+from twisted.internet.interfaces import IListeningPort
+from twisted.python import log
+from zope.interface import implementer
+
+# how long an inbound connection may take to identify itself, and the most it
+# may send us while doing so
+ROUTING_TIMEOUT = 30
+MAX_ROUTING_PREFIX = 1024
+
+
+class _Router(protocol.Protocol):
+    """I buffer the start of an inbound connection until my listener knows
+    who it is for. After that, I pass everything through to the real
+    Protocol."""
+
+    def __init__(self, listener):
+        self._listener = listener
+        self.buf = b""
+        self._inner = None
+        self._timer = None
+
+    def connectionMade(self):
+        self._timer = self._listener._reactor.callLater(
+            ROUTING_TIMEOUT, self.transport.loseConnection)
+        self._listener._unrouted.add(self)
+
+    def dataReceived(self, data):
+        if self._inner:
+            return self._inner.dataReceived(data)
+        self.buf += data
+        self._listener._route(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self._inner:
+            return self._inner.connectionLost(reason)
+        self._stop_timer()
+        self._listener._unrouted.discard(self)
+
+    def _stop_timer(self):
+        t, self._timer = self._timer, None
+        if t and t.active():
+            t.cancel()
+
+    def hand_over(self, factory):
+        self._stop_timer()
+        self._listener._unrouted.discard(self)
+        p = factory.buildProtocol(self.transport.getPeer())
+        if p is None:
+            self.transport.loseConnection()
+            return
+        self._inner = p
+        p.makeConnection(self.transport)
+        buf, self.buf = self.buf, b""
+        if buf:
+            p.dataReceived(buf)
+
+
+class _RouterFactory(protocol.Factory):
+    def __init__(self, listener):
+        self._listener = listener
+
+    def buildProtocol(self, addr):
+        return _Router(self._listener)
+
+
+@implementer(IListeningPort)
+@attrs(eq=False)
+class _Registration:
+    """What a SharedEndpoint's listen() gives back: it looks like a
+    listening port (so getHost() tells you the shared port number), but
+    stopListening() only stops routing connections to this factory."""
+
+    _listener = attrib()
+    _factory = attrib()
+    prefix = attrib(default=None)
+
+    def startListening(self):
+        pass
+
+    def stopListening(self):
+        self._listener._unregister(self)
+        return defer.succeed(None)
+
+    def getHost(self):
+        return self._listener._port.getHost()
+
+
+@attrs(eq=False)
+class SharedEndpoint:
+    """An IStreamServerEndpoint-alike for one user of a SharedListener.
+    'prefix' is what an inbound peer will send first (bytes), or a Deferred
+    that fires with it once we know."""
+
+    _listener = attrib()
+    _prefix = attrib()
+
+    def listen(self, factory):
+        return defer.succeed(self._listener._register(self._prefix, factory))
+
+
+class SharedListener:
+    """I listen on one TCP port on behalf of many Transit and Dilation
+    objects, and route each inbound connection to the one it is meant for.
+    Pass me to TransitSender/TransitReceiver (or w.dilate()) as listener=.
+
+    With port=0 (the default), the OS picks the port, once, when I am first
+    used. I keep listening until stopListening() is called."""
+
+    def __init__(self, reactor=None, port=0, interface=""):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._portnum = port
+        self._interface = interface
+        self._port = None
+        self._registrations = []  # oldest first
+        self._unrouted = set()
+
+    def start(self):
+        if not self._port:
+            self._port = self._reactor.listenTCP(self._portnum,
+                                                 _RouterFactory(self),
+                                                 interface=self._interface)
+        return self._port.getHost().port
+
+    def endpoint(self, prefix):
+        """Return an endpoint whose listen(factory) arranges for inbound
+        connections that start with 'prefix' to be given to 'factory'."""
+        self.start()
+        return SharedEndpoint(self, prefix)
+
+    def stopListening(self):
+        for r in list(self._unrouted):
+            r.transport.loseConnection()
+        port, self._port = self._port, None
+        if port:
+            return port.stopListening()
+        return defer.succeed(None)
+
+    def _register(self, prefix, factory):
+        reg = _Registration(self, factory)
+        self._registrations.append(reg)
+
+        def _known(prefix):
+            assert isinstance(prefix, bytes), prefix
+            reg.prefix = prefix
+            for r in list(self._unrouted):
+                self._route(r)
+
+        d = defer.maybeDeferred(lambda: prefix)
+        d.addCallback(_known)
+        d.addErrback(log.err)
+        return reg
+
+    def _unregister(self, reg):
+        if reg in self._registrations:
+            self._registrations.remove(reg)
+        for r in list(self._unrouted):
+            self._route(r)
+
+    def _route(self, router):
+        buf = router.buf
+        if not buf:
+            return
+        waiting = False
+        for reg in self._registrations:
+            if reg.prefix is None:
+                # someone who doesn't know their prefix yet might want this
+                waiting = True
+            elif buf.startswith(reg.prefix):
+                router.hand_over(reg._factory)
+                return
+            elif reg.prefix.startswith(buf):
+                waiting = True
+        if not waiting or len(buf) > MAX_ROUTING_PREFIX:
+            # nobody here wants this connection
+            router.transport.loseConnection()
@@ -8,7 +8,7 @@ from ...eventual import EventualQueue
 from ..._interfaces import IDilationConnector
 from ..._dilation.roles import LEADER, FOLLOWER
 from ..._dilation.connection import (DilatedConnectionProtocol, encode_record,
-                                     KCM, Open, Ack)
+                                     KCM, Open, Close, Ack)
 from .common import clear_mock_calls
 
 
@@ -311,3 +311,32 @@ def test_follower_combined():
     assert t.mock_calls == []
     assert m.mock_calls[1:] == [mock.call.got_record(t_open)]
     clear_mock_calls(n, connector, t, m)
+
+
+def test_selected_skips_state_machines():
+    # once a connection is selected, frames go straight from the framer
+    # through Noise to the Manager, without any state-machine inputs
+    c, n, connector, t, eq = make_con(LEADER)
+    t_open = Open(seqnum=1, scid=0x11223344, subprotocol="proto")
+    t_close = Close(seqnum=2, scid=0x11223344)
+    n.decrypt = mock.Mock(side_effect=[
+        encode_record(KCM()),
+        encode_record(t_open),
+        encode_record(t_close),
+    ])
+    m = mock.Mock()  # Manager
+    c.makeConnection(t)
+    c.dataReceived(b"inbound_prologue\n")
+    c.dataReceived(b"\x00\x00\x00\x0Ahandshake2")
+    c.dataReceived(b"\x00\x00\x00\x03KCM")
+    c.select(m)
+    clear_mock_calls(n, m)
+
+    c._record._framer.parse = mock.Mock(side_effect=AssertionError)
+    c._record.got_frame = mock.Mock(side_effect=AssertionError)
+    c.got_record = mock.Mock(side_effect=AssertionError)
+    c.dataReceived(b"\x00\x00\x00\x04msg1\x00\x00\x00\x04msg2")
+    assert n.mock_calls == [mock.call.decrypt(b"msg1"),
+                            mock.call.decrypt(b"msg2")]
+    assert m.mock_calls == [mock.call.got_record(t_open),
+                            mock.call.got_record(t_close)]
@@ -21,6 +21,7 @@ from ..._dilation.connector import (Connector,
                                     OutboundConnectionFactory,
                                     InboundConnectionFactory,
                                     PROLOGUE_LEADER, PROLOGUE_FOLLOWER,
+                                    build_routed_prologue,
                                     )
 from ..._status import DilationHint
 from .common import clear_mock_calls
@@ -114,7 +115,8 @@ def test_build_inbound():
     assert p.factory is f
 
 
-def make_connector(listen=True, tor=False, relay=None, role=roles.LEADER):
+def make_connector(listen=True, tor=False, relay=None, role=roles.LEADER,
+                   routed=False):
     class Holder:
         pass
     h = Holder()
@@ -132,7 +134,7 @@ def make_connector(listen=True, tor=False, relay=None, role=roles.LEADER):
     h.side = "abcd1234abcd5678"
     h.role = role
     c = Connector(h.dilation_key, h.relay, h.manager, h.reactor, h.eq,
-                  not listen, h.tor, timing, h.side, h.role)
+                  not listen, h.tor, timing, h.side, h.role, routed=routed)
     return c, h
 
 
@@ -303,6 +305,46 @@ def test_start_listen():
                                              },
                                             ])]
 
+
+def test_start_shared_listener():
+    for role, prologue in [(roles.LEADER, PROLOGUE_FOLLOWER),
+                           (roles.FOLLOWER, PROLOGUE_LEADER)]:
+        c, h = make_connector(listen=True, role=role)
+        c._listener = listener = mock.Mock()
+        ep = listener.endpoint.return_value
+        ep.listen = mock.Mock(return_value=Deferred())
+        with mock.patch("wormhole._dilation.connector.serverFromString") \
+                as sfs:
+            c._start_listener(["1.2.3.4"])
+        # the peer's prologue is how the listener knows the connection is
+        # for us
+        assert sfs.mock_calls == []
+        assert listener.endpoint.mock_calls[0] == mock.call(prologue)
+        assert isinstance(ep.listen.mock_calls[0][1][0],
+                          InboundConnectionFactory)
+
+
+def test_routed_prologue():
+    leader = build_routed_prologue(PROLOGUE_LEADER, b"key")
+    assert leader.startswith(PROLOGUE_LEADER + b"route ")
+    assert leader.endswith(b"\n\n")
+    # unique to each wormhole
+    assert build_routed_prologue(PROLOGUE_LEADER, b"other key") != leader
+
+    c, h = make_connector(listen=True, role=roles.FOLLOWER, routed=True)
+    with mock.patch("wormhole._dilation.connector.build_noise"):
+        with mock.patch("wormhole._dilation.connector.DilatedConnectionProtocol"
+                        ) as dcp:
+            c.build_protocol(object(), "desc")
+    assert dcp.mock_calls[0][1][5:] == \
+        (build_routed_prologue(PROLOGUE_FOLLOWER, b"key"), leader)
+    # so a shared listener hands us only our own peer's connections
+    c._listener = listener = mock.Mock()
+    listener.endpoint.return_value.listen = mock.Mock(return_value=Deferred())
+    c._start_listener(["1.2.3.4"])
+    assert listener.endpoint.mock_calls[0] == mock.call(leader)
+
+
 def test_schedule_connection_no_relay():
     c, h = make_connector(listen=True, role=roles.LEADER)
     hint = DirectTCPV1Hint("foo", 55, 0.0)
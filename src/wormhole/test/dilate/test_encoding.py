@@ -16,6 +16,8 @@ def test_be4():
     assert from_be4(b"\x00\x00\x00\x01") == 1
     assert from_be4(b"\x00\x00\x01\x00") == 256
     assert from_be4(b"\x00\x00\x01\x01") == 257
+    assert from_be4(bytearray(b"\x00\x00\x01\x02")) == 258
+    assert from_be4(memoryview(b"\x00\x00\x01\x03")) == 259
 
     with pytest.raises(TypeError):
         from_be4(0)
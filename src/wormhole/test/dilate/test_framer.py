@@ -64,6 +64,12 @@ def test_good_prologue():
     f.send_frame(b"frame")
     assert t.mock_calls == \
                      [mock.call.write(b"\x00\x00\x00\x05frame")]
+    t.mock_calls[:] = []
+
+    # a frame in several parts is written without joining them
+    f.send_frame_parts([b"fr", b"ame"])
+    assert t.mock_calls == [
+        mock.call.writeSequence([b"\x00\x00\x00\x05", b"fr", b"ame"])]
 
 
 def test_bad_relay():
@@ -112,3 +118,45 @@ def test_frame():
     assert [] == list(f.add_and_parse(encoded_frame[2:6]))
     assert [Frame(frame=b"frame")] == \
                      list(f.add_and_parse(encoded_frame[6:]))
+
+
+def test_frames_in_one_read():
+    f, t = make_framer()
+    f.connectionMade()
+    frames = [b"a" * n for n in (0, 1, 5, 1000, 70000)]
+    data = b"inbound_prologue\n" + b"".join(
+        len(frame).to_bytes(4, "big") + frame for frame in frames)
+    tokens = list(f.add_and_parse(data))
+    assert tokens[0] == Prologue()
+    assert [bytes(token.frame) for token in tokens[1:]] == frames
+    assert all(isinstance(token.frame, memoryview) for token in tokens[1:])
+
+
+@pytest.mark.parametrize("read_size", [1, 3, 1000, 2**16])
+def test_frames_split_across_reads(read_size):
+    f, t = make_framer()
+    f.connectionMade()
+    list(f.add_and_parse(b"inbound_prologue\n"))
+    frames = [bytes([i]) * (i * 37) for i in range(100)]
+    data = b"".join(len(frame).to_bytes(4, "big") + frame for frame in frames)
+    got = []
+    for i in range(0, len(data), read_size):
+        # copy each frame before asking for the next read, like _Record
+        got.extend(bytes(token.frame)
+                   for token in f.add_and_parse(data[i:i + read_size]))
+    assert got == frames
+    # everything was consumed, so the next read compacts the buffer
+    assert [] == list(f.add_and_parse(b"\x00"))
+    assert bytes(f._buffer) == b"\x00"
+
+
+def test_frame_held_across_reads():
+    f, t = make_framer()
+    f.connectionMade()
+    list(f.add_and_parse(b"inbound_prologue\n"))
+    [first] = list(f.add_and_parse(b"\x00\x00\x00\x05frame\x00\x00"))
+    # the first Frame still points into the old buffer, so the framer has to
+    # switch to a new one rather than resizing it
+    [second] = list(f.add_and_parse(b"\x00\x03two"))
+    assert first == Frame(frame=b"frame")
+    assert second == Frame(frame=b"two")
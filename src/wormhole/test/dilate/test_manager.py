@@ -8,7 +8,7 @@ import pytest_twisted
 from ...eventual import EventualQueue
 from ..._interfaces import ISend, ITerminator, ISubChannel
 from ...util import dict_to_bytes
-from ..._dilation import roles
+from ..._dilation import roles, manager
 from ..._dilation.manager import (Dilator, Manager, make_side,
                                   OldPeerCannotDilateError,
                                   CanOnlyDilateOnceError,
@@ -63,7 +63,8 @@ def test_dilate_first():
     assert eps1 is eps
     assert mm.mock_calls == [mock.call(h.send, side, None,
                                        h.reactor, h.eq, h.coop, DILATION_VERSIONS, 30.0, None,
-                                       False, None, initial_mailbox_status=None)]
+                                       False, None, initial_mailbox_status=None,
+                                       listener=None)]
 
     assert m.mock_calls == []
 
@@ -178,7 +179,8 @@ def test_transit_relay():
         dil.dilate(transit_relay_location)
     assert mm.mock_calls == [mock.call(h.send, side, transit_relay_location,
                                        h.reactor, h.eq, h.coop, DILATION_VERSIONS, 30.0, None,
-                                       False, None, initial_mailbox_status=None)]
+                                       False, None, initial_mailbox_status=None,
+                                       listener=None)]
 
 
 LEADER = "ff3456abcdef"
@@ -301,7 +303,8 @@ def test_leader():
                   False,  # no_listen
                   None,  # tor
                   None,  # timing
-                  LEADER, roles.LEADER),
+                  LEADER, roles.LEADER,
+                  listener=None, routed=False),
         ]
     assert c.mock_calls == [mock.call.start()]
     clear_mock_calls(connector, c)
@@ -458,7 +461,8 @@ def test_leader():
                   False,  # no_listen
                   None,  # tor
                   None,  # timing
-                  LEADER, roles.LEADER),
+                  LEADER, roles.LEADER,
+                  listener=None, routed=False),
         ]
     assert c2.mock_calls == [mock.call.start()]
     clear_mock_calls(connector2, c2)
@@ -498,7 +502,8 @@ def test_follower():
                   False,  # no_listen
                   None,  # tor
                   None,  # timing
-                  FOLLOWER, roles.FOLLOWER),
+                  FOLLOWER, roles.FOLLOWER,
+                  listener=None, routed=False),
         ]
     assert c.mock_calls == [mock.call.start()]
     clear_mock_calls(connector, c)
@@ -536,7 +541,8 @@ def test_follower():
                   False,  # no_listen
                   None,  # tor
                   None,  # timing
-                  FOLLOWER, roles.FOLLOWER),
+                  FOLLOWER, roles.FOLLOWER,
+                  listener=None, routed=False),
         ]
     assert c2.mock_calls == [mock.call.start()]
     clear_mock_calls(connector2, c2)
@@ -553,7 +559,8 @@ def test_follower():
                   False,  # no_listen
                   None,  # tor
                   None,  # timing
-                  FOLLOWER, roles.FOLLOWER),
+                  FOLLOWER, roles.FOLLOWER,
+                  listener=None, routed=False),
         ]
     assert c3.mock_calls == [mock.call.start()]
     clear_mock_calls(c2, connector3, c3)
@@ -575,7 +582,8 @@ def test_follower():
                   False,  # no_listen
                   None,  # tor
                   None,  # timing
-                  FOLLOWER, roles.FOLLOWER),
+                  FOLLOWER, roles.FOLLOWER,
+                  listener=None, routed=False),
         ]
     assert c4.mock_calls == [mock.call.start()]
     clear_mock_calls(c3, connector4, c4)
@@ -610,7 +618,7 @@ def test_ping_pong(observe_errors):
 
     m.send_ping(2, lambda _: None)
     assert h.outbound.mock_calls == \
-                     [mock.call.send_if_connected(Pong(2))]
+                     [mock.call.send_if_connected(Ping(2))]
     clear_mock_calls(h.outbound)
 
     # sort of low-level; what does this look like to API user?
@@ -621,7 +629,7 @@ def test_ping_pong(observe_errors):
         raise FakeError()
     m.send_ping(3, cause_error)
     assert h.outbound.mock_calls == \
-                     [mock.call.send_if_connected(Pong(3))]
+                     [mock.call.send_if_connected(Ping(3))]
     clear_mock_calls(h.outbound)
     with pytest.raises(FakeError):
         m.got_record(Pong(3))
@@ -719,3 +727,87 @@ def test_status_hints():
 
 
 # TODO: test transit relay is used
+
+
+def make_connected_manager(versions):
+    # a Follower, so there are no pings (or ping timers) to get in the way
+    m, h = make_manager(leader=False)
+    m._reactor = h.clock  # so we can see the delayed-ack timer fire
+    m.got_wormhole_versions({"can-dilate": versions})
+    with mock.patch("wormhole._dilation.manager.Connector"):
+        m.rx_PLEASE({"side": LEADER, "use-version": versions[0]})
+    m.connector_connection_made(mock.Mock())
+    h.inbound.is_record_old = mock.Mock(return_value=False)
+    clear_mock_calls(h.outbound, h.inbound)
+    return m, h
+
+
+def test_routed_prologues():
+    # only peers who both speak "ogion" add a routing token to the prologue
+    for versions, routed in [(["ogion", "ged"], True), (["ged"], False)]:
+        m, h = make_manager(leader=False)
+        m.got_wormhole_versions({"can-dilate": versions})
+        with mock.patch("wormhole._dilation.manager.Connector") as connector:
+            m.rx_PLEASE({"side": LEADER, "use-version": versions[0]})
+        assert connector.mock_calls[0].kwargs["routed"] is routed
+
+
+def acks_sent(h):
+    acks = [c.args[0] for c in h.outbound.mock_calls
+            if c[0] == "send_if_connected"]
+    clear_mock_calls(h.outbound)
+    return acks
+
+
+def test_delayed_acks():
+    m, h = make_connected_manager(["ogion", "ged"])
+    assert m._dilation_version == "ogion"
+
+    # a few records get a single ACK, once ACK_DELAY has passed
+    m.got_record(Open(0, 2, "proto"))
+    m.got_record(Data(1, 2, b"data"))
+    m.got_record(Data(2, 2, b"data"))
+    assert acks_sent(h) == []
+    h.clock.advance(manager.ACK_DELAY)
+    assert acks_sent(h) == [Ack(2)]
+    assert [c[0] for c in h.inbound.mock_calls].count("handle_data") == 2
+
+    # a steady stream gets one ACK for every ACK_EVERY records
+    for seqnum in range(3, 3 + 2 * manager.ACK_EVERY):
+        m.got_record(Data(seqnum, 2, b"data"))
+    assert acks_sent(h) == [Ack(2 + manager.ACK_EVERY),
+                            Ack(2 + 2 * manager.ACK_EVERY)]
+    assert h.clock.getDelayedCalls() == []
+
+    # re-sent (old) records are acked too, with the highest seqnum so far
+    h.inbound.is_record_old = mock.Mock(return_value=True)
+    m.got_record(Data(30, 2, b"data"))
+    h.clock.advance(manager.ACK_DELAY)
+    assert acks_sent(h) == [Ack(2 + 2 * manager.ACK_EVERY)]
+
+    # losing the connection cancels a pending ACK: the peer will re-send
+    # those records
+    h.inbound.is_record_old = mock.Mock(return_value=False)
+    m.got_record(Data(35, 2, b"data"))
+    m.connector_connection_lost()
+    assert h.clock.getDelayedCalls() == []
+    assert acks_sent(h) == []
+
+
+def test_acks_for_old_peers():
+    m, h = make_connected_manager(["ged"])
+    assert m._dilation_version == "ged"
+    for seqnum in range(3):
+        m.got_record(Data(seqnum, 2, b"data"))
+    assert acks_sent(h) == [Ack(0), Ack(1), Ack(2)]
+    assert h.clock.getDelayedCalls() == []
+
+
+def test_follower_uses_leaders_version():
+    m, h = make_manager(leader=False)
+    m.got_wormhole_versions({"can-dilate": ["ogion", "ged"]})
+    assert m._dilation_version == "ogion"
+    with mock.patch("wormhole._dilation.manager.Connector"):
+        m.rx_PLEASE({"side": LEADER, "use-version": "ged"})
+    assert m._dilation_version == "ged"
+    assert not m._delay_acks
@@ -26,6 +26,23 @@ def test_parse():
                          b"\x07unknown"))]
 
 
+@pytest.mark.parametrize("plaintext", [
+    b"",
+    b"\x03\x00\x00\x02\x01\x00\x00\x01",
+    b"\x04\x00\x00",
+    b"\x05",
+    b"\x06\x00\x00\x01",
+])
+def test_parse_short(plaintext):
+    with mock.patch("wormhole._dilation.connection.log.err") as le:
+        with pytest.raises(ValueError):
+            parse_record(plaintext)
+        with pytest.raises(ValueError):
+            parse_record(memoryview(bytearray(plaintext)))
+    assert le.mock_calls == \
+        [mock.call(f"received short message: {plaintext}")] * 2
+
+
 def test_encode():
     assert encode_record(KCM()) == b"\x00"
     assert encode_record(Ping(ping_id=b"ping")) == b"\x01ping"
@@ -41,3 +58,25 @@ def test_encode():
     with pytest.raises(TypeError) as ar:
         encode_record("not a record")
     assert str(ar.value) == "not a record"
+    with pytest.raises(ValueError):
+        encode_record(Data(scid=1, seqnum=2**32, data=b""))
+    with pytest.raises(ValueError):
+        encode_record(Close(scid=-1, seqnum=0))
+    with pytest.raises(ValueError):
+        encode_record(Ack(resp_seqnum=2**32))
+
+
+def test_parse_memoryview():
+    # large messages are decrypted into a bytearray, and parsed from a view.
+    # Data payloads are views too, rather than copies
+    def view(data):
+        return memoryview(bytearray(data))
+    assert parse_record(view(b"\x01\x55\x44\x33\x22")) == \
+        Ping(ping_id=b"\x55\x44\x33\x22")
+    assert parse_record(view(b"\x03\x00\x00\x02\x01\x00\x00\x01\x00proto")) == \
+        Open(scid=513, seqnum=256, subprotocol="proto")
+    r = parse_record(view(b"\x04\x00\x00\x02\x02\x00\x00\x01\x01dataaa"))
+    assert r == Data(scid=514, seqnum=257, data=b"dataaa")
+    assert isinstance(r.data, memoryview)
+    assert parse_record(view(b"\x06\x00\x00\x01\x03")) == \
+        Ack(resp_seqnum=259)
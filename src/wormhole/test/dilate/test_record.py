@@ -197,9 +197,9 @@ def test_good():
     n.encrypt = mock.Mock(side_effect=[f_kcm, f_msg1])
     f.add_and_parse = mock.Mock(side_effect=[[],  # no tokens yet
                                              [Prologue()],
-                                             [Frame("f_handshake")],
-                                             [Frame("f_kcm"),
-                                              Frame("f_msg1")],
+                                             [Frame(b"f_handshake")],
+                                             [Frame(b"f_kcm"),
+                                              Frame(b"f_msg1")],
                                              ])
 
     assert f.mock_calls == []
@@ -243,7 +243,7 @@ def test_good():
 
     assert list(r.add_and_unframe(b"handshake")) == [Handshake()]
     assert f.mock_calls == [mock.call.add_and_parse(b"handshake")]
-    assert n.mock_calls == [mock.call.read_message("f_handshake")]
+    assert n.mock_calls == [mock.call.read_message(b"f_handshake")]
     f.mock_calls[:] = []
     n.mock_calls[:] = []
 
@@ -269,8 +269,8 @@ def test_good():
                          [kcm, msg1]
         assert f.mock_calls == \
                          [mock.call.add_and_parse(b"kcm,msg1")]
-        assert n.mock_calls == [mock.call.decrypt("f_kcm"),
-                                        mock.call.decrypt("f_msg1")]
+        assert n.mock_calls == [mock.call.decrypt(b"f_kcm"),
+                                        mock.call.decrypt(b"f_msg1")]
         assert pr.mock_calls == [mock.call(kcm), mock.call(msg1)]
     n.mock_calls[:] = []
     f.mock_calls[:] = []
@@ -298,6 +298,9 @@ def test_large_frame():
         def write(self, data):
             self.data.append(data)
 
+        def writeSequence(self, data):
+            self.data.append(b"".join(data))
+
     # we build both sides of a connection so that underlying Noise
     # structures can be set up and paired properly. Essentially
     # this test is acting like the L2 Protocol object, and can
@@ -378,3 +381,82 @@ def test_large_frame():
             scid=456,
             data=input_plaintext,
         )
+
+
+def paired_records():
+    # a connected (leader, follower) pair of _Records, with their transports
+    @implementer(ITransport)
+    class FakeTransport:
+        def __init__(self):
+            self.data = []
+
+        def write(self, data):
+            self.data.append(data)
+
+        def writeSequence(self, data):
+            self.data.append(b"".join(data))
+
+    pake_secret = b"\x00" * 32
+    noise0 = build_noise()
+    noise0.set_psks(pake_secret)
+    noise0.set_as_initiator()
+    noise1 = build_noise()
+    noise1.set_psks(pake_secret)
+    noise1.set_as_responder()
+    transport0 = FakeTransport()
+    transport1 = FakeTransport()
+    record0 = _Record(_Framer(transport0, b"out prolog", b"in prolog"),
+                      noise0, LEADER)
+    record1 = _Record(_Framer(transport1, b"in prolog", b"out prolog"),
+                      noise1, FOLLOWER)
+    record0.set_role_leader()
+    record1.set_role_follower()
+    record0.connectionMade()
+    record1.connectionMade()
+    list(record0.add_and_unframe(b"in prolog"))
+    list(record1.add_and_unframe(b"".join(transport0.data)))
+    list(record0.add_and_unframe(b"".join(transport1.data[1:])))
+    record1.send_record(KCM())
+    record0.send_record(KCM())
+    assert list(record0.add_and_unframe(transport1.data[-1])) == [KCM()]
+    assert list(record1.add_and_unframe(transport0.data[-1])) == [KCM()]
+    del transport0.data[:]
+    del transport1.data[:]
+    return record0, transport0, record1
+
+
+@pytest.mark.parametrize("size", [
+    65535 - 16 - 9,  # fits in one Noise message
+    65535 - 16 - 8,  # one byte too many
+    (65535 - 16) * 3 - 9,  # exactly three
+    10**7,
+])
+def test_large_frames(size):
+    if not NoiseConnection:
+        import unittest
+        raise unittest.SkipTest("noiseprotocol unavailable")
+    record0, transport0, record1 = paired_records()
+    data = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+    record0.send_record(Data(seqnum=1, scid=2, data=data))
+    [frame] = transport0.data
+    chunks = -(-(size + 9) // (65535 - 16))
+    assert len(frame) == 4 + size + 9 + 16 * chunks
+    [out] = list(record1.add_and_unframe(frame))
+    assert out == Data(seqnum=1, scid=2, data=data)
+
+
+def test_large_frame_truncated():
+    if not NoiseConnection:
+        import unittest
+        raise unittest.SkipTest("noiseprotocol unavailable")
+    record0, transport0, record1 = paired_records()
+    record0.send_record(Data(seqnum=1, scid=2, data=b"x" * 100000))
+    [frame] = transport0.data
+    # chop 10 bytes off the end of the last Noise message, but keep the
+    # frame itself well-formed
+    short = len(frame) - 4 - 10
+    with mock.patch("wormhole._dilation.connection.log.err") as le:
+        with pytest.raises(Disconnect):
+            list(record1.add_and_unframe(short.to_bytes(4, "big") +
+                                         frame[4:-10]))
+    assert len(le.mock_calls) == 1
@@ -121,6 +121,14 @@ def test_subchannel_data():
                                     ]
 
 
+def test_subchannel_data_memoryview():
+    # Data records carry memoryviews, but protocols are given bytes
+    sc, m, scid, hostaddr, peeraddr, p = make_sc()
+    sc.remote_data(memoryview(b"\x04header+data")[7:])
+    assert p.mock_calls == [mock.call.dataReceived(b"+data")]
+    assert type(p.mock_calls[0].args[0]) is bytes
+
+
 def test_subchannel_data_before_open():
     sc, m, scid, hostaddr, peeraddr, p = make_sc(set_protocol=False)
     sc.remote_data(b"data1")
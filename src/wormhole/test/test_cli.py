@@ -1,8 +1,10 @@
 import builtins
+import hashlib
 import io
 import os
 import re
 import stat
+import struct
 import sys
 import tempfile
 import zipfile
@@ -13,9 +15,9 @@ from pathlib import Path
 from click import UsageError
 from click.testing import CliRunner
 from humanize import naturalsize
-from twisted.internet import endpoints, reactor
+from twisted.internet import defer, endpoints, protocol, reactor
 from twisted.internet.defer import gatherResults, CancelledError, ensureDeferred
-from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.error import ConnectionClosed, ConnectionRefusedError
 from twisted.internet.utils import getProcessOutputAndValue
 from twisted.python import log, procutils
 from zope.interface import implementer
@@ -28,17 +30,19 @@ import pytest_twisted
 from hypothesis import given
 from hypothesis import strategies as st
 
-from .. import __version__
+from .. import __version__, transit
 from .._interfaces import ITorManager
-from ..cli import cli, cmd_receive, cmd_send, welcome
+from ..cli import cli, cmd_receive, cmd_send, tarzstd, welcome, zipwriter
 from ..errors import (ServerConnectionError, ServerError, TransferError,
                       UnsendableFileError, WelcomeError, WrongPasswordError)
+from ..timing import DebugTiming
+from ..util import bytes_to_dict, dict_to_bytes
 from .common import config, setup_mailbox
 
 
-def build_offer(args):
+async def build_offer(args):
     s = cmd_send.Sender(args, None)
-    return s._build_offer()
+    return await s._build_offer()
 
 
 def maybe_delete(fn):
@@ -53,10 +57,11 @@ def create_config():
     return cfg
 
 
-def test_text_offer():
+@pytest_twisted.ensureDeferred
+async def test_text_offer():
     cfg = create_config()
     cfg.text = message = "blah blah blah ponies"
-    d, fd_to_send = build_offer(cfg)
+    d, fd_to_send = await build_offer(cfg)
 
     assert "message" in d
     assert "file" not in d
@@ -65,7 +70,8 @@ def test_text_offer():
     assert fd_to_send is None
 
 
-def test_file_offer(tmpdir_factory):
+@pytest_twisted.ensureDeferred
+async def test_file_offer(tmpdir_factory):
     cfg = create_config()
     cfg.what = filename = "my file"
     message = b"yay ponies\n"
@@ -75,7 +81,7 @@ def test_file_offer(tmpdir_factory):
         f.write(message)
 
     cfg.cwd = send_dir
-    d, fd_to_send = build_offer(cfg)
+    d, fd_to_send = await build_offer(cfg)
 
     assert "message" not in d
     assert "file" in d
@@ -98,12 +104,13 @@ def _create_broken_symlink(cfg, parent_dir):
     cfg.cwd = parent_dir
 
 
-def test_broken_symlink_raises_err(tmpdir_factory):
+@pytest_twisted.ensureDeferred
+async def test_broken_symlink_raises_err(tmpdir_factory):
     cfg = create_config()
     _create_broken_symlink(cfg, tmpdir_factory.mktemp("broken_sym"))
     cfg.ignore_unsendable_files = False
     with pytest.raises(UnsendableFileError) as e:
-        build_offer(cfg)
+        await build_offer(cfg)
 
     # On english distributions of Linux, this will be
     # "linky: No such file or directory", but the error may be
@@ -112,28 +119,30 @@ def test_broken_symlink_raises_err(tmpdir_factory):
     assert "linky: " in str(e)
 
 
-def test_broken_symlink_is_ignored(tmpdir_factory):
+@pytest_twisted.ensureDeferred
+async def test_broken_symlink_is_ignored(tmpdir_factory):
     cfg = create_config()
     _create_broken_symlink(cfg, tmpdir_factory.mktemp("broken_sym_ign"))
     cfg.ignore_unsendable_files = True
-    d, fd_to_send = build_offer(cfg)
+    d, fd_to_send = await build_offer(cfg)
     assert '(ignoring error)' in cfg.stderr.getvalue()
     assert d['directory']['numfiles'] == 0
     assert d['directory']['numbytes'] == 0
 
 
-def test_missing_file(tmpdir_factory):
+@pytest_twisted.ensureDeferred
+async def test_missing_file(tmpdir_factory):
     cfg = create_config()
     cfg.what = filename = "missing"
     send_dir = tmpdir_factory.mktemp("missing_file")
     cfg.cwd = send_dir
 
     with pytest.raises(TransferError) as e:
-        build_offer(cfg)
+        await build_offer(cfg)
     assert str(e.value) == f"Cannot send: no file/directory named '{filename}'"
 
 
-def _do_test_directory(parent_dir, addslash):
+async def _do_test_directory(parent_dir, addslash):
     send_dir = "dirname"
     os.mkdir(os.path.join(parent_dir, send_dir))
     ponies = [str(i) for i in range(5)]
@@ -148,7 +157,7 @@ def _do_test_directory(parent_dir, addslash):
     cfg.what = send_dir_arg
     cfg.cwd = parent_dir
 
-    d, fd_to_send = build_offer(cfg)
+    d, fd_to_send = await build_offer(cfg)
 
     assert "message" not in d
     assert "file" not in d
@@ -170,15 +179,186 @@ def _do_test_directory(parent_dir, addslash):
                              contents
 
 
-def test_directory_simple(tmpdir_factory):
-    return _do_test_directory(tmpdir_factory.mktemp("dir"), addslash=False)
+@pytest.mark.parametrize("zstd, level, other_modes, deflated", [
+    (True, 6, [tarzstd.MODE], False),
+    (True, 0, None, False),
+    (False, 6, None, True),
+    (False, 0, None, False),
+])
+@pytest_twisted.ensureDeferred
+async def test_directory_offer_modes(monkeypatch, tmp_path, zstd, level,
+                                     other_modes, deflated):
+    # nothing is deflated before the offer if the receiver might ask for
+    # tar/zstd instead, and tar/zstd is only offered with a level
+    monkeypatch.setattr(tarzstd, "available", lambda: zstd)
+    (tmp_path / "d").mkdir()
+    (tmp_path / "d" / "text").write_bytes(b"ponies " * 10000)
+    cfg = create_config()
+    cfg.what = "d"
+    cfg.cwd = str(tmp_path)
+    cfg.compress_level = level
+
+    with mock.patch.object(zipwriter, "worth_deflating",
+                           wraps=zipwriter.worth_deflating) as wd:
+        d, fd_to_send = await build_offer(cfg)
+    assert d["directory"].get("other-modes") == other_modes
+    assert isinstance(fd_to_send, zipwriter.ZipWriter)
+    assert wd.called == deflated
+
+
+@pytest_twisted.ensureDeferred
+async def test_abandoned_offer():
+    # if sending fails while the directory scan is still running, the scan's
+    # own failure is swallowed rather than logged as unhandled
+    cfg = create_config()
+    cfg.relay_url = ""
+    sender = cmd_send.Sender(cfg, reactor)
+    offer_d = defer.Deferred()
+
+    def _go(w):
+        sender._pending_offer = offer_d
+        return defer.fail(WrongPasswordError())
+    with mock.patch.object(sender, "_go", _go), \
+         mock.patch("wormhole.cli.cmd_send.create") as create:
+        create.return_value.close.return_value = defer.succeed(None)
+        with pytest.raises(WrongPasswordError):
+            await sender.go()
+    offer_d.errback(OSError("scan failed"))
+    assert offer_d.result is None
+
+
+def test_walk_parallel(tmp_path):
+    for d in ["a/b/c", "a/empty", "d", "e/only-a-loop"]:
+        (tmp_path / d).mkdir(parents=True)
+    for f in ["top", "a/one", "a/b/two", "a/b/c/three", "d/four"]:
+        (tmp_path / f).write_bytes(b"x")
+    (tmp_path / "e/only-a-loop/up").symlink_to(tmp_path / "e")
+    (tmp_path / "d/link-to-b").symlink_to(tmp_path / "a/b")
+
+    def walked(**kwargs):
+        return [os.path.relpath(p, tmp_path).replace(os.sep, "/")
+                + ("/" if p.endswith(os.sep) else "")
+                for p in cmd_send.walk_parallel(str(tmp_path), **kwargs)]
+    # breadth-first, in name order. a/b is only visited once (not again as
+    # d/link-to-b, which comes later), and a directory holding nothing but
+    # a loop counts as empty
+    expected = [
+        "top", "a/one", "d/four", "a/b/two", "a/empty/", "e/only-a-loop/",
+        "a/b/c/three",
+    ]
+    assert walked() == expected
+    assert walked(workers=1) == expected
+
+
+def test_worth_deflating(tmp_path):
+    text = b"".join(b"line %d of some text\n" % i for i in range(20000))
+    (tmp_path / "text").write_bytes(text)
+    (tmp_path / "text.JPG").write_bytes(text)
+    (tmp_path / "random").write_bytes(os.urandom(200000))
+    (tmp_path / "empty").write_bytes(b"")
+
+    def worth(name, level=6):
+        return zipwriter.worth_deflating(str(tmp_path / name), level)
+    assert worth("text")
+    assert not worth("text", 0)
+    assert not worth("text.JPG")
+    assert not worth("random")
+    assert not worth("empty")
+
+
+@pytest.mark.parametrize("level", [0, 1, 6, 9])
+def test_zipwriter_levels(tmp_path, level):
+    files = {
+        "text": b"".join(b"line %d\n" % i for i in range(100000)),
+        "photo.jpg": b"pretend this is a JPEG " * 1000,
+        "random": os.urandom(100000),
+        "tiny": b"x",
+    }
+    entries = []
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+        entries.append((str(tmp_path / name), name))
+    (tmp_path / "empty").mkdir()
+    entries.append((str(tmp_path / "empty") + os.sep, "empty"))
+    zs = zipwriter.ZipWriter(level)
+    for path, arcname in entries:
+        zs.add_path(path, arcname)
+
+    zdata = b"".join(zs)
+    assert len(zdata) == len(zs)
+    assert sorted(x["size"] for x in zs.info_list()) == sorted(
+        [0] + [len(data) for data in files.values()])
+    with zipfile.ZipFile(io.BytesIO(zdata)) as zf:
+        for name, data in files.items():
+            assert zf.read(name) == data
+        types = {info.filename: info.compress_type for info in zf.infolist()}
+    deflated = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+    assert types == {"text": deflated,
+                     "photo.jpg": zipfile.ZIP_STORED,
+                     "random": zipfile.ZIP_STORED,
+                     "tiny": zipfile.ZIP_STORED,
+                     "empty/": zipfile.ZIP_STORED}
+
+
+def test_zipwriter_deflated_streamable(tmp_path):
+    # the local headers must carry the sizes, so the receiver can extract
+    # each entry as it arrives
+    fn = tmp_path / "text"
+    fn.write_bytes(b"text " * 100000)
+    zs = zipwriter.ZipWriter(6)
+    zs.add_path(str(fn), "text")
+    header = b"".join(zs)[:30]
+    flags, method = struct.unpack("<HH", header[6:10])
+    compress_size, file_size = struct.unpack("<II", header[18:26])
+    assert not flags & 0x08  # no data descriptor
+    assert method == zipfile.ZIP_DEFLATED
+    assert file_size == 500000
+    assert 0 < compress_size < file_size
+
+
+def test_zipwriter_deflated_changed(tmp_path):
+    # a file that changes after it was sized (but keeps its size) can't be
+    # sent with the header we already wrote
+    fn = tmp_path / "text"
+    fn.write_bytes(b"text " * 100000)
+    zs = zipwriter.ZipWriter(6)
+    zs.add_path(str(fn), "text")
+    fn.write_bytes(os.urandom(500000))
+    with pytest.raises(RuntimeError, match="changed while we were sending"):
+        b"".join(zs)
+
+
+def test_zipwriter_select(tmp_path):
+    entries = []
+    for name in ["a", "b", "c"]:
+        (tmp_path / name).write_bytes(name.encode("ascii") * 10000)
+        entries.append((str(tmp_path / name), name))
+    zs = zipwriter.ZipWriter(6)
+    with mock.patch.object(zipwriter, "worth_deflating",
+                           wraps=zipwriter.worth_deflating) as wd:
+        for path, arcname in entries:
+            zs.add_path(path, arcname)
+        some = zs.select(entries[::2])
+        assert wd.call_count == 3  # nothing is looked at again
+    zdata = b"".join(some)
+    assert len(zdata) == len(some)
+    with zipfile.ZipFile(io.BytesIO(zdata)) as zf:
+        assert zf.namelist() == ["a", "c"]
+        assert zf.read("c") == b"c" * 10000
+
+
+@pytest_twisted.ensureDeferred
+async def test_directory_simple(tmpdir_factory):
+    return await _do_test_directory(tmpdir_factory.mktemp("dir"), addslash=False)
 
 
-def test_directory_addslash_simple(tmpdir_factory):
-    return _do_test_directory(tmpdir_factory.mktemp("addslash"), addslash=True)
+@pytest_twisted.ensureDeferred
+async def test_directory_addslash_simple(tmpdir_factory):
+    return await _do_test_directory(tmpdir_factory.mktemp("addslash"), addslash=True)
 
 
-def test_unknown(request, tmpdir_factory):
+@pytest_twisted.ensureDeferred
+async def test_unknown(request, tmpdir_factory):
     cfg = create_config()
     cfg.what = filename = "unknown"
     send_dir = tmpdir_factory.mktemp("unknown")
@@ -200,12 +380,35 @@ def test_unknown(request, tmpdir_factory):
     assert not os.path.isdir(abs_filename)
 
     with pytest.raises(TypeError) as e:
-        build_offer(cfg)
+        await build_offer(cfg)
     assert str(e.value) == f"'{filename}' is neither file nor directory"
 
 
+def test_record_size():
+    choose = cmd_send.choose_record_size
+    # older receivers don't say anything, so they get what they always got
+    assert choose({"file_ack": "ok"}) == transit.DEFAULT_RECORD_SIZE
+    assert choose({"file_ack": "ok", "max-record-size": 2**16}) == 2**16
+    assert choose({"file_ack": "ok", "max-record-size": 2**30}) == \
+        transit.MAX_RECORD_SIZE
+    for bogus in [0, -1, "big", True, None, 1.5]:
+        assert choose({"file_ack": "ok", "max-record-size": bogus}) == \
+            transit.DEFAULT_RECORD_SIZE
+
+
+def test_resume_offset():
+    choose = cmd_send.choose_resume_offset
+    assert choose({"file_ack": "ok"}, 100) == 0
+    assert choose({"file_ack": "ok", "resume-from": 40}, 100) == 40
+    assert choose({"file_ack": "ok", "resume-from": 100}, 100) == 100
+    for bogus in [-1, 101, "40", True, None, 1.5]:
+        with pytest.raises(TransferError):
+            choose({"file_ack": "ok", "resume-from": bogus}, 100)
+
+
 @pytest.mark.skipif(not hasattr(os, 'symlink'), reason="host OS does not support symlinks")
-def test_symlink(tmpdir_factory):
+@pytest_twisted.ensureDeferred
+async def test_symlink(tmpdir_factory):
     # build A/B1 -> B2 (==A/B2), and A/B2/C.txt
     parent_dir = tmpdir_factory.mktemp("symlink_parent")
     os.mkdir(os.path.join(parent_dir, "B2"))
@@ -216,7 +419,7 @@ def test_symlink(tmpdir_factory):
     cfg = create_config()
     cfg.cwd = parent_dir
     cfg.what = os.path.join("B1", "C.txt")
-    d, fd_to_send = build_offer(cfg)
+    d, fd_to_send = await build_offer(cfg)
     assert d["file"]["filename"] == "C.txt"
     assert fd_to_send.read() == b"success"
 
@@ -230,7 +433,8 @@ def test_symlink(tmpdir_factory):
 # work (sometimes, but not in #251). See cmd_send.py for more notes.
 @pytest.mark.skipif(os.name == "nt", reason="host OS has broken os.path.realpath()")
 @pytest.mark.skipif(not hasattr(os, 'symlink'), reason="host OS does not support symlinks")
-def test_symlink_collapse(tmpdir_factory):
+@pytest_twisted.ensureDeferred
+async def test_symlink_collapse(tmpdir_factory):
     cfg = create_config()
     # build A/B1, A/B1/D.txt
     # A/B2/C2, A/B2/D.txt
@@ -259,7 +463,7 @@ def test_symlink_collapse(tmpdir_factory):
     # * D.txt: open A/B1/D.txt , which contains "fail"
     cfg.cwd = parent_dir
     cfg.what = os.path.join("B1", "C1", os.pardir, "D.txt")
-    d, fd_to_send = build_offer(cfg)
+    d, fd_to_send = await build_offer(cfg)
     assert d["file"]["filename"] == "D.txt"
     assert fd_to_send.read() == b"success"
 
@@ -426,7 +630,8 @@ async def _do_test(
         fake_tor=False,
         overwrite=False,
         mock_accept=False,
-        verify=False):
+        verify=False,
+        compress_level=0):
     assert mode in ("text", "file", "empty-file", "directory", "slow-text",
                     "slow-sender-text")
     if fake_tor:
@@ -498,6 +703,7 @@ async def _do_test(
         if addslash:
             send_dirname_arg += os.sep
         send_cfg.what = send_dirname_arg
+        send_cfg.compress_level = compress_level
         receive_dirname = send_dirname
 
         recv_cfg.accept_file = False if mock_accept else True
@@ -796,6 +1002,30 @@ async def test_directory_overwrite(wormhole_executable, scripts_env, mailbox, tr
     await _do_test(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory, mode="directory", overwrite=True)
 
 
+@pytest.mark.skipif(not tarzstd.available(), reason="needs zstandard")
+async def test_directory_tar_zstd(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory):
+    with mock.patch.object(tarzstd, "compressed_stream",
+                           wraps=tarzstd.compressed_stream) as cs:
+        await _do_test(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory, mode="directory", compress_level=6)
+    assert cs.called
+    assert cs.call_args[0][1] == tarzstd.zstd_level(6)
+
+
+async def test_directory_without_zstd(monkeypatch, wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory):
+    # like an older sender and receiver: they fall back to a zip file
+    monkeypatch.setattr(tarzstd, "zstandard", None)
+    with mock.patch.object(tarzstd, "compressed_stream") as cs:
+        await _do_test(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory, mode="directory", compress_level=6)
+    assert not cs.called
+
+
+async def test_directory_stored(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory):
+    # the default: a sized zip file, without asking for tar/zstd
+    with mock.patch.object(tarzstd, "compressed_stream") as cs:
+        await _do_test(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory, mode="directory", compress_level=0)
+    assert not cs.called
+
+
 async def test_slow_text(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory):
     await _do_test(wormhole_executable, scripts_env, mailbox, transit_relay, tmpdir_factory, mode="slow-text")
 
@@ -997,6 +1227,246 @@ async def test_text_ponies(mailbox):
     assert receive_stderr == ""
 
 
+async def _resume_transfer(mailbox, tmpdir_factory, data, tmp_data,
+                           received, sha256, mtime=None, changed=None):
+    # leave behind what an interrupted earlier attempt would have, then
+    # send the file for real (as 'changed', if given: it was modified since
+    # then, but its mtime was put back)
+    send_cfg = config("send")
+    recv_cfg = config("receive")
+    for cfg in [send_cfg, recv_cfg]:
+        cfg.hide_progress = True
+        cfg.relay_url = mailbox.url
+        cfg.transit_helper = ""
+        cfg.listen = True
+        cfg.zeromode = True
+        cfg.stdout = io.StringIO()
+        cfg.stderr = io.StringIO()
+
+    send_dir = tmpdir_factory.mktemp("sender")
+    receive_dir = tmpdir_factory.mktemp("receiver")
+    send_name = os.path.join(send_dir, "bigfile")
+    with open(send_name, "wb") as f:
+        f.write(data)
+    if mtime is None:
+        mtime = os.stat(send_name).st_mtime
+    send_cfg.what = "bigfile"
+    send_cfg.cwd = send_dir
+    recv_cfg.accept_file = True
+    recv_cfg.cwd = receive_dir
+
+    tmp_name = os.path.join(receive_dir, "bigfile.tmp")
+    with open(tmp_name, "wb") as f:
+        f.write(tmp_data)
+    resume_name = tmp_name + cmd_receive.RESUME_SUFFIX
+    checkpoint = {"filename": "bigfile", "filesize": len(data),
+                  "mtime": mtime, "received": received, "sha256": sha256}
+    with open(resume_name, "wb") as f:
+        f.write(dict_to_bytes(checkpoint))
+    if changed is not None:
+        st = os.stat(send_name)
+        with open(send_name, "wb") as f:
+            f.write(changed)
+        os.utime(send_name, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(recv_cfg)
+        with pytest.raises(TransferError, match="does not match"):
+            await receive_d
+        with pytest.raises(TransferError, match="bad remote hash"):
+            await send_d
+        assert not os.path.exists(os.path.join(receive_dir, "bigfile"))
+    else:
+        await gatherResults([cmd_send.send(send_cfg),
+                             cmd_receive.receive(recv_cfg)], True)
+        with open(os.path.join(receive_dir, "bigfile"), "rb") as f:
+            assert f.read() == data
+    assert not os.path.exists(tmp_name)
+    assert not os.path.exists(resume_name)
+    return send_cfg.stderr.getvalue(), recv_cfg.stderr.getvalue()
+
+
+@pytest_twisted.ensureDeferred
+async def test_file_resume(mailbox, tmpdir_factory):
+    data = os.urandom(100 * 1000)
+    partial = data[:40000]
+    send_stderr, receive_stderr = await _resume_transfer(
+        mailbox, tmpdir_factory, data, partial + b"junk past the checkpoint",
+        len(partial), hashlib.sha256(partial).hexdigest())
+    assert "Resuming after 40.0 kB already sent" in send_stderr
+    assert "Resuming after 40.0 kB already received" in receive_stderr
+
+
+@pytest_twisted.ensureDeferred
+async def test_file_resume_mismatch(mailbox, tmpdir_factory):
+    # the .tmp file doesn't match its checkpoint, so we start over
+    data = os.urandom(100 * 1000)
+    send_stderr, receive_stderr = await _resume_transfer(
+        mailbox, tmpdir_factory, data, b"x" * 40000,
+        40000, hashlib.sha256(data[:40000]).hexdigest())
+    assert "Resuming" not in send_stderr
+    assert "Resuming" not in receive_stderr
+
+
+@pytest_twisted.ensureDeferred
+async def test_file_resume_other_mtime(mailbox, tmpdir_factory):
+    # the checkpoint is from another version of the file (same name and
+    # size), so we start over
+    data = os.urandom(100 * 1000)
+    partial = data[:40000]
+    send_stderr, receive_stderr = await _resume_transfer(
+        mailbox, tmpdir_factory, data, partial, len(partial),
+        hashlib.sha256(partial).hexdigest(), mtime=12345.0)
+    assert "Resuming" not in send_stderr
+    assert "Resuming" not in receive_stderr
+
+
+@pytest_twisted.ensureDeferred
+async def test_file_resume_changed(mailbox, tmpdir_factory):
+    # the file changed without its mtime (or size) changing, so only the
+    # final hash shows that the resumed start is stale: the receiver throws
+    # it all away, rather than keeping it or resuming from it again
+    data = os.urandom(100 * 1000)
+    partial = data[:40000]
+    send_stderr, receive_stderr = await _resume_transfer(
+        mailbox, tmpdir_factory, data, partial, len(partial),
+        hashlib.sha256(partial).hexdigest(),
+        changed=os.urandom(len(data)))
+    assert "Resuming after 40.0 kB already sent" in send_stderr
+    assert "what we received has been discarded" in receive_stderr
+
+
+@pytest_twisted.ensureDeferred
+async def test_checkpoint_on_drop(tmpdir_factory):
+    args = mock.Mock()
+    args.relay_url = ""
+    args.hide_progress = True
+    args.progress_fd = None
+    args.stderr = io.StringIO()
+    args.timing = DebugTiming()
+    r = cmd_receive.Receiver(args)
+    r.abs_destname = os.path.join(tmpdir_factory.mktemp("receiver"), "f")
+    r.xfersize = 10
+    r._offered_filename = "f"
+    r._resume_name = r.abs_destname + ".tmp" + cmd_receive.RESUME_SUFFIX
+    r._resume_from = 2
+    r._prefix_hasher = hashlib.sha256(b"ab")
+
+    class DroppingPipe:
+        def describe(self):
+            return "fake"
+
+        def connectConsumer(self, consumer, expected):
+            assert expected == 8
+            consumer.registerProducer(mock.Mock(), True)
+            for data in [b"cd", b"ef"]:
+                consumer.write(data)
+            return defer.fail(ConnectionClosed())
+
+    with open(r.abs_destname + ".tmp", "wb") as f:
+        f.write(b"ab")
+        with pytest.raises(TransferError):
+            await r._transfer_data(DroppingPipe(), f)
+    with open(r._resume_name, "rb") as f:
+        checkpoint = bytes_to_dict(f.read())
+    assert checkpoint == {
+        "filename": "f", "filesize": 10, "mtime": None, "received": 6,
+        "sha256": hashlib.sha256(b"abcdef").hexdigest(),
+    }
+
+
+@pytest_twisted.ensureDeferred
+async def test_listen_port_closed(mailbox, tmpdir_factory):
+    # the --listen-port listener is closed once the transfer is done
+    send_cfg = config("send")
+    recv_cfg = config("receive")
+    for cfg in [send_cfg, recv_cfg]:
+        cfg.hide_progress = True
+        cfg.relay_url = mailbox.url
+        cfg.transit_helper = ""
+        cfg.listen = True
+        cfg.listen_port = transit.allocate_tcp_port()
+        cfg.zeromode = True
+        cfg.stdout = io.StringIO()
+        cfg.stderr = io.StringIO()
+    send_dir = tmpdir_factory.mktemp("sender")
+    receive_dir = tmpdir_factory.mktemp("receiver")
+    with open(os.path.join(send_dir, "testfile"), "wb") as f:
+        f.write(b"hello")
+    send_cfg.what = "testfile"
+    send_cfg.cwd = send_dir
+    recv_cfg.accept_file = True
+    recv_cfg.cwd = receive_dir
+    sender = cmd_send.Sender(send_cfg, reactor)
+    receiver = cmd_receive.Receiver(recv_cfg)
+
+    await gatherResults([sender.go(), receiver.go()], True)
+
+    with open(os.path.join(receive_dir, "testfile"), "rb") as f:
+        assert f.read() == b"hello"
+    assert sender._listener is None
+    assert receiver._listener is None
+    for cfg in [send_cfg, recv_cfg]:
+        # the port is free again
+        port = reactor.listenTCP(cfg.listen_port, protocol.Factory())
+        await port.stopListening()
+
+
+class Killed(Exception):
+    pass
+
+
+@pytest_twisted.ensureDeferred
+async def test_resume_after_kill(mailbox, tmpdir_factory):
+    # the receiver dies partway through (so only the periodic checkpoints
+    # get written, not the one for a dropped connection), then the transfer
+    # is tried again and must pick up from the last checkpoint
+    data = os.urandom(100 * 1000)
+    args = mock.Mock()
+    args.relay_url = ""
+    args.hide_progress = True
+    args.progress_fd = None
+    args.stderr = io.StringIO()
+    args.timing = DebugTiming()
+    r = cmd_receive.Receiver(args)
+    r.abs_destname = os.path.join(tmpdir_factory.mktemp("killed"), "bigfile")
+    r.xfersize = len(data)
+    r._offered_filename = "bigfile"
+    r._resume_name = r.abs_destname + ".tmp" + cmd_receive.RESUME_SUFFIX
+
+    class KilledPipe:
+        def describe(self):
+            return "fake"
+
+        def connectConsumer(self, consumer, expected):
+            consumer.registerProducer(mock.Mock(), True)
+            for i in range(0, 50000, 10000):
+                consumer.write(data[i:i + 10000])
+            # die once the writer thread has caught up
+            d = defer.Deferred()
+            consumer.call_in_writer(reactor.callFromThread, d.errback,
+                                    Killed())
+            return d
+
+    with mock.patch("wormhole.cli.cmd_receive.CHECKPOINT_INTERVAL", 15000):
+        with open(r.abs_destname + ".tmp", "wb") as f:
+            with pytest.raises(Killed):
+                await r._transfer_data(KilledPipe(), f)
+    with open(r.abs_destname + ".tmp", "rb") as f:
+        tmp_data = f.read()
+    with open(r._resume_name, "rb") as f:
+        checkpoint = bytes_to_dict(f.read())
+    assert checkpoint["received"] == 40000
+    assert tmp_data == data[:50000]
+    assert checkpoint["sha256"] == hashlib.sha256(data[:40000]).hexdigest()
+
+    send_stderr, receive_stderr = await _resume_transfer(
+        mailbox, tmpdir_factory, data, tmp_data,
+        checkpoint["received"], checkpoint["sha256"])
+    assert "Resuming after 40.0 kB already sent" in send_stderr
+    assert "Resuming after 40.0 kB already received" in receive_stderr
+
+
 @pytest.fixture(scope="module")
 def unwelcome_mailbox(reactor):
     mailbox = pytest_twisted.blockon(
@@ -1159,6 +1629,176 @@ async def test_text_wrong_password(mailbox):
     assert len(cids) == 0
 
 
+@pytest.mark.parametrize("level", [0, 6])
+@pytest.mark.parametrize("zstd", [False, True])
+@pytest_twisted.ensureDeferred
+async def test_sync_directory(mailbox, tmp_path, monkeypatch, zstd, level):
+    if not zstd:
+        monkeypatch.setattr(tarzstd, "zstandard", None)
+    elif not tarzstd.available():
+        pytest.skip("needs zstandard")
+    src = tmp_path / "src" / "d"
+    dest = tmp_path / "dest" / "d"
+    for d in [src / "sub", dest / "sub", dest / "old-dir"]:
+        d.mkdir(parents=True)
+    for top in [src, dest]:
+        (top / "same").write_bytes(b"same" * 1000)
+        (top / "sub" / "same").write_bytes(b"x")
+    (src / "changed").write_bytes(b"new!")
+    (dest / "changed").write_bytes(b"old!")
+    (src / "new").write_bytes(b"new" * 1000)
+    (dest / "gone").write_bytes(b"gone")
+    (dest / "old-dir" / "gone").write_bytes(b"gone")
+    (dest / "link").symlink_to(src / "new")
+
+    send_cfg = create_named_config("send", mailbox.url)
+    send_cfg.what = "d"
+    send_cfg.cwd = str(src.parent)
+    send_cfg.compress_level = level
+    recv_cfg = create_named_config("receive", mailbox.url)
+    recv_cfg.cwd = str(dest.parent)
+    recv_cfg.accept_file = True
+    recv_cfg.sync = True
+    send_cfg.code = recv_cfg.code = "1-sync-test"
+    with mock.patch("sys.stdout"):
+        await gatherResults([cmd_send.send(send_cfg),
+                             cmd_receive.receive(recv_cfg)])
+
+    assert sorted(os.listdir(dest)) == ["changed", "new", "same", "sub"]
+    assert (dest / "changed").read_bytes() == b"new!"
+    assert (dest / "new").read_bytes() == b"new" * 1000
+    assert (dest / "sub" / "same").read_bytes() == b"x"
+    assert ("Receiver already has 2 of the files: sending 2 new or "
+            "changed, deleting 3") in send_cfg.stderr.getvalue()
+    assert "Updating existing directory 'd'" in recv_cfg.stderr.getvalue()
+
+
+def test_receive_existing_directory(tmp_path):
+    (tmp_path / "d").mkdir()
+    args = mock.Mock()
+    args.relay_url = ""
+    args.output_file = None
+    args.cwd = str(tmp_path)
+    args.stderr = io.StringIO()
+    offer = {"mode": "zipfile/deflated", "dirname": "d", "zipsize": 22,
+             "numbytes": 0, "numfiles": 0, "sync": True}
+    # without --sync (or from a sender that can't), we don't touch it
+    for sync, sender_sync in [(False, True), (True, False)]:
+        args.sync = sync
+        offer["sync"] = sender_sync
+        r = cmd_receive.Receiver(args)
+        with pytest.raises(cmd_receive.TransferRejectedError):
+            r._handle_directory({"directory": offer})
+        assert "refusing to overwrite" in args.stderr.getvalue()
+
+
+@pytest.mark.parametrize("streamable", [False, True])
+def test_receive_directory(tmp_path, streamable):
+    args = mock.Mock()
+    args.relay_url = ""
+    args.output_file = None
+    args.accept_file = True
+    args.cwd = str(tmp_path)
+    args.stderr = io.StringIO()
+    args.timing = DebugTiming()
+    r = cmd_receive.Receiver(args)
+    zdata = io.BytesIO()
+    with zipfile.ZipFile(zdata, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("sub/a", b"contents")
+    offer = {"mode": "zipfile/deflated", "dirname": "d",
+             "zipsize": len(zdata.getvalue()), "numbytes": 8, "numfiles": 1}
+    if streamable:
+        offer["streamable"] = True
+    f = r._handle_directory({"directory": offer})
+    assert isinstance(f, cmd_receive.StreamingUnzipper) == streamable
+    f.write(zdata.getvalue())
+    [staging] = [p for p in tmp_path.iterdir()]
+    assert staging.name.startswith(".d.")
+    if streamable:
+        # the file is extracted before the transfer has finished, but not
+        # where the user will look for it
+        assert (staging / "sub" / "a").read_bytes() == b"contents"
+    r._write_directory(f)
+    assert [p.name for p in tmp_path.iterdir()] == ["d"]
+    assert (tmp_path / "d" / "sub" / "a").read_bytes() == b"contents"
+    assert ("Unpacking zipfile" in args.stderr.getvalue()) != streamable
+
+
+def test_receive_directory_failed(tmp_path):
+    # a transfer that fails partway leaves nothing behind
+    args = mock.Mock()
+    args.relay_url = ""
+    args.output_file = None
+    args.accept_file = True
+    args.cwd = str(tmp_path)
+    args.stderr = io.StringIO()
+    args.timing = DebugTiming()
+    r = cmd_receive.Receiver(args)
+    zdata = io.BytesIO()
+    with zipfile.ZipFile(zdata, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr("a", b"first")
+        zf.writestr("b", b"second" * 1000)
+    offer = {"mode": "zipfile/deflated", "dirname": "d", "streamable": True,
+             "zipsize": len(zdata.getvalue()), "numbytes": 6005,
+             "numfiles": 2}
+    f = r._handle_directory({"directory": offer})
+    f.write(zdata.getvalue()[:len(zdata.getvalue()) // 2])
+    r._discard_staging_dir(f)
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("complete", [False, True, "install-fails"])
+def test_receive_sync_staged(tmp_path, complete):
+    # with --sync, nothing in the existing directory is replaced until all
+    # the data has arrived, or deleted until after that (and the ack)
+    (tmp_path / "d").mkdir()
+    (tmp_path / "d" / "a").write_bytes(b"old")
+    (tmp_path / "d" / "gone").write_bytes(b"old")
+    args = mock.Mock()
+    args.relay_url = ""
+    args.output_file = None
+    args.accept_file = True
+    args.sync = True
+    args.cwd = str(tmp_path)
+    args.stderr = io.StringIO()
+    args.timing = DebugTiming()
+    r = cmd_receive.Receiver(args)
+    zdata = io.BytesIO()
+    with zipfile.ZipFile(zdata, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr("a", b"new" * 1000)
+    offer = {"mode": "zipfile/deflated", "dirname": "d", "streamable": True,
+             "zipsize": 0, "numbytes": 3003, "numfiles": 2, "sync": True}
+    f = r._handle_directory({"directory": offer})
+    r._manifest = [["a", 3, None], ["gone", 3, None]]
+    rp = mock.Mock()
+    # (we never delete what isn't in our own manifest)
+    rp.receive_record.return_value = defer.succeed(dict_to_bytes(
+        {"delete": ["gone", "../elsewhere"], "numbytes": 3000,
+         "zipsize": len(zdata.getvalue())}))
+    r._receive_sync_plan(rp)
+    assert r.xfersize == len(zdata.getvalue())
+
+    if complete == "install-fails":
+        f.write(zdata.getvalue())
+        with mock.patch.object(cmd_receive.sync, "install",
+                               side_effect=OSError("disk on fire")):
+            with pytest.raises(OSError):
+                r._write_directory(f)
+        r._discard_staging_dir(f)
+        assert (tmp_path / "d" / "a").read_bytes() == b"old"
+    elif complete:
+        f.write(zdata.getvalue())
+        r._write_directory(f)
+        assert (tmp_path / "d" / "a").read_bytes() == b"new" * 1000
+        assert r._stale == ["gone"]
+    else:
+        f.write(zdata.getvalue()[:len(zdata.getvalue()) // 2])
+        r._discard_staging_dir(f)
+        assert (tmp_path / "d" / "a").read_bytes() == b"old"
+    assert (tmp_path / "d" / "gone").read_bytes() == b"old"
+    assert [p.name for p in tmp_path.iterdir()] == ["d"]
+
+
 def test_filenames(tmpdir_factory):
     args = mock.Mock()
     args.relay_url = ""
@@ -1,9 +1,12 @@
 import errno
 import os
 import re
+import socket
 import subprocess
 from unittest import mock
 
+import pytest
+
 from .. import ipaddrs
 
 DOTTED_QUAD_RE = re.compile(r"^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$")
@@ -96,6 +99,13 @@ class FakeProcess:
         return (self.output, self.err)
 
 
+@pytest.fixture(autouse=True)
+def no_cache():
+    ipaddrs._cache.clear()
+    yield
+    ipaddrs._cache.clear()
+
+
 def test_list():
     addresses = ipaddrs.find_addresses()
     assert "127.0.0.1" in addresses
@@ -141,8 +151,9 @@ def _test_list_mock(command, output, expected):
     patch_popen = mock.patch.object(subprocess, 'Popen', call_Popen)
     patch_isfile = mock.patch.object(os.path, 'isfile', lambda x: True)
     patch_which = mock.patch.object(ipaddrs, 'which', call_which)
+    patch_native = mock.patch.object(ipaddrs, '_getifaddrs', lambda: None)
 
-    with patch_popen, patch_isfile, patch_which:
+    with patch_popen, patch_isfile, patch_which, patch_native:
         addresses = ipaddrs.find_addresses()
 
     assert set(addresses) == set(expected)
@@ -164,3 +175,50 @@ def test_list_mock_route():
 def test_list_mock_cygwin():
     with mock.patch.object(ipaddrs, 'platform', "cygwin"):
         _test_list_mock(None, None, CYGWIN_TEST_ADDRESSES)
+
+
+FOUND = [(socket.AF_INET, "127.0.0.1"), (socket.AF_INET6, "::1"),
+         (socket.AF_INET, "192.168.0.6"), (socket.AF_INET6, "fe80::1"),
+         (socket.AF_INET6, "2001:db8::6")]
+
+
+def test_native():
+    found = ipaddrs._getifaddrs()
+    if found is None:
+        pytest.skip("getifaddrs() is not available here")
+    assert (socket.AF_INET, "127.0.0.1") in found
+    for family, addr in found:
+        # these round-trip iff they're well-formed
+        assert socket.inet_ntop(family, socket.inet_pton(family, addr)) == \
+            addr
+
+
+def test_ipv6():
+    with mock.patch.object(ipaddrs, '_getifaddrs', lambda: FOUND):
+        assert ipaddrs.find_addresses() == ["127.0.0.1", "192.168.0.6"]
+        assert ipaddrs.find_addresses(ipv6=True) == \
+            ["127.0.0.1", "192.168.0.6", "::1", "2001:db8::6"]
+
+
+def test_nothing_found():
+    with mock.patch.object(ipaddrs, '_getifaddrs', lambda: []), \
+         mock.patch.object(ipaddrs, '_find_addresses_by_tool', lambda: []):
+        assert ipaddrs.find_addresses() == ["127.0.0.1"]
+
+
+def test_cache():
+    calls = []
+    now = [100.0]
+
+    def getifaddrs():
+        calls.append(now[0])
+        return FOUND
+
+    with mock.patch.object(ipaddrs, '_getifaddrs', getifaddrs), \
+         mock.patch.object(ipaddrs, '_clock', lambda: now[0]):
+        ipaddrs.find_addresses()
+        ipaddrs.find_addresses(ipv6=True)
+        assert calls == [100.0]
+        now[0] += ipaddrs.CACHE_TTL
+        ipaddrs.find_addresses()
+        assert calls == [100.0, 100.0 + ipaddrs.CACHE_TTL]
@@ -0,0 +1,126 @@
+from twisted.internet import defer, protocol
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import MemoryReactorClock, StringTransport
+
+from .. import listener
+
+
+class Recorder(protocol.Protocol):
+    def __init__(self):
+        self.received = b""
+        self.lost = False
+
+    def dataReceived(self, data):
+        self.received += data
+
+    def connectionLost(self, reason=None):
+        self.lost = True
+
+
+def make_listener():
+    reactor = MemoryReactorClock()
+    sl = listener.SharedListener(reactor, port=1234)
+    return sl, reactor
+
+
+def inbound(reactor):
+    factory = reactor.tcpServers[0][1]
+    addr = IPv4Address("TCP", "10.0.0.1", 5678)
+    r = factory.buildProtocol(addr)
+    t = StringTransport(peerAddress=addr)
+    r.makeConnection(t)
+    return r, t
+
+
+def test_start():
+    sl, reactor = make_listener()
+    assert sl.start() == 1234
+    assert sl.start() == 1234
+    assert len(reactor.tcpServers) == 1
+    assert reactor.tcpServers[0][0] == 1234
+
+
+def test_route():
+    sl, reactor = make_listener()
+    f1 = protocol.Factory.forProtocol(Recorder)
+    f2 = protocol.Factory.forProtocol(Recorder)
+    lp1 = sl.endpoint(b"hello one\n").listen(f1).result
+    sl.endpoint(b"hello two\n").listen(f2)
+    assert lp1.getHost().port == 1234
+
+    r, t = inbound(reactor)
+    r.dataReceived(b"hello t")
+    assert r._inner is None
+    assert t.connected
+    r.dataReceived(b"wo\nmore")
+    p = r._inner
+    assert isinstance(p, Recorder)
+    assert p.factory is f2
+    assert p.transport is t
+    assert p.received == b"hello two\nmore"
+    r.dataReceived(b" data")
+    assert p.received == b"hello two\nmore data"
+    assert not sl._unrouted
+    # once routed, the connection is no longer subject to the routing timeout
+    assert not reactor.getDelayedCalls()
+    r.connectionLost()
+    assert p.lost
+
+
+def test_unwanted():
+    sl, reactor = make_listener()
+    sl.endpoint(b"hello\n").listen(protocol.Factory.forProtocol(Recorder))
+    r, t = inbound(reactor)
+    r.dataReceived(b"GET / HTTP/1.1\r\n")
+    assert t.disconnecting
+
+
+def test_timeout():
+    sl, reactor = make_listener()
+    sl.endpoint(b"hello\n").listen(protocol.Factory.forProtocol(Recorder))
+    r, t = inbound(reactor)
+    r.dataReceived(b"hel")
+    reactor.advance(listener.ROUTING_TIMEOUT)
+    assert t.disconnecting
+    r.connectionLost()
+    assert not sl._unrouted
+
+
+def test_prefix_not_known_yet():
+    # the connection can arrive before we know what it will say
+    sl, reactor = make_listener()
+    prefix_d = defer.Deferred()
+    sl.endpoint(prefix_d).listen(protocol.Factory.forProtocol(Recorder))
+    r, t = inbound(reactor)
+    r.dataReceived(b"hello\nrecords")
+    assert r._inner is None
+    assert not t.disconnecting
+    prefix_d.callback(b"hello\n")
+    assert r._inner.received == b"hello\nrecords"
+
+
+def test_stop_routing():
+    sl, reactor = make_listener()
+    lp = sl.endpoint(b"hello\n").listen(
+        protocol.Factory.forProtocol(Recorder)).result
+    r, t = inbound(reactor)
+    r.dataReceived(b"hel")
+    lp.stopListening()
+    # nobody else is going to want it
+    assert t.disconnecting
+
+    # the port itself stays open for the next user
+    assert sl._port
+    sl.endpoint(b"hello\n").listen(protocol.Factory.forProtocol(Recorder))
+    r, t = inbound(reactor)
+    r.dataReceived(b"hello\n")
+    assert r._inner
+
+
+def test_stop_listening():
+    sl, reactor = make_listener()
+    sl.start()
+    r, t = inbound(reactor)
+    sl.stopListening()
+    assert t.disconnecting
+    assert sl._port is None
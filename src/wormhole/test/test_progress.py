@@ -0,0 +1,83 @@
+import io
+import json
+import os
+
+from twisted.internet import task
+from unittest import mock
+import pytest
+
+from ..cli import progress
+
+
+def lines(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_rate_limited():
+    clock = task.Clock()
+    bar = mock.MagicMock()
+    stream = io.StringIO()
+    with progress.Progress(clock, bar, stream, total=100, initial=10) as p:
+        bar.__enter__.assert_called_once_with()
+        for i in range(5):
+            p.update(4)
+        assert bar.update.mock_calls == []
+        clock.advance(progress.PROGRESS_INTERVAL)
+        assert bar.update.mock_calls == [mock.call(20)]
+        # nothing new, so nothing to report
+        clock.advance(progress.PROGRESS_INTERVAL)
+        assert bar.update.mock_calls == [mock.call(20)]
+        p.update(70)
+    assert bar.update.mock_calls == [mock.call(20), mock.call(70)]
+    bar.__exit__.assert_called_once_with(None, None, None)
+    assert not clock.getDelayedCalls()
+    assert lines(stream) == [
+        {"event": "start", "bytes": 10, "total": 100, "elapsed": 0.0},
+        {"event": "progress", "bytes": 30, "total": 100, "elapsed": 0.1},
+        {"event": "progress", "bytes": 100, "total": 100, "elapsed": 0.2},
+        {"event": "done", "bytes": 100, "total": 100, "elapsed": 0.2,
+         "ok": True},
+    ]
+
+
+def test_short():
+    clock = task.Clock()
+    stream = io.StringIO()
+    with progress.Progress(clock, mock.MagicMock(), stream, total=100) as p:
+        p.update(40)
+    assert lines(stream)[-1]["ok"] is False
+
+
+def test_failed():
+    clock = task.Clock()
+    bar = mock.MagicMock()
+    stream = io.StringIO()
+    with pytest.raises(ValueError):
+        with progress.Progress(clock, bar, stream, total=100) as p:
+            p.update(100)
+            raise ValueError()
+    assert lines(stream)[-1] == {"event": "done", "bytes": 100,
+                                 "total": 100, "elapsed": 0.0, "ok": False}
+    assert bar.update.mock_calls == [mock.call(100)]
+
+
+def test_no_stream():
+    clock = task.Clock()
+    bar = mock.MagicMock()
+    with progress.Progress(clock, bar) as p:
+        p.update(1)
+        clock.advance(progress.PROGRESS_INTERVAL)
+    assert bar.update.mock_calls == [mock.call(1)]
+
+
+def test_open_progress_stream():
+    assert progress.open_progress_stream(None) is None
+    r, w = os.pipe()
+    stream = progress.open_progress_stream(w)
+    stream.write("{}\n")
+    # line-buffered, and it leaves the fd open
+    assert os.read(r, 10) == b"{}\n"
+    stream.close()
+    os.write(w, b"x")
+    os.close(w)
+    os.close(r)
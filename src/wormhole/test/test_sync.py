@@ -0,0 +1,158 @@
+import hashlib
+import os
+
+import pytest
+
+from ..cli import sync
+from ..errors import TransferError
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_build_manifest(tmp_path):
+    (tmp_path / "sub" / "empty").mkdir(parents=True)
+    (tmp_path / "a").write_bytes(b"aaa")
+    (tmp_path / "sub" / "b").write_bytes(b"")
+    (tmp_path / "link").symlink_to(tmp_path / "a")
+    (tmp_path / "dirlink").symlink_to(tmp_path / "sub")
+    manifest = sync.build_manifest(str(tmp_path), workers=2)
+    assert sorted(manifest) == [
+        ["a", 3, sha256(b"aaa")],
+        ["dirlink", -1, None],
+        ["link", -1, None],
+        ["sub/b", 0, sha256(b"")],
+    ]
+
+
+def test_plan(tmp_path):
+    files = {"same": b"same", "sub/same": b"x", "changed": b"new!",
+             "longer": b"longer now", "new": b"new"}
+    entries = []
+    for name, data in files.items():
+        fn = tmp_path / name
+        fn.parent.mkdir(exist_ok=True)
+        fn.write_bytes(data)
+        entries.append((str(fn), name.replace("/", os.sep)))
+    (tmp_path / "empty").mkdir()
+    entries.append((str(tmp_path / "empty") + os.sep, "empty"))
+    manifest = [
+        ["same", 4, sha256(b"same")],
+        ["sub/same", 1, sha256(b"x")],
+        ["changed", 4, sha256(b"old!")],
+        ["longer", 6, sha256(b"longer")],
+        ["gone", 4, sha256(b"gone")],
+        ["new", -1, None],  # a symlink, say
+    ]
+    changed, stale, unchanged = sync.plan(entries, manifest)
+    assert sorted(arcname for _, arcname in changed) == [
+        "changed", "empty", "longer", "new"]
+    # the files we're replacing aren't stale: the receiver keeps them
+    # until it has their new copies
+    assert stale == ["gone"]
+    assert unchanged == 2
+    assert sync.total_size(changed) == 4 + 10 + 3
+
+
+@pytest.mark.parametrize("manifest", [
+    {"a": 1},
+    [["a", 1]],
+    [["a", "1", None]],
+    [[1, 1, None]],
+])
+def test_bad_manifest(manifest):
+    with pytest.raises(TransferError):
+        sync.plan([], manifest)
+
+
+def test_install(tmp_path):
+    root = tmp_path / "root"
+    (root / "sub").mkdir(parents=True)
+    (root / "keep").write_bytes(b"keep")
+    (root / "changed").write_bytes(b"old")
+    (root / "sub" / "changed").write_bytes(b"old")
+    (root / "was-file").write_bytes(b"old")  # now a directory
+    (root / "was-dir" / "deeper").mkdir(parents=True)  # now a file
+    (root / "was-dir" / "deeper" / "gone").write_bytes(b"old")
+    (root / "was-link").symlink_to(tmp_path)  # now a directory
+    staging = tmp_path / "staging"
+    (staging / "sub").mkdir(parents=True)
+    (staging / "changed").write_bytes(b"new")
+    (staging / "sub" / "changed").write_bytes(b"new")
+    (staging / "empty").mkdir()
+    (staging / "was-file").mkdir()
+    (staging / "was-file" / "new").write_bytes(b"new")
+    (staging / "was-dir").write_bytes(b"new")
+    (staging / "was-link").mkdir()
+    (staging / "was-link" / "new").write_bytes(b"new")
+
+    installed = sync.install(str(staging), str(root),
+                             ["was-dir/deeper/gone"])
+    assert installed == {"changed", "sub/changed", "was-file/new",
+                         "was-dir", "was-link/new"}
+    assert not staging.exists()
+    assert sorted(os.listdir(root)) == [
+        "changed", "empty", "keep", "sub", "was-dir", "was-file", "was-link"]
+    assert (root / "keep").read_bytes() == b"keep"
+    for name in installed:
+        assert (root / name).read_bytes() == b"new"
+    assert not (root / "was-link").is_symlink()
+    assert not (tmp_path / "new").exists()
+
+
+def test_remove_stale(tmp_path):
+    root = tmp_path / "root"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "keep").mkdir()
+    (root / "a" / "b" / "gone").write_bytes(b"")
+    (root / "a" / "gone").write_bytes(b"")
+    (root / "gone").write_bytes(b"")
+    (root / "link").symlink_to(root / "keep")
+    sync.remove_stale(str(root), ["a/b/gone", "a/gone", "gone", "link",
+                                  "already-gone"])
+    # directories that were emptied go too, but not ones that already were
+    assert os.listdir(root) == ["keep"]
+    with pytest.raises(ValueError, match="malicious"):
+        sync.remove_stale(str(root), ["../root-plus/haha"])
+
+
+def test_remove_stale_symlinked_dir(tmp_path):
+    # a name that goes through a symlink to somewhere outside 'root' is
+    # refused, rather than followed
+    root = tmp_path / "root"
+    root.mkdir()
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "victim").write_bytes(b"precious")
+    (root / "link").symlink_to(outside)
+    with pytest.raises(ValueError, match="malicious"):
+        sync.remove_stale(str(root), ["link/victim"])
+    assert (outside / "victim").read_bytes() == b"precious"
+    # a symlink to a directory is itself a file we may delete, though
+    sync.remove_stale(str(root), ["link"])
+    assert os.listdir(root) == []
+    assert (outside / "victim").exists()
+
+
+def test_parse_plan():
+    manifest = [["a", 1, sha256(b"a")], ["sub/b", 1, sha256(b"b")]]
+    plan = {"delete": ["a", "sub/b", "not-ours", "../../etc/passwd"],
+            "numbytes": 10, "zipsize": 22}
+    assert sync.parse_plan(plan, manifest) == (["a", "sub/b"], 10, 22)
+    del plan["zipsize"]
+    assert sync.parse_plan(plan, manifest) == (["a", "sub/b"], 10, None)
+
+
+@pytest.mark.parametrize("plan", [
+    [],
+    {"numbytes": 1},
+    {"delete": "a", "numbytes": 1},
+    {"delete": [1], "numbytes": 1},
+    {"delete": [], "numbytes": "1"},
+    {"delete": [], "numbytes": True},
+    {"delete": [], "numbytes": 1, "zipsize": None},
+])
+def test_bad_plan(plan):
+    with pytest.raises(TransferError):
+        sync.parse_plan(plan, [])
@@ -0,0 +1,161 @@
+import io
+import os
+import stat
+import tarfile
+
+import pytest
+
+from ..cli import tarzstd
+
+zstandard = pytest.importorskip("zstandard")
+
+FILES = {
+    "top": b"top file\n",
+    "sub/a": b"hello" * 1000,
+    "sub/empty-file": b"",
+    "sub/random": os.urandom(100000),
+    # long enough to need a pax header
+    "sub/" + "long-name-" * 20: b"long",
+    "sub/\N{SNOWMAN}": b"unicode",
+}
+
+
+@pytest.fixture
+def entries(tmp_path):
+    src = tmp_path / "src"
+    entries = []
+    for name, data in FILES.items():
+        fn = src / name
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        fn.write_bytes(data)
+        entries.append((str(fn), name))
+    (src / "sub" / "empty-dir").mkdir()
+    entries.append((str(src / "sub" / "empty-dir") + os.sep, "sub/empty-dir"))
+    os.chmod(src / "top", 0o751)
+    return entries
+
+
+def extract(data, dest, chunk_size):
+    u = tarzstd.StreamingUntarrer(str(dest))
+    for i in range(0, len(data), chunk_size):
+        u.write(data[i:i + chunk_size])
+    u.close()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 1000, 2**20])
+def test_roundtrip(entries, tmp_path, chunk_size):
+    data = b"".join(tarzstd.compressed_stream(entries))
+    dest = tmp_path / "dest"
+    extract(data, dest, chunk_size)
+    for name, contents in FILES.items():
+        assert (dest / name).read_bytes() == contents
+    assert (dest / "sub" / "empty-dir").is_dir()
+    assert stat.S_IMODE(os.stat(dest / "top").st_mode) == 0o751
+
+
+def test_tar_stream(entries):
+    # what we send is an ordinary tar file
+    data = b"".join(tarzstd.tar_stream(entries))
+    with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+        assert tf.getnames() == list(FILES) + ["sub/empty-dir"]
+        assert tf.extractfile("sub/a").read() == FILES["sub/a"]
+
+
+def test_changed(tmp_path):
+    fn = tmp_path / "f"
+    fn.write_bytes(b"data")
+    stream = tarzstd.tar_stream([(str(fn), "f")])
+    next(stream)  # the header
+    fn.write_bytes(b"more data")
+    with pytest.raises(RuntimeError, match="changed while"):
+        list(stream)
+
+
+def test_zstd_level():
+    levels = [tarzstd.zstd_level(n) for n in range(1, 10)]
+    assert levels == sorted(levels)
+    assert tarzstd.zstd_level(6) == tarzstd.ZSTD_LEVEL
+    assert levels[0] >= 1
+    assert levels[-1] <= zstandard.MAX_COMPRESSION_LEVEL
+
+
+@pytest.mark.parametrize("checksum", [False, True])
+@pytest.mark.parametrize("chunk_size", [1, 7, 2**20])
+def test_frame_scanner(checksum, chunk_size):
+    # RLE blocks, raw blocks, and compressed ones
+    data = b"\0" * 300000 + os.urandom(200000) + b"abc" * 100000
+    params = zstandard.ZstdCompressionParameters.from_level(
+        3, write_checksum=checksum)
+    frame = zstandard.ZstdCompressor(compression_params=params).compress(data)
+    s = tarzstd.ZstdFrameScanner()
+    for i in range(0, len(frame), chunk_size):
+        assert not s.finished
+        finished = s.feed(frame[i:i + chunk_size])
+    assert finished
+    s = tarzstd.ZstdFrameScanner()
+    assert not s.feed(frame[:-1])
+    with pytest.raises(ValueError, match="not a zstd frame"):
+        tarzstd.ZstdFrameScanner().feed(b"PK\x03\x04\x00")
+
+
+def test_frame_end_consumer():
+    written = []
+
+    class Consumer:
+        def write(self, data):
+            written.append(data)
+    frame = zstandard.ZstdCompressor().compress(b"data")
+    fc = tarzstd.FrameEndConsumer(Consumer())
+    fc.write(frame[:3])
+    assert not fc.ended.called
+    fc.write(frame[3:])
+    assert fc.ended.result is True
+    fc.write(b"more")
+    fc.lost()
+    assert written == [frame[:3], frame[3:]]
+
+    fc = tarzstd.FrameEndConsumer(Consumer())
+    fc.write(frame[:3])
+    fc.lost()
+    assert fc.ended.result is False
+
+
+def tar_zstd(add):
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w") as tf:
+        add(tf)
+    return zstandard.ZstdCompressor().compress(f.getvalue())
+
+
+def test_ended_early(entries, tmp_path):
+    data = b"".join(tarzstd.compressed_stream(entries))
+    u = tarzstd.StreamingUntarrer(str(tmp_path / "dest"))
+    u.write(data[:len(data) // 2])
+    with pytest.raises(tarfile.ReadError, match="ended early"):
+        u.close()
+
+
+def test_symlink(tmp_path):
+    def add(tf):
+        info = tarfile.TarInfo("link")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "/etc/passwd"
+        tf.addfile(info)
+    with pytest.raises(tarfile.ReadError, match="not a regular file"):
+        extract(tar_zstd(add), tmp_path / "dest", 1000)
+    assert not os.path.lexists(tmp_path / "dest" / "link")
+
+
+@pytest.mark.parametrize("name", [
+    "/etc/passwd",
+    "../haha",
+    "../dest-plus-hyphen/haha",
+])
+def test_malicious(tmp_path, name):
+    def add(tf):
+        info = tarfile.TarInfo(name)
+        info.size = 4
+        tf.addfile(info, io.BytesIO(b"evil"))
+    with pytest.raises(ValueError, match="malicious"):
+        extract(tar_zstd(add), tmp_path / "dest", 1000)
+    assert os.listdir(tmp_path) == []
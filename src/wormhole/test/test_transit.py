@@ -1,20 +1,30 @@
 import io
+import os
+import threading
 from binascii import hexlify, unhexlify
 
 from nacl.exceptions import CryptoError
 from nacl.secret import SecretBox
-from twisted.internet import address, defer, endpoints, error, protocol, task
+from twisted.internet import (address, defer, endpoints, error, interfaces,
+                              protocol, reactor, task)
 from twisted.internet.defer import gatherResults
+from twisted.protocols.basic import FileSender
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 from twisted.test import proto_helpers
 
 from unittest import mock
+from zope.interface import implementer
 from wormhole_transit_relay import transit_server
 from pytest_twisted import ensureDeferred
 
 from .. import transit
 from .._hints import DirectTCPV1Hint
 from ..errors import InternalError
+from ..listener import SharedEndpoint, SharedListener
+from ..timing import DebugTiming
 from ..util import HKDF
+from .common import poll_until
 import pytest
 
 
@@ -315,6 +325,370 @@ def test_connection_ready():
     assert r.connection_ready("p2") == "wait-for-decision"
 
 
+def test_abilities_probe():
+    s = transit.TransitSender("", no_listen=True)
+    assert {"type": "probe-v1"} not in s.get_connection_abilities()
+    r = transit.TransitReceiver("", no_listen=True)
+    assert {"type": "probe-v1"} in r.get_connection_abilities()
+
+    # without a window, or a receiver who can answer probes, the first
+    # connection still wins
+    s = transit.TransitSender("", select_window=1.0)
+    assert s.connection_ready("p1") == "go"
+    s = transit.TransitSender("")
+    s.add_connection_abilities(r.get_connection_abilities())
+    assert s.connection_ready("p1") == "go"
+
+
+class FakeCandidate:
+    def __init__(self, description, relay=False):
+        self._description = description
+        self.relay_handshake = b"please relay" if relay else None
+        self.state = "probing"
+        self._negotiation_d = defer.Deferred()
+        self.probes = []
+
+    def describe(self):
+        return self._description
+
+    def send_probe(self, size):
+        self.probes.append(size)
+
+    def decide(self, state):
+        self.state = state
+
+
+def test_select():
+    clock = task.Clock()
+    timing = DebugTiming()
+    s = transit.TransitSender("", reactor=clock, timing=timing,
+                              select_window=1.0)
+    s.add_connection_abilities([{"type": "probe-v1"}])
+    relay = FakeCandidate("relay", relay=True)
+    direct = FakeCandidate("direct")
+    slow = FakeCandidate("slow")
+    assert s.connection_ready(relay) == "probing"
+    assert relay.probes == [0, transit.PROBE_SIZE]
+    clock.advance(0.1)
+    assert s.connection_ready(direct) == "probing"
+    assert s.connection_ready(slow) == "probing"
+
+    # the relay won the race to negotiate, and is a bit faster, but not
+    # enough to beat a direct connection
+    clock.advance(0.01)
+    s.probe_answered(relay)
+    clock.advance(0.01)
+    s.probe_answered(relay)
+    clock.advance(0.01)
+    s.probe_answered(direct)
+    clock.advance(0.012)
+    s.probe_answered(direct)
+    s.probe_answered(slow)
+    assert relay.state == direct.state == "probing"
+
+    clock.advance(1.0)
+    assert direct.state == "go"
+    assert relay.state == "nevermind"
+    assert slow.state == "nevermind"
+    assert s._winner is direct
+    assert s.connection_ready(FakeCandidate("late")) == "nevermind"
+
+    events = {e._name: e for e in timing._events}
+    probe = [e._details for e in timing._events
+             if e._name == "transit probe"]
+    assert [p["description"] for p in probe] == ["relay", "direct"]
+    assert probe[1]["rtt"] == pytest.approx(0.03)
+    assert probe[1]["throughput"] == \
+        pytest.approx(transit.PROBE_SIZE / 0.012)
+    assert events["transit select"]._details["winner"] == "direct"
+    assert events["transit select"]._details["candidates"] == 3
+    assert not clock.getDelayedCalls()
+
+
+def test_select_after_window():
+    clock = task.Clock()
+    s = transit.TransitSender("", reactor=clock, select_window=1.0)
+    s.add_connection_abilities([{"type": "probe-v1"}])
+    a = FakeCandidate("a")
+    b = FakeCandidate("b")
+    s.connection_ready(a)
+    s.connection_ready(b)
+    clock.advance(1.0)
+    # nobody has finished probing yet, so we use whoever finishes first
+    assert a.state == b.state == "probing"
+    s.probe_answered(b)
+    s.probe_answered(b)
+    assert b.state == "go"
+    assert a.state == "nevermind"
+
+
+def test_select_fast_links_tie():
+    # two links which both deliver the probe faster than we can measure
+    # are ranked by their RTT
+    clock = task.Clock()
+    s = transit.TransitSender("", reactor=clock, select_window=1.0)
+    s.add_connection_abilities([{"type": "probe-v1"}])
+    far = FakeCandidate("far")
+    near = FakeCandidate("near")
+    s.connection_ready(far)
+    s.connection_ready(near)
+    clock.advance(0.002)
+    s.probe_answered(near)
+    clock.advance(0.005)
+    s.probe_answered(near)
+    clock.advance(0.02)
+    s.probe_answered(far)
+    s.probe_answered(far)
+    clock.advance(1.0)
+    assert near.state == "go"
+    assert far.state == "nevermind"
+
+
+def test_choose_probed_connection():
+    choose = transit.choose_probed_connection
+    direct = ("d", False, 0.01, 100.0)
+    relay = ("r", True, 0.01, 120.0)
+    fast_relay = ("fr", True, 0.01, 200.0)
+    assert choose([direct, relay]) is direct
+    assert choose([direct, relay, fast_relay]) is fast_relay
+    assert choose([relay, fast_relay]) is fast_relay
+    # ties go to the lower RTT
+    near = ("n", False, 0.001, 100.0)
+    assert choose([direct, near]) is near
+
+
+def test_abilities_striped():
+    c = transit.Common(None, no_listen=True, stripes=4)
+    assert c.get_connection_abilities()[-1] == \
+        {"type": "striped-v1", "stripes": 4}
+    assert c._negotiated_stripes() == 1  # until the peer agrees
+    c.add_connection_abilities([{"type": "direct-tcp-v1"},
+                                {"type": "striped-v1", "stripes": "lots"}])
+    assert c._negotiated_stripes() == 1
+    c.add_connection_abilities([{"type": "striped-v1", "stripes": 2}])
+    assert c._negotiated_stripes() == 2
+
+    c = transit.Common(None, no_listen=True, stripes=100)
+    assert c.get_connection_abilities()[-1]["stripes"] == transit.MAX_STRIPES
+
+
+def test_stripe_keys():
+    s = transit.TransitSender("")
+    s.set_transit_key(b"\x00")
+    r = transit.TransitReceiver("")
+    r.set_transit_key(b"\x00")
+    keys = set()
+    for stripe in range(3):
+        assert s._sender_record_key(stripe) == r._receiver_record_key(stripe)
+        assert r._sender_record_key(stripe) == s._receiver_record_key(stripe)
+        keys.add(s._sender_record_key(stripe))
+        keys.add(s._receiver_record_key(stripe))
+    assert len(keys) == 6
+    assert s._sender_record_key(0) == s._sender_record_key()
+
+
+class FakeConnection:
+    def __init__(self, description="fake"):
+        self.stripe = 0
+        self._description = description
+        self._consumer = None
+        self._inbound_records = []
+        self.producer = None
+        self.paused = False
+        self.sent = []
+        self.closed = False
+        self._closed_d = defer.Deferred()
+
+    def describe(self):
+        return self._description
+
+    def send_record(self, record):
+        self.sent.append(record)
+
+    def send_records(self, records):
+        self.sent.extend(records)
+
+    def whenClosed(self):
+        return self._closed_d
+
+    def close(self):
+        self.closed = True
+
+    def registerProducer(self, producer, streaming):
+        assert streaming
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def connectConsumer(self, consumer):
+        self._consumer = consumer
+        for r in self._inbound_records:
+            consumer.write(r)
+        self._inbound_records = []
+
+    def disconnectConsumer(self):
+        self._consumer = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def deliver(self, offset, data):
+        record = transit.STRIPE_OFFSET.pack(offset) + data
+        if self._consumer:
+            self._consumer.write(record)
+        else:
+            self._inbound_records.append(record)
+
+
+def test_connection_ready_striped():
+    s = transit.TransitSender("", stripes=3)
+    s.add_connection_abilities([{"type": "striped-v1", "stripes": 8}])
+    p1, p2, p3, p4 = [FakeConnection() for i in range(4)]
+    assert s.connection_ready(p1) == "go"
+    s._start_striping(p1)
+    # stragglers from the initial race still lose
+    straggler = FakeConnection()
+    assert s.connection_ready(straggler) == "nevermind"
+    for p in [p2, p3, p4]:
+        p.factory = mock.Mock(for_stripes=True)
+    assert s.connection_ready(p2) == "go"
+    assert p2.stripe == 1
+    assert s.connection_ready(p3) == "go"
+    assert p3.stripe == 2
+    assert s.connection_ready(p4) == "nevermind"
+    assert p4.stripe == 0
+
+
+def test_striped_send():
+    primary, extra = FakeConnection("primary"), FakeConnection("extra")
+    sc = transit.StripedConnection(primary)
+    assert sc.describe() == "primary"
+    sc.add_stripe(extra)
+    assert sc.describe() == "primary (+1 stripes)"
+
+    fs = FileSender()
+    f = io.BytesIO(b"".join(b"%d" % i * 10000 for i in range(10)))
+    fs.CHUNK_SIZE = 10000
+    d = fs.beginFileTransfer(f, sc)
+    # our fake transports never push back, so that sends everything,
+    # spread across both stripes
+    assert d.called
+    assert primary.producer is None
+    assert extra.producer is None
+    assert len(primary.sent) == 5
+    assert len(extra.sent) == 5
+    chunks = {}
+    for record in primary.sent + extra.sent:
+        (offset,) = transit.STRIPE_OFFSET.unpack_from(record)
+        chunks[offset] = record[transit.STRIPE_OFFSET.size:]
+    assert b"".join(chunks[o] for o in sorted(chunks)) == f.getvalue()
+
+    # control records only use the primary
+    sc.send_record(b"control")
+    assert primary.sent[-1] == b"control"
+    assert len(extra.sent) == 5
+
+
+def test_striped_send_batch():
+    primary, extra = FakeConnection(), FakeConnection()
+    sc = transit.StripedConnection(primary)
+    sc.add_stripe(extra)
+    # a batch goes to a single stripe, with consecutive offsets
+    sc.writeSequence([b"one", b"two"])
+    sc.writeSequence([b"three"])
+    assert primary.sent == [transit.STRIPE_OFFSET.pack(0) + b"one",
+                            transit.STRIPE_OFFSET.pack(3) + b"two"]
+    assert extra.sent == [transit.STRIPE_OFFSET.pack(6) + b"three"]
+
+
+def test_striped_send_flow_control():
+    primary, extra = FakeConnection(), FakeConnection()
+    sc = transit.StripedConnection(primary)
+    sc.add_stripe(extra)
+    producer = proto_helpers.StringTransport()
+    sc.registerProducer(producer, True)
+    assert producer.producerState == "producing"
+
+    primary.producer.pauseProducing()
+    assert producer.producerState == "producing"
+    # while the primary is full, data goes to the other stripe
+    sc.write(b"one")
+    sc.write(b"two")
+    assert primary.sent == []
+    assert len(extra.sent) == 2
+    extra.producer.pauseProducing()
+    assert producer.producerState == "paused"
+    primary.producer.resumeProducing()
+    assert producer.producerState == "producing"
+    sc.unregisterProducer()
+    assert primary.producer is None
+
+
+@ensureDeferred
+async def test_striped_receive():
+    primary, extra = FakeConnection(), FakeConnection()
+    sc = transit.StripedConnection(primary)
+    sc.add_stripe(extra)
+    primary.deliver(0, b"aaa")
+
+    f = io.BytesIO()
+    progress = []
+    d = sc.writeToFile(f, 12, progress.append)
+    assert f.getvalue() == b"aaa"
+    extra.deliver(6, b"ccc")  # early
+    assert f.getvalue() == b"aaa"
+    primary.deliver(3, b"bbb")  # fills the gap
+    assert f.getvalue() == b"aaabbbccc"
+    assert progress == [3, 3, 3]
+    with pytest.raises(transit.TransitError):
+        extra.deliver(3, b"bbb")
+    primary.deliver(9, b"ddd")
+    assert await d == 12
+    assert f.getvalue() == b"aaabbbcccddd"
+    assert primary._consumer is None
+    assert extra._consumer is None
+
+
+@ensureDeferred
+async def test_striped_receive_reorder_limit():
+    primary, extra = FakeConnection(), FakeConnection()
+    sc = transit.StripedConnection(primary)
+    sc.add_stripe(extra)
+    f = io.BytesIO()
+    size = 2**20
+    count = transit.STRIPE_REORDER_LIMIT // size + 2
+    d = sc.writeToFile(f, size * (count + 1))
+    for i in range(count):
+        extra.deliver(size * (i + 1), b"x" * size)
+    # the stripe that's running ahead gets paused
+    assert extra.paused
+    assert not primary.paused
+    primary.deliver(0, b"y" * size)
+    assert not extra.paused
+    assert await d == size * (count + 1)
+
+
+@ensureDeferred
+async def test_striped_receive_stripe_lost():
+    primary, extra = FakeConnection(), FakeConnection()
+    sc = transit.StripedConnection(primary)
+    sc.add_stripe(extra)
+    d = sc.writeToFile(io.BytesIO(), 10)
+    extra._closed_d.callback(None)
+    with pytest.raises(error.ConnectionClosed):
+        await d
+    # the transfer is broken, but the primary may still be used for errors
+    assert not primary.closed
+    assert sc.stripe_count() == 1
+
+    primary._closed_d.callback(None)
+    assert sc.closed
+
+
 def test_listener():
     c = transit.Common("")
     hints, ep = c._build_listener()
@@ -325,6 +699,15 @@ def test_listener():
 
 
 
+def test_shared_listener():
+    sl = SharedListener(port=0)
+    c = transit.TransitSender("", listener=sl)
+    hints, ep = c._build_listener()
+    assert hints[0].port == sl.start()
+    assert isinstance(ep, SharedEndpoint)
+    sl.stopListening()
+
+
 @ensureDeferred
 async def test_get_direct_hints():
     # this actually starts the listener
@@ -374,6 +757,7 @@ class DummyProtocol(protocol.Protocol):
             self._d2.callback(None)
 
 
+@implementer(interfaces.IConsumer)
 class FakeTransport:
     signalConnectionLost = True
 
@@ -381,11 +765,30 @@ class FakeTransport:
         self.protocol = p
         self._peeraddr = peeraddr
         self._buf = b""
+        self._writes = 0
         self._connected = True
+        self.producer = None
+        self.paused = False
 
     def write(self, data):
         self._buf += data
 
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def writeSequence(self, data):
+        self._writes += 1
+        self._buf += b"".join(data)
+
     def loseConnection(self):
         self._connected = False
         if self.signalConnectionLost:
@@ -548,6 +951,8 @@ def test_success_outboun():
 
 class MockOwner:
     _connection_ready_called = False
+    _reactor = reactor
+    _threadpool = None
 
     def connection_ready(self, connection):
         self._connection_ready_called = True
@@ -560,12 +965,18 @@ class MockOwner:
     def _expect_this(self):
         return b"expect_this"
 
-    def _sender_record_key(self):
+    def _sender_record_key(self, stripe=0):
         return b"s" * 32
 
-    def _receiver_record_key(self):
+    def _receiver_record_key(self, stripe=0):
         return b"r" * 32
 
+    def _negotiated_stripes(self):
+        return 3
+
+    def _crypto_threadpool(self):
+        return self._threadpool
+
 
 class MockFactory:
     _connectionWasMade_called = False
@@ -808,6 +1219,154 @@ async def test_receiver_accepted():
     assert await d == c
 
 
+@ensureDeferred
+async def test_receiver_accepted_stripe():
+    owner = MockOwner()
+    factory = MockFactory()
+    addr = address.HostnameAddress("example.com", 1234)
+    c = transit.Connection(owner, None, None, "description")
+    t = c.transport = FakeTransport(c, addr)
+    c.factory = factory
+    c.connectionMade()
+
+    owner._state = "wait-for-decision"
+    d = c.startNegotiation()
+    c.dataReceived(b"expect_this")
+    c.dataReceived(b"go ")
+    assert c.state == "wait-for-decision"
+    c.dataReceived(b"2\n")
+    assert c.state == "records"
+    assert c.stripe == 2
+    assert await d == c
+    assert t._connected
+
+
+@ensureDeferred
+async def test_receiver_bad_stripe():
+    for bad in [b"go 3\n", b"go 0\n", b"go two\n", b"go " + b"1" * 20]:
+        owner = MockOwner()
+        factory = MockFactory()
+        addr = address.HostnameAddress("example.com", 1234)
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, addr)
+        c.factory = factory
+        c.connectionMade()
+
+        owner._state = "wait-for-decision"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        c.dataReceived(bad)
+        assert not t._connected
+        with pytest.raises(transit.BadHandshake):
+            await d
+
+
+@ensureDeferred
+async def test_sender_accepting_stripe():
+    owner = MockOwner()
+    factory = MockFactory()
+    addr = address.HostnameAddress("example.com", 1234)
+    c = transit.Connection(owner, None, None, "description")
+    t = c.transport = FakeTransport(c, addr)
+    c.factory = factory
+    c.connectionMade()
+
+    def _ready(p):
+        p.stripe = 1
+        return "go"
+    owner.connection_ready = _ready
+    d = c.startNegotiation()
+    t.read_buf()
+    c.dataReceived(b"expect_this")
+    assert t.read_buf() == b"go 1\n"
+    assert await d == c
+
+
+@ensureDeferred
+async def test_receiver_probed():
+    owner = MockOwner()
+    owner.answers_probes = True
+    factory = MockFactory()
+    addr = address.HostnameAddress("example.com", 1234)
+    c = transit.Connection(owner, None, None, "description")
+    t = c.transport = FakeTransport(c, addr)
+    c.factory = factory
+    c.connectionMade()
+
+    owner._state = "wait-for-decision"
+    d = c.startNegotiation()
+    c.dataReceived(b"expect_this")
+    t.read_buf()
+    c.dataReceived(b"probe 0\nprobe 5\nab")
+    assert t.read_buf() == b"probed\n"
+    c.dataReceived(b"cd")
+    assert t.read_buf() == b""
+    c.dataReceived(b"ego\n")
+    assert t.read_buf() == b"probed\n"
+    assert c.state == "records"
+    assert await d == c
+
+
+@ensureDeferred
+async def test_receiver_bad_probe():
+    for answers, bad in [(False, b"probe 1\n"),
+                         (True, b"probe -1\n"),
+                         (True, b"probe %d\n" % (transit.MAX_PROBE_SIZE + 1)),
+                         (True, b"prod 1\n"),
+                         (True, b"probe " + b"1" * 20)]:
+        owner = MockOwner()
+        owner.answers_probes = answers
+        factory = MockFactory()
+        addr = address.HostnameAddress("example.com", 1234)
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, addr)
+        c.factory = factory
+        c.connectionMade()
+
+        owner._state = "wait-for-decision"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        c.dataReceived(bad)
+        assert not t._connected
+        with pytest.raises(transit.BadHandshake):
+            await d
+
+
+@ensureDeferred
+async def test_sender_probing():
+    owner = MockOwner()
+    factory = MockFactory()
+    addr = address.HostnameAddress("example.com", 1234)
+    c = transit.Connection(owner, None, None, "description")
+    t = c.transport = FakeTransport(c, addr)
+    c.factory = factory
+    c.connectionMade()
+
+    answered = []
+
+    def _ready(p):
+        p.send_probe(0)
+        p.send_probe(3)
+        return "probing"
+    owner.connection_ready = _ready
+    owner.probe_answered = answered.append
+    d = c.startNegotiation()
+    t.read_buf()
+    c.dataReceived(b"expect_this")
+    assert t.read_buf() == b"probe 0\nprobe 3\n\x00\x00\x00"
+    c.dataReceived(b"probed\nprob")
+    assert answered == [c]
+    c.dataReceived(b"ed\n")
+    assert answered == [c, c]
+    assert c.state == "probing"
+    assert not d.called
+
+    c.decide("go")
+    assert t.read_buf() == b"go\n"
+    assert c.state == "records"
+    assert await d == c
+
+
 @ensureDeferred
 async def test_receiver_rejected_politely():
     # we're on the receiving side, so we wait for the sender to decide
@@ -919,8 +1478,9 @@ async def test_timeout():
     assert str(f.value) == "timeout"
 
 
-async def make_connection():
+async def make_connection(threadpool=None):
     owner = MockOwner()
+    owner._threadpool = threadpool
     factory = MockFactory()
     addr = address.HostnameAddress("example.com", 1234)
     c = transit.Connection(owner, None, None, "description")
@@ -1021,6 +1581,231 @@ async def test_records_good():
     assert inbound_records == [RECORD5, RECORD6]
 
 
+@ensureDeferred
+async def test_records_many_per_read():
+    # a single large read can hold many records, plus the start of the next
+    t, c, owner = await make_connection()
+
+    inbound_records = []
+    c.recordReceived = inbound_records.append
+    send_box = SecretBox(owner._receiver_record_key())
+
+    records = [b"record%d" % i * (i + 1) for i in range(20)]
+    wire = b""
+    for i, record in enumerate(records):
+        nonce_buf = unhexlify("%048x" % i)
+        encrypted = send_box.encrypt(record, nonce_buf)
+        wire += unhexlify(f"{len(encrypted):08x}") + encrypted
+
+    c.dataReceived(wire[:-5])
+    assert inbound_records == records[:-1]
+    # everything consumed has been discarded, only the partial record is left
+    assert len(c.buf) == len(wire) - 5 - sum(
+        4 + 24 + 16 + len(r) for r in records[:-1])
+    c.dataReceived(wire[-5:])
+    assert inbound_records == records
+    assert c.buf == b""
+
+
+@ensureDeferred
+async def test_send_records_batch():
+    # a batch of records is encrypted with consecutive nonces and written
+    # with a single writeSequence()
+    t, c, owner = await make_connection()
+    c.send_record(b"first")
+    t.read_buf()
+    writes = t._writes
+
+    records = [b"r1", b"r2" * 100, b""]
+    c.send_records(records)
+    assert t._writes == writes + 1
+    buf = t.read_buf()
+    receive_box = SecretBox(owner._sender_record_key())
+    for i, record in enumerate(records):
+        length = int(hexlify(buf[:4]), 16)
+        encrypted, buf = buf[4:4 + length], buf[4 + length:]
+        assert int(hexlify(encrypted[:SecretBox.NONCE_SIZE]), 16) == i + 1
+        assert receive_box.decrypt(encrypted) == record
+    assert buf == b""
+
+    # nothing is encrypted (or written) if any record in a batch is bad
+    with pytest.raises(InternalError):
+        c.send_records([b"good", "bad"])
+    assert t.read_buf() == b""
+    assert c.send_nonce == 4
+
+
+
+@pytest.fixture
+def threadpool():
+    pool = ThreadPool(minthreads=0, maxthreads=3, name="test-crypto")
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+@ensureDeferred
+async def test_crypto_pipeline_order(threadpool):
+    # batches finish in whatever order the threads get to them, but are
+    # delivered in the order they were submitted
+    gates = [threading.Event() for i in range(3)]
+    delivered = []
+    p = transit._CryptoPipeline(reactor, threadpool, delivered.append,
+                                None, lambda: None)
+
+    def work(i):
+        gates[i].wait(5)
+        return i
+
+    for i in range(3):
+        p.submit(work, i, 1)
+    assert p.busy()
+    idle = p.whenIdle()
+    gates[2].set()
+    gates[1].set()
+    await task.deferLater(reactor, 0.05, lambda: None)
+    assert delivered == []
+    gates[0].set()
+    await idle
+    assert delivered == [0, 1, 2]
+    assert not p.busy()
+
+
+@ensureDeferred
+async def test_crypto_pipeline_failure(threadpool):
+    failures = []
+    delivered = []
+    p = transit._CryptoPipeline(reactor, threadpool, delivered.append,
+                                failures.append, lambda: None)
+    p.submit(lambda i: 1 / i, 0, 1)
+    p.submit(lambda i: i, 1, 1)
+    await p.whenIdle()
+    assert len(failures) == 1
+    assert failures[0].check(ZeroDivisionError)
+    assert delivered == []  # nothing after the failure
+
+
+@ensureDeferred
+async def test_threaded_records(threadpool):
+    t, c, owner = await make_connection(threadpool)
+    records = [b"record%d" % i * 1000 for i in range(20)]
+    for record in records[:10]:
+        c.send_record(record)
+    c.send_records(records[10:])
+    await c._encryptor.whenIdle()
+    buf = t.read_buf()
+    receive_box = SecretBox(owner._sender_record_key())
+    for i, record in enumerate(records):
+        (length,) = transit.RECORD_LENGTH.unpack_from(buf)
+        encrypted, buf = buf[4:4 + length], buf[4 + length:]
+        assert int(hexlify(encrypted[:SecretBox.NONCE_SIZE]), 16) == i
+        assert receive_box.decrypt(encrypted) == record
+    assert buf == b""
+
+    inbound_records = []
+    c.recordReceived = inbound_records.append
+    send_box = SecretBox(owner._receiver_record_key())
+    wire = b""
+    for i, record in enumerate(records):
+        encrypted = send_box.encrypt(record, transit.NONCE.pack(i))
+        wire += transit.RECORD_LENGTH.pack(len(encrypted)) + encrypted
+    for i in range(0, len(wire), 3000):
+        c.dataReceived(wire[i:i + 3000])
+    await c._decryptor.whenIdle()
+    assert inbound_records == records
+
+    # nonces are still checked as the records arrive
+    with pytest.raises(transit.BadNonce):
+        c.dataReceived(wire[:4 + 40 + len(records[0])])
+
+
+@ensureDeferred
+async def test_threaded_flow_control(threadpool, monkeypatch):
+    monkeypatch.setattr(transit, "CRYPTO_QUEUE_SIZE", 1000)
+    t, c, owner = await make_connection(threadpool)
+    gate = threading.Event()
+    encrypt_batch = c._encrypt_batch
+
+    def slow_encrypt(batch):
+        gate.wait(5)
+        return encrypt_batch(batch)
+    c._encrypt_batch = slow_encrypt
+
+    producer = proto_helpers.StringTransport()
+    c.registerProducer(producer, True)
+    assert t.producer is not producer  # we sit in between
+    c.write(b"." * 600)
+    assert producer.producerState == "producing"
+    c.write(b"." * 600)
+    # the encryption queue is full
+    assert producer.producerState == "paused"
+    gate.set()
+    await c._encryptor.whenIdle()
+    assert producer.producerState == "producing"
+    # and the transport can push back too
+    t.producer.pauseProducing()
+    assert producer.producerState == "paused"
+    t.producer.resumeProducing()
+    assert producer.producerState == "producing"
+    c.unregisterProducer()
+    assert t.producer is None
+
+    # inbound: we stop reading while the decryption queue is full, even if
+    # our consumer wants more
+    gate.clear()
+    decrypt_batch = c._decrypt_batch
+
+    def slow_decrypt(batch):
+        gate.wait(5)
+        return decrypt_batch(batch)
+    c._decrypt_batch = slow_decrypt
+    inbound_records = []
+    c.recordReceived = inbound_records.append
+    send_box = SecretBox(owner._receiver_record_key())
+    encrypted = send_box.encrypt(b"." * 1200, transit.NONCE.pack(0))
+    c.dataReceived(transit.RECORD_LENGTH.pack(len(encrypted)) + encrypted)
+    assert t.paused
+    c.pauseProducing()
+    c.resumeProducing()
+    assert t.paused
+    gate.set()
+    await c._decryptor.whenIdle()
+    assert inbound_records == [b"." * 1200]
+    assert not t.paused
+
+
+@ensureDeferred
+async def test_threaded_close(threadpool):
+    # records accepted before close() are still sent, and records received
+    # before the connection was lost are still delivered
+    t, c, owner = await make_connection(threadpool)
+    t.signalConnectionLost = False
+    gate = threading.Event()
+    encrypt_batch = c._encrypt_batch
+
+    def slow_encrypt(batch):
+        gate.wait(5)
+        return encrypt_batch(batch)
+    c._encrypt_batch = slow_encrypt
+    c.send_record(b"last words")
+    c.close()
+    assert t._connected
+    gate.set()
+    await c._encryptor.whenIdle()
+    assert not t._connected
+    assert t.read_buf() != b""
+
+    t, c, owner = await make_connection(threadpool)
+    d = c.receive_record()
+    closed = c.whenClosed()
+    send_box = SecretBox(owner._receiver_record_key())
+    encrypted = send_box.encrypt(b"ack", transit.NONCE.pack(0))
+    c.dataReceived(transit.RECORD_LENGTH.pack(len(encrypted)) + encrypted)
+    c.connectionLost()
+    assert await d == b"ack"
+    await closed
+
+
 def corrupt(orig):
     last_byte = orig[-1:]
     num = int(hexlify(last_byte).decode("ascii"), 16)
@@ -1297,6 +2082,11 @@ def test_consumer():
     c.write(b"r1.")
     assert records == [b"r1."]
 
+    batches = []
+    c.send_records = batches.append
+    c.writeSequence([b"r2.", b"r3."])
+    assert batches == [[b"r2.", b"r3."]]
+
     c.unregisterProducer()
     assert c.transport.producer is None
 
@@ -1333,6 +2123,281 @@ def test_hasher():
     assert hashee == [b"." * 99, b"!"]
 
 
+@ensureDeferred
+async def test_write_behind():
+    f = io.BytesIO()
+    progress = []
+    hashee = []
+    fc = transit.WriteBehindFileConsumer(f, progress.append, hashee.append)
+    producer = mock.Mock()
+    fc.registerProducer(producer, True)
+    fc.write(b"." * 99)
+    fc.call_in_writer(lambda: hashee.append(f.getvalue()))
+    fc.write(b"!")
+    # progress is reported as the data arrives, not once it is written
+    assert progress == [99, 1]
+    fc.unregisterProducer()
+    await fc.close()
+    assert f.getvalue() == b"." * 99 + b"!"
+    assert hashee == [b"." * 99, b"." * 99, b"!"]
+    assert producer.mock_calls == []
+
+
+class SlowFile(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.unblocked = threading.Event()
+
+    def write(self, data):
+        self.unblocked.wait()
+        return super().write(data)
+
+
+@ensureDeferred
+async def test_write_behind_pause():
+    f = SlowFile()
+    fc = transit.WriteBehindFileConsumer(f)
+    producer = mock.Mock()
+    fc.registerProducer(producer, True)
+    with mock.patch("wormhole.transit.WRITE_BEHIND", 30):
+        for i in range(3):
+            fc.write(b"." * 10)
+        assert producer.mock_calls == [mock.call.pauseProducing()]
+        fc.write(b"." * 10)  # we're already paused
+        assert producer.mock_calls == [mock.call.pauseProducing()]
+        f.unblocked.set()
+        await poll_until(lambda: len(producer.mock_calls) == 2)
+        assert producer.mock_calls[1] == mock.call.resumeProducing()
+    fc.unregisterProducer()
+    await fc.close()
+    assert f.getvalue() == b"." * 40
+
+
+@ensureDeferred
+async def test_write_behind_unregister_paused():
+    f = SlowFile()
+    fc = transit.WriteBehindFileConsumer(f)
+    producer = mock.Mock()
+    fc.registerProducer(producer, True)
+    with mock.patch("wormhole.transit.WRITE_BEHIND", 10):
+        fc.write(b"." * 10)
+    assert producer.mock_calls == [mock.call.pauseProducing()]
+    fc.unregisterProducer()
+    assert producer.mock_calls == [mock.call.pauseProducing(),
+                                   mock.call.resumeProducing()]
+    f.unblocked.set()
+    await fc.close()
+    assert f.getvalue() == b"." * 10
+
+
+@ensureDeferred
+async def test_write_behind_error():
+    class FullDisk(io.BytesIO):
+        def write(self, data):
+            if self.tell() >= 2:
+                raise OSError("disk full")
+            return super().write(data)
+    f = FullDisk()
+    fc = transit.WriteBehindFileConsumer(f)
+    producer = mock.Mock()
+    fc.registerProducer(producer, True)
+    fc.write(b"ab")
+    fc.write(b"cd")
+    await poll_until(lambda: producer.mock_calls)
+    assert producer.mock_calls == [mock.call.stopProducing()]
+    fc.write(b"ef")  # ignored
+    with pytest.raises(OSError, match="disk full"):
+        await fc.close()
+    assert f.getvalue() == b"ab"
+
+
+@implementer(interfaces.IConsumer)
+class PausingConsumer:
+    def __init__(self, pause_after=None):
+        self.producer = None
+        self.streaming = None
+        self.writes = []
+        self._pause_after = pause_after
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.writes.append(data)
+        if len(self.writes) == self._pause_after:
+            self.producer.pauseProducing()
+
+
+class BatchingConsumer(PausingConsumer):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def writeSequence(self, data):
+        self.batches.append(data)
+        self.writes.extend(data)
+
+
+@ensureDeferred
+async def test_read_ahead_mmap(tmp_path):
+    fn = tmp_path / "data"
+    data = os.urandom(100000)
+    fn.write_bytes(data)
+    hashee = []
+    c = PausingConsumer()
+    with open(fn, "rb") as f:
+        fs = transit.ReadAheadFileSender()
+        fs.CHUNK_SIZE = 4096
+        last = await fs.beginFileTransfer(
+            f, c, transform=lambda d: hashee.append(d) or d)
+    assert c.streaming is True
+    assert c.producer is None  # unregistered when done
+    assert b"".join(c.writes) == data
+    assert all(len(w) == 4096 for w in c.writes[:-1])
+    assert hashee == c.writes
+    assert last == data[-1:]
+
+
+def test_map_file(tmp_path):
+    fn = tmp_path / "data"
+    fn.write_bytes(b"hello")
+    with open(fn, "rb") as f:
+        mm = transit._map_file(f)
+        assert mm[:] == b"hello"
+        mm.close()
+    # empty files, and things that aren't files, are read normally
+    fn.write_bytes(b"")
+    with open(fn, "rb") as f:
+        assert transit._map_file(f) is None
+    assert transit._map_file(io.BytesIO(b"hello")) is None
+    r, w = os.pipe()
+    with open(r, "rb") as f:
+        assert transit._map_file(f) is None
+    os.close(w)
+
+
+@ensureDeferred
+async def test_read_ahead_resume(tmp_path):
+    fn = tmp_path / "data"
+    data = os.urandom(10000)
+    fn.write_bytes(data)
+    c = PausingConsumer()
+    with open(fn, "rb") as f:
+        f.seek(3000)
+        fs = transit.ReadAheadFileSender()
+        fs.CHUNK_SIZE = 4096
+        await fs.beginFileTransfer(f, c)
+    assert c.writes == [data[3000:7096], data[7096:]]
+
+
+@ensureDeferred
+async def test_read_ahead_batches():
+    # a consumer with writeSequence() gets whatever chunks are waiting in
+    # batches of up to BATCH_SIZE
+    data = os.urandom(10000)
+    c = BatchingConsumer()
+    fs = transit.ReadAheadFileSender()
+    fs.CHUNK_SIZE = 100
+    fs.BATCH_SIZE = 8
+    fs.pauseProducing()
+    d = fs.beginFileTransfer(io.BytesIO(data), c)
+    await poll_until(lambda: fs._queue.qsize() == 101)
+    fs.resumeProducing()
+    last = await d
+    assert [len(batch) for batch in c.batches] == [8] * 12 + [4]
+    assert b"".join(c.writes) == data
+    assert last == data[-1:]
+
+
+@ensureDeferred
+async def test_read_ahead_hasher():
+    # the hasher is fed in the reader thread, so it may block there
+    data = os.urandom(10000)
+    hashed = []
+    threads = set()
+
+    def hasher(chunk):
+        threads.add(threading.current_thread().name)
+        hashed.append(chunk)
+    c = PausingConsumer()
+    fs = transit.ReadAheadFileSender()
+    fs.CHUNK_SIZE = 1000
+    await fs.beginFileTransfer(io.BytesIO(data), c, hasher=hasher)
+    assert hashed == c.writes
+    assert threads == {"wormhole-reader"}
+
+
+@ensureDeferred
+async def test_read_ahead_pause():
+    data = os.urandom(10000)
+    c = PausingConsumer(pause_after=1)
+    fs = transit.ReadAheadFileSender()
+    fs.CHUNK_SIZE = 1000
+    d = fs.beginFileTransfer(io.BytesIO(data), c)
+    # the reader thread queues the other nine chunks (and EOF), but nothing
+    # more is written while we're paused
+    await poll_until(lambda: fs._queue.qsize() == 10)
+    assert c.writes == [data[:1000]]
+    assert not d.called
+    fs.resumeProducing()
+    last = await d
+    assert b"".join(c.writes) == data
+    assert last == data[-1:]
+
+
+@ensureDeferred
+async def test_read_ahead_bounded():
+    data = os.urandom(10000)
+    c = PausingConsumer(pause_after=1)
+    fs = transit.ReadAheadFileSender()
+    fs.CHUNK_SIZE = 1000
+    with mock.patch("wormhole.transit.READ_AHEAD", 3000):
+        d = fs.beginFileTransfer(io.BytesIO(data), c)
+    await poll_until(fs._queue.full)
+    assert fs._queue.qsize() == 3
+    fs.resumeProducing()
+    await d
+    assert b"".join(c.writes) == data
+
+
+@ensureDeferred
+async def test_read_ahead_stop():
+    c = PausingConsumer(pause_after=1)
+    fs = transit.ReadAheadFileSender()
+    fs.CHUNK_SIZE = 1000
+    with mock.patch("wormhole.transit.READ_AHEAD", 3000):
+        d = fs.beginFileTransfer(io.BytesIO(b"." * 100000), c)
+    await poll_until(fs._queue.full)
+    fs.stopProducing()
+    with pytest.raises(Exception, match="asked us to stop"):
+        await d
+    # the reader notices, and gives up
+    await poll_until(lambda: not any(t.name == "wormhole-reader"
+                                     for t in threading.enumerate()))
+    assert c.writes == [b"." * 1000]
+
+
+@ensureDeferred
+async def test_read_ahead_error():
+    class BrokenFile(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell() >= 2000:
+                raise OSError("disk on fire")
+            return super().read(size)
+    c = PausingConsumer()
+    fs = transit.ReadAheadFileSender()
+    fs.CHUNK_SIZE = 1000
+    d = fs.beginFileTransfer(BrokenFile(b"." * 5000), c)
+    with pytest.raises(OSError, match="disk on fire"):
+        await d
+    assert c.writes == [b"." * 1000] * 2
+    assert c.producer is None
+
+
 DIRECT_HINT_JSON = {
     "type": "direct-tcp-v1",
     "hostname": "direct",
@@ -1596,6 +2661,93 @@ async def test_no_direct_hints():
         assert await d == "winner"
 
 
+@ensureDeferred
+async def test_relay_after_direct_fails():
+    clock = task.Clock()
+    fc = FakeConnector()
+    s = transit.TransitSender("", reactor=clock, no_listen=True)
+    s.set_transit_key(b"key")
+    hints = await s.get_connection_hints()
+    del hints
+    s.add_connection_hints([DIRECT_HINT_JSON, RELAY_HINT_JSON])
+    s._start_connector = fc._start_connector
+
+    with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                    _endpoint_from_hint_obj):
+        d = s.connect()
+        assert fc._connectors == ["direct"]
+        # the only direct hint was refused, so there's no point in waiting
+        # for it any longer
+        fc._waiters[0].errback(error.ConnectionRefusedError())
+        assert fc._connectors == ["direct"]
+        clock.advance(0)
+        assert fc._connectors == ["direct", "relay"]
+
+        fc._waiters[1].callback("winner")
+        assert await d == "winner"
+        assert not clock.getDelayedCalls()
+
+
+@ensureDeferred
+async def test_relay_delay_from_rtt():
+    clock = task.Clock()
+    fc = FakeConnector()
+    s = transit.TransitSender("", reactor=clock, no_listen=True)
+    s.set_transit_key(b"key")
+    hints = await s.get_connection_hints()
+    del hints
+    s.add_connection_hints([
+        DIRECT_HINT_JSON,
+        {"type": "direct-tcp-v1", "hostname": "direct2", "port": 1234},
+        RELAY_HINT_JSON,
+    ])
+    s._start_connector = fc._start_connector
+
+    with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                    _endpoint_from_hint_obj):
+        d = s.connect()
+        assert fc._connectors == ["direct", "direct2"]
+        # one direct hint is refused after 100ms, which tells us the RTT,
+        # and the other one is silent: we give it four RTTs to answer
+        clock.advance(0.1)
+        s._observe_connect(failure.Failure(error.ConnectionRefusedError()),
+                           0.0)
+        fc._waiters[0].errback(error.ConnectionRefusedError())
+        clock.advance(0.29)
+        assert fc._connectors == ["direct", "direct2"]
+        clock.advance(0.02)
+        assert fc._connectors == ["direct", "direct2", "relay"]
+
+        fc._waiters[2].callback("winner")
+        assert await d == "winner"
+
+
+def test_relay_delay():
+    s = transit.TransitSender("", reactor=task.Clock())
+    assert s._relay_delay() == s.RELAY_DELAY
+    s._srtt = 0.1
+    assert s._relay_delay() == pytest.approx(0.4)
+    s._srtt = 0.001
+    assert s._relay_delay() == s.MIN_RELAY_DELAY
+    s._srtt = 10.0
+    assert s._relay_delay() == s.RELAY_DELAY
+
+
+def test_observe_connect():
+    clock = task.Clock()
+    s = transit.TransitSender("", reactor=clock)
+    clock.advance(1.0)
+    assert s._observe_connect("proto", 0.8) == "proto"
+    assert s._srtt == pytest.approx(0.2)
+    f = failure.Failure(error.ConnectionRefusedError())
+    assert s._observe_connect(f, 0.0) is f
+    assert s._srtt == pytest.approx(0.875 * 0.2 + 0.125 * 1.0)
+    # timeouts say nothing about the RTT
+    f = failure.Failure(error.TimeoutError())
+    assert s._observe_connect(f, 0.0) is f
+    assert s._srtt == pytest.approx(0.875 * 0.2 + 0.125 * 1.0)
+
+
 @ensureDeferred
 async def test_no_contenders():
     clock = task.Clock()
@@ -1620,7 +2772,6 @@ def old_build_relay_handshake(key):
     return (token, b"please relay " + hexlify(token) + b"\n")
 
 
-
 def test_old():
     key = b"\x00"
     token, old_handshake = old_build_relay_handshake(key)
@@ -1718,3 +2869,147 @@ async def test_relay(transit_relay):
 
     x.close()
     y.close()
+
+
+async def _striped_transfer(s, r):
+    s.add_connection_abilities(r.get_connection_abilities())
+    r.add_connection_abilities(s.get_connection_abilities())
+    shints = await s.get_connection_hints()
+    rhints = await r.get_connection_hints()
+    s.add_connection_hints(rhints)
+    r.add_connection_hints(shints)
+
+    (x, y) = await doBoth(s.connect(), r.connect())
+    assert isinstance(x, transit.StripedConnection)
+    assert isinstance(y, transit.StripedConnection)
+    await poll_until(lambda: x.stripe_count() == 3 and y.stripe_count() == 3)
+
+    data = os.urandom(100 * 1000)
+    f = io.BytesIO()
+    rx_d = y.writeToFile(f, len(data))
+    fs = FileSender()
+    fs.CHUNK_SIZE = 1000
+    await fs.beginFileTransfer(io.BytesIO(data), x)
+    assert await rx_d == len(data)
+    assert f.getvalue() == data
+
+    d = x.receive_record()
+    y.send_record(b"ack")
+    assert await d == b"ack"
+
+    x.close()
+    y.close()
+
+
+@ensureDeferred
+async def test_direct_striped():
+    KEY = b"k" * 32
+    s = transit.TransitSender(None, stripes=3)
+    r = transit.TransitReceiver(None, stripes=transit.MAX_STRIPES)
+    s.set_transit_key(KEY)
+    r.set_transit_key(KEY)
+    await _striped_transfer(s, r)
+
+
+@ensureDeferred
+async def test_relay_striped(transit_relay):
+    KEY = b"k" * 32
+    s = transit.TransitSender(transit_relay, no_listen=True, stripes=3)
+    r = transit.TransitReceiver(transit_relay, no_listen=True,
+                                stripes=transit.MAX_STRIPES)
+    s.set_transit_key(KEY)
+    r.set_transit_key(KEY)
+    await _striped_transfer(s, r)
+
+
+def test_default_crypto_workers():
+    # a single CPU does its crypto inline
+    assert transit.default_crypto_workers(1) == 0
+    assert transit.default_crypto_workers(2) == 2
+    assert transit.default_crypto_workers(16) == 4
+    assert transit.TransitSender(None, crypto_workers=0)._crypto_threadpool() \
+        is None
+
+
+@ensureDeferred
+async def test_direct_threaded():
+    KEY = b"k" * 32
+    s = transit.TransitSender(None, crypto_workers=2)
+    r = transit.TransitReceiver(None, crypto_workers=2)
+    s.set_transit_key(KEY)
+    r.set_transit_key(KEY)
+    shints = await s.get_connection_hints()
+    rhints = await r.get_connection_hints()
+    s.add_connection_hints(rhints)
+    r.add_connection_hints(shints)
+
+    (x, y) = await doBoth(s.connect(), r.connect())
+    assert x._encryptor and y._decryptor
+
+    data = os.urandom(1000 * 1000)
+    f = io.BytesIO()
+    rx_d = y.writeToFile(f, len(data))
+    fs = FileSender()
+    fs.CHUNK_SIZE = 10000
+    await fs.beginFileTransfer(io.BytesIO(data), x)
+    assert await rx_d == len(data)
+    assert f.getvalue() == data
+
+    d = x.receive_record()
+    y.send_record(b"ack")
+    y.close()
+    assert await d == b"ack"
+    x.close()
+    # the threads go away with the connection
+    await poll_until(lambda: s._threadpool is None and r._threadpool is None)
+
+
+@ensureDeferred
+async def test_direct_select():
+    KEY = b"k" * 32
+    timing = DebugTiming()
+    s = transit.TransitSender(None, timing=timing, select_window=0.2)
+    r = transit.TransitReceiver(None)
+    s.set_transit_key(KEY)
+    r.set_transit_key(KEY)
+    s.add_connection_abilities(r.get_connection_abilities())
+    shints = await s.get_connection_hints()
+    rhints = await r.get_connection_hints()
+    s.add_connection_hints(rhints)
+    r.add_connection_hints(shints)
+
+    (x, y) = await doBoth(s.connect(), r.connect())
+    x.send_record(b"hello")
+    assert await y.receive_record() == b"hello"
+    names = [e._name for e in timing._events]
+    assert "transit probe" in names
+    assert "transit select" in names
+    x.close()
+    y.close()
+
+
+@ensureDeferred
+async def test_direct_shared_listener():
+    # back-to-back transfers, both accepted on the same port
+    sl = SharedListener()
+    ports = []
+    for key in [b"1" * 32, b"2" * 32]:
+        s = transit.TransitSender(None, listener=sl)
+        r = transit.TransitReceiver(None, no_listen=True)
+        s.set_transit_key(key)
+        r.set_transit_key(key)
+        shints = await s.get_connection_hints()
+        ports.append({h["port"] for h in shints})
+        rhints = await r.get_connection_hints()
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x, y) = await doBoth(s.connect(), r.connect())
+        assert x.describe().startswith("<-")  # inbound, via the listener
+        x.send_record(b"hello")
+        assert await y.receive_record() == b"hello"
+        x.close()
+        y.close()
+    assert ports[0] == ports[1] == {sl.start()}
+    assert not sl._registrations
+    await sl.stopListening()
@@ -0,0 +1,217 @@
+import io
+import os
+import stat
+import tempfile
+import zipfile
+
+import pytest
+
+from ..cli import unzip, zipwriter
+
+FILES = {
+    "top": b"top file\n",
+    "sub/a": b"hello" * 1000,
+    "sub/empty-file": b"",
+    "sub/random": os.urandom(100000),
+    # data that looks like the start of a data descriptor
+    "sub/tricky": unzip.DESCRIPTOR_SIG * 100 + b"\x00" * 20,
+}
+
+
+@pytest.fixture
+def source(tmp_path):
+    src = tmp_path / "src"
+    for name, data in FILES.items():
+        fn = src / name
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        fn.write_bytes(data)
+    (src / "sub" / "empty-dir").mkdir()
+    os.chmod(src / "top", 0o751)
+    return src
+
+
+def zipwriter_bytes(src):
+    zw = zipwriter.ZipWriter()
+    for name in FILES:
+        zw.add_path(str(src / name), name)
+    zw.add_path(str(src / "sub" / "empty-dir") + os.sep, "sub/empty-dir/")
+    data = b"".join(zw)
+    assert len(data) == len(zw)
+    return data
+
+
+class _Unseekable(io.RawIOBase):
+    # zipfile can't go back to fill in the local headers of what it writes
+    # to this, so it writes zero sizes there, and a descriptor after each
+    # entry, like most streaming zip writers
+    def __init__(self):
+        super().__init__()
+        self.written = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.written.write(b)
+
+
+def zipfile_bytes(src, compress_type=zipfile.ZIP_DEFLATED, seekable=True):
+    # with seekable=True, what older senders did: sizes in the local
+    # headers, no descriptors
+    f = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(f, "w", compress_type) as zf:
+        for name in FILES:
+            zf.write(src / name, name)
+        zf.write(src / "sub" / "empty-dir", "sub/empty-dir/")
+    return f.getvalue() if seekable else f.written.getvalue()
+
+
+def extract(data, dest, chunk_size):
+    u = unzip.StreamingUnzipper(str(dest))
+    for i in range(0, len(data), chunk_size):
+        u.write(data[i:i + chunk_size])
+    u.close()
+
+
+def check(dest):
+    for name, data in FILES.items():
+        assert (dest / name).read_bytes() == data
+    assert (dest / "sub" / "empty-dir").is_dir()
+    assert stat.S_IMODE(os.stat(dest / "top").st_mode) == 0o751
+
+
+@pytest.mark.parametrize("chunk_size", [1, 1000, 2**20])
+@pytest.mark.parametrize("kind", ["stored", "deflated", "zipfile"])
+def test_extract(source, tmp_path, kind, chunk_size):
+    if kind == "stored":
+        data = zipwriter_bytes(source)
+    elif kind == "deflated":
+        data = zipfile_bytes(source, seekable=False)
+    else:
+        data = zipfile_bytes(source)
+    dest = tmp_path / "dest"
+    extract(data, dest, chunk_size)
+    check(dest)
+
+
+def test_ended_early(source, tmp_path):
+    data = zipwriter_bytes(source)
+    u = unzip.StreamingUnzipper(str(tmp_path / "dest"))
+    u.write(data[:-10])
+    with pytest.raises(zipfile.BadZipFile, match="ended early"):
+        u.close()
+
+
+def test_trailing_data(source, tmp_path):
+    data = zipwriter_bytes(source)
+    u = unzip.StreamingUnzipper(str(tmp_path / "dest"))
+    with pytest.raises(zipfile.BadZipFile, match="after the end"):
+        u.write(data + b"extra")
+
+
+def test_stored_without_sizes(source, tmp_path):
+    # we can't tell where such an entry ends without guessing, so we don't
+    data = zipfile_bytes(source, zipfile.ZIP_STORED, seekable=False)
+    with pytest.raises(zipfile.BadZipFile, match="Bad CRC-32 or size"):
+        extract(data, tmp_path / "dest", 1000)
+
+
+def test_zipwriter_zip64(monkeypatch, source, tmp_path):
+    # every size and offset (and the entry count) gets zip64 fields
+    monkeypatch.setattr(zipwriter, "ZIP64_LIMIT", 1)
+    monkeypatch.setattr(zipwriter, "ZIP64_COUNT_LIMIT", 1)
+    data = zipwriter_bytes(source)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.read("sub/a") == FILES["sub/a"]
+    dest = tmp_path / "dest"
+    extract(data, dest, 1000)
+    check(dest)
+
+
+def test_zipwriter_changed(source):
+    zw = zipwriter.ZipWriter()
+    zw.add_path(str(source / "top"), "top")
+    (source / "top").write_bytes(b"longer than it was")
+    with pytest.raises(RuntimeError, match="changed while we were sending"):
+        b"".join(zw)
+
+
+def test_bad_crc(source, tmp_path):
+    data = zipfile_bytes(source)
+    # corrupt the stored CRC of the first entry
+    data = data[:14] + bytes([data[14] ^ 0xff]) + data[15:]
+    with pytest.raises(zipfile.BadZipFile, match="Bad CRC-32"):
+        extract(data, tmp_path / "dest", 1000)
+
+
+def test_not_a_zip(tmp_path):
+    u = unzip.StreamingUnzipper(str(tmp_path / "dest"))
+    with pytest.raises(zipfile.BadZipFile, match="unexpected data"):
+        u.write(b"not a zip file")
+
+
+def test_unsupported(tmp_path):
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w", zipfile.ZIP_BZIP2) as zf:
+        zf.writestr("a", b"data")
+    with pytest.raises(zipfile.BadZipFile, match="compression method 12"):
+        extract(f.getvalue(), tmp_path / "dest", 1000)
+
+
+@pytest.mark.parametrize("name", [
+    "/etc/passwd",
+    "../haha",
+    "../dest-plus-hyphen/haha",
+])
+def test_malicious(tmp_path, name):
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w") as zf:
+        zf.writestr(name, b"evil")
+    with pytest.raises(ValueError, match="malicious zipfile"):
+        extract(f.getvalue(), tmp_path / "dest", 1000)
+    assert os.listdir(tmp_path) == []
+
+
+def extract_one(zf, info, extract_dir):
+    # like Receiver._extract_file
+    out_path = unzip.extract_path(extract_dir, info.filename)
+    zf.extract(info.filename, path=extract_dir)
+    os.chmod(out_path, info.external_attr >> 16)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+@pytest.mark.parametrize("max_size", [0, 10**7])
+def test_extract_parallel(source, tmp_path, workers, max_size):
+    # max_size=0 spools to a real file (so it's read with pread), a big one
+    # leaves it in memory until extract_parallel() rolls it over
+    f = tempfile.SpooledTemporaryFile(max_size=max_size)
+    f.write(zipfile_bytes(source))
+    dest = tmp_path / "dest"
+    unzip.extract_parallel(f, str(dest), extract_one, workers=workers)
+    check(dest)
+    f.close()
+
+
+def test_extract_parallel_malicious(tmp_path):
+    f = tempfile.TemporaryFile()
+    with zipfile.ZipFile(f, "w") as zf:
+        zf.writestr("fine", b"data")
+        zf.writestr("../haha", b"evil")
+    with pytest.raises(ValueError, match="malicious zipfile"):
+        unzip.extract_parallel(f, str(tmp_path / "dest"), extract_one)
+    assert not (tmp_path / "haha").exists()
+    f.close()
+
+
+def test_positional_file(tmp_path):
+    fn = tmp_path / "data"
+    fn.write_bytes(bytes(range(256)))
+    with open(fn, "rb") as f:
+        a = io.BufferedReader(unzip._PositionalFile(f.fileno()))
+        b = io.BufferedReader(unzip._PositionalFile(f.fileno()))
+        a.seek(10)
+        b.seek(-6, io.SEEK_END)
+        assert a.read(3) == bytes([10, 11, 12])
+        assert b.read() == bytes(range(250, 256))
+        assert a.tell() == 13
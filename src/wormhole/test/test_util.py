@@ -1,8 +1,15 @@
+import hashlib
+import io
+import os
+import threading
 import unicodedata
 
 from unittest import mock
 
+import pytest
+
 from .. import util
+from ..timing import DebugTiming
 
 def test_to_bytes():
     b = util.to_bytes("abc")
@@ -55,3 +62,74 @@ def test_no_statvfs():
             assert util.estimate_free_space(".") is None
     except AttributeError:  # raised by mock.get_original()
         pass
+
+
+def test_hash_prefix():
+    f = io.BytesIO(b"abcdefgh")
+    f.seek(5)
+    hasher = util.hash_prefix(f, 6, chunk_size=4)
+    assert hasher.digest() == hashlib.sha256(b"abcdef").digest()
+    hasher.update(b"gh")
+    assert hasher.digest() == hashlib.sha256(b"abcdefgh").digest()
+    assert util.hash_prefix(f, 0).digest() == hashlib.sha256().digest()
+    with pytest.raises(ValueError):
+        util.hash_prefix(f, 9)
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fallocate"),
+                    reason="no posix_fallocate")
+def test_preallocate(tmp_path):
+    fn = tmp_path / "f"
+    with open(fn, "wb") as f:
+        f.write(b"abc")
+        if not util.preallocate(f, 10):
+            pytest.skip("filesystem can't preallocate")
+        assert os.fstat(f.fileno()).st_size == 10
+        assert util.preallocate(f, 5)  # already big enough
+        assert f.tell() == 3
+        f.write(b"def")
+    assert fn.read_bytes() == b"abcdef" + b"\0" * 4
+
+
+def test_preallocate_unsupported(tmp_path):
+    with open(tmp_path / "f", "wb") as f:
+        with mock.patch("os.posix_fallocate", side_effect=OSError(95, "no"),
+                        create=True):
+            assert util.preallocate(f, 10) is False
+
+
+def test_threaded_hasher():
+    timing = DebugTiming()
+    h = util.ThreadedHasher(hashlib.sha256(b"ab"), timing, max_queued=2)
+    for data in [b"cd", b"ef", b"gh"]:
+        h.update(data)
+    assert h.copy().digest() == hashlib.sha256(b"abcdefgh").digest()
+    h.update(b"ij")
+    assert h.hexdigest() == hashlib.sha256(b"abcdefghij").hexdigest()
+    assert h.digest() == hashlib.sha256(b"abcdefghij").digest()
+    assert not h._thread.is_alive()
+    assert h.hashed == 8
+    [ev] = timing._events
+    assert ev._name == "hash"
+    assert ev._stop is not None
+    assert ev._details["bytes"] == 8
+    assert set(ev._details) == {"bytes", "busy", "MBps"}
+
+
+def test_threaded_hasher_close():
+    h = util.ThreadedHasher(max_queued=2)
+    with mock.patch.object(h, "_hasher") as hasher:
+        # stall the hashing thread, and fill the queue behind it
+        started, stall = threading.Event(), threading.Event()
+        hasher.update.side_effect = lambda data: (started.set(), stall.wait())
+        h.update(b"one")
+        started.wait()
+        h.update(b"two")
+        h.update(b"three")
+        # close() doesn't wait for the queue to drain
+        h.close()
+        stall.set()
+        h._thread.join(5)
+    assert not h._thread.is_alive()
+    assert hasher.update.mock_calls == [mock.call(b"one")]
+    h.close()  # harmless
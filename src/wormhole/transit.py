@@ -1,16 +1,23 @@
+import functools
+import mmap
 import os
+import queue
 import socket
+import stat
+import struct
 import sys
+import threading
 import time
-from binascii import hexlify, unhexlify
+from binascii import hexlify
 from collections import deque
 
 from nacl.secret import SecretBox
 from twisted.internet import (address, defer, endpoints, error, interfaces,
-                              protocol, task)
+                              protocol, threads)
 from twisted.internet.defer import inlineCallbacks
 from twisted.protocols import policies
-from twisted.python import log
+from twisted.python import failure, log
+from twisted.python.threadpool import ThreadPool
 from twisted.python.runtime import platformType
 from zope.interface import implementer
 
@@ -63,6 +70,23 @@ class BadNonce(TransitError):
 #  sender -> receiver: nevermind\n
 #
 # and closes the socket.
+#
+# If both sides advertised the "striped-v1" ability, the sender may accept
+# additional connections (after the first) as "stripes" of the same transfer.
+# It tells each of those:
+#
+#  sender -> receiver: go N\n
+#
+# where N (starting at 1) is the stripe number, which is also mixed into the
+# record keys for that connection, so no two connections share a nonce
+# sequence.
+#
+# If the receiver advertised the "probe-v1" ability, a sender with a
+# selection window may measure each connection before deciding, by sending
+# (any number of times, before the "go" or "nevermind"):
+#
+#  sender -> receiver: probe N\n, then N bytes of padding
+#  receiver -> sender: probed\n (once all N bytes have arrived)
 
 # So the receiver looks for "transit sender TXID_HEX ready\n\ngo\n" and hangs
 # up upon the first wrong byte. The sender lookgs for "transit receiver
@@ -90,12 +114,165 @@ def build_sided_relay_handshake(key, side):
 
 TIMEOUT = 60  # seconds
 
+# each record on the wire is a 4-byte big-endian length, followed by that
+# many bytes of SecretBox output (a 24-byte big-endian nonce, then the MAC
+# and ciphertext)
+RECORD_LENGTH = struct.Struct(">L")
+# we only ever count up from zero, so the top 16 bytes of the nonce stay zero
+NONCE = struct.Struct(">16xQ")
+assert NONCE.size == SecretBox.NONCE_SIZE
+
+# The file-transfer protocol originally used t.p.basic.FileSender, which
+# produces 16KiB records. Newer receivers tell the sender (in their answer)
+# that they can handle records up to MAX_RECORD_SIZE, which costs far fewer
+# Python calls and nonces per byte. Peers that say nothing get the default.
+DEFAULT_RECORD_SIZE = 2**14
+MAX_RECORD_SIZE = 2**18
+
+# In striped mode, bulk data records are prefixed with their offset in the
+# stream, so the receiver can put them back in order.
+STRIPE_OFFSET = struct.Struct(">Q")
+MAX_STRIPES = 8
+# how much out-of-order data we'll hold before pausing the stripes that are
+# running ahead
+STRIPE_REORDER_LIMIT = 2**23
+
+# With crypto_workers=, records are encrypted and decrypted by a pool of
+# threads (PyNaCl releases the GIL), rather than on the reactor thread. This
+# is how many bytes of records each direction of a connection may have
+# queued up for those threads before we stop accepting more: the sender's
+# producer is paused, or we stop reading from the socket.
+CRYPTO_QUEUE_SIZE = 2**22
+
+
+def default_crypto_workers(cpus=None):
+    """How many crypto threads the CLI should use: none (so records are
+    encrypted inline, on the reactor thread) with only one CPU, where a
+    thread could not run in parallel and would only add handoffs."""
+    if cpus is None:
+        cpus = os.cpu_count() or 1
+    if cpus <= 1:
+        return 0
+    return min(4, cpus)
+
+
+DEFAULT_CRYPTO_WORKERS = default_crypto_workers()
+
+# With select_window=, the sender doesn't simply use the first connection to
+# finish negotiation. It probes every connection that finishes within the
+# window, with an empty probe (to measure the RTT) followed by one of
+# PROBE_SIZE bytes (to measure throughput), and then uses the fastest one.
+# This is only a rough heuristic: a new connection is still in TCP slow
+# start, so a probe that fits in a few windows mostly measures the RTT
+# again. PROBE_SIZE is large enough to take several round trips on a
+# typical link, and anything that delivers it in under PROBE_RESOLUTION
+# seconds is faster than we can tell apart, so all of those count as equally
+# fast and the one with the lowest RTT wins. A relay connection must be more
+# than DIRECT_PREFERENCE times faster than the best direct connection to be
+# chosen over it.
+PROBE_SIZE = 2**21
+PROBE_RESOLUTION = 0.01
+MAX_PROBE_SIZE = 2**22
+DIRECT_PREFERENCE = 1.25
+
+
+class _CryptoPipeline:
+    """I run a function (encryption or decryption) over batches of records
+    in a thread pool, and hand the results back, on the reactor thread, in
+    the same order the batches were submitted. Batches are worked on in
+    parallel."""
+
+    def __init__(self, reactor, threadpool, deliver, failed, drained):
+        self._reactor = reactor
+        self._threadpool = threadpool
+        self._deliver = deliver  # called with the results of each batch
+        self._failed = failed  # called with a Failure, then nothing else
+        self._drained = drained  # called when we're no longer full()
+        self._batches = deque()  # [done, results, size], in order
+        self._queued_bytes = 0
+        self._flushing = False
+        self._broken = False
+        self._idle_observers = []
+
+    def submit(self, f, batch, size):
+        entry = [False, None, size]
+        self._batches.append(entry)
+        self._queued_bytes += size
+        d = threads.deferToThreadPool(self._reactor, self._threadpool, f,
+                                      batch)
+
+        def _done(res):
+            entry[0] = True
+            entry[1] = res
+            self._flush()
+
+        d.addBoth(_done)
+
+    def full(self):
+        return self._queued_bytes >= CRYPTO_QUEUE_SIZE
+
+    def busy(self):
+        return bool(self._batches)
+
+    def whenIdle(self):
+        d = defer.Deferred()
+        if self._batches:
+            self._idle_observers.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def _flush(self):
+        # delivering results may cause more batches to be submitted, or
+        # finished, so don't recurse
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._batches and self._batches[0][0]:
+                (_, res, size) = self._batches.popleft()
+                self._queued_bytes -= size
+                if self._broken:
+                    continue
+                if isinstance(res, failure.Failure):
+                    self._broken = True
+                    self._failed(res)
+                    continue
+                self._deliver(res)
+        finally:
+            self._flushing = False
+        if not self.full() and not self._broken:
+            self._drained()
+        if not self._batches:
+            observers, self._idle_observers = self._idle_observers, []
+            for d in observers:
+                d.callback(None)
+
+
+class _TransportProducer:
+    # When encryption is done in threads, the producer that writes to a
+    # Connection (like a FileSender) has to wait for room in both the
+    # transport and the encryption queue, so we register one of these with
+    # the transport, and it tells the Connection what the transport wants.
+    def __init__(self, connection):
+        self._connection = connection
+
+    def pauseProducing(self):
+        self._connection._transport_wants_data(False)
+
+    def resumeProducing(self):
+        self._connection._transport_wants_data(True)
+
+    def stopProducing(self):
+        self._connection._stop_producer()
+
 
 @implementer(interfaces.IProducer, interfaces.IConsumer)
 class Connection(protocol.Protocol, policies.TimeoutMixin):
     def __init__(self, owner, relay_handshake, start, description):
         self.state = "too-early"
-        self.buf = b""
+        self.buf = bytearray()
+        self._buf_offset = 0
         self.owner = owner
         self.relay_handshake = relay_handshake
         self.start = start
@@ -108,6 +285,19 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._consumer_deferred = None
         self._inbound_records = deque()
         self._waiting_reads = deque()
+        self._closed_observers = []
+        self.stripe = 0
+        self._probe_remaining = None
+        # these are only used when records are encrypted in threads
+        self._encryptor = None
+        self._decryptor = None
+        self._producer = None
+        self._streaming = None
+        self._producer_paused = False
+        self._pumping = False
+        self._transport_paused = False
+        self._consumer_paused = False
+        self._reading_paused = False
 
     def connectionMade(self):
         self.setTimeout(TIMEOUT)  # does timeoutConnection() when it expires
@@ -146,12 +336,76 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     def _check_and_remove(self, expected):
         # any divergence is a handshake error
         if not self.buf.startswith(expected[:len(self.buf)]):
-            raise BadHandshake(f"got {self.buf!r} want {expected!r}")
+            raise BadHandshake(f"got {bytes(self.buf)!r} want {expected!r}")
         if len(self.buf) < len(expected):
             return False  # keep waiting
         self.buf = self.buf[len(expected):]
         return True
 
+    def _check_for_decision(self):
+        # "go\n" for the first connection, "go N\n" for an extra stripe
+        if not self.buf.startswith(b"go "):
+            return self._check_and_remove(b"go\n")
+        eol = self.buf.find(b"\n")
+        if eol == -1:
+            if len(self.buf) > len(b"go %d\n" % MAX_STRIPES):
+                raise BadHandshake(f"got {bytes(self.buf)!r} want go N")
+            return False  # keep waiting
+        line, self.buf = bytes(self.buf[:eol]), self.buf[eol + 1:]
+        try:
+            stripe = int(line[len(b"go "):])
+        except ValueError:
+            raise BadHandshake(f"got {line!r} want go N")
+        if not 0 < stripe < self.owner._negotiated_stripes():
+            raise BadHandshake(f"unexpected stripe {stripe}")
+        self.stripe = stripe
+        return True
+
+    def _answer_probes(self):
+        # Each "probe N\n" is followed by N bytes of padding, which we
+        # discard before saying "probed\n". Returns True once there's
+        # nothing left in the buffer but (perhaps) the sender's decision.
+        while True:
+            if self._probe_remaining is not None:
+                discard = min(self._probe_remaining, len(self.buf))
+                del self.buf[:discard]
+                self._probe_remaining -= discard
+                if self._probe_remaining:
+                    return False
+                self._probe_remaining = None
+                self.transport.write(b"probed\n")
+            if not self.buf.startswith(b"p"):
+                return True
+            if not self.owner.answers_probes:
+                raise BadHandshake(f"got {bytes(self.buf)!r} want go")
+            eol = self.buf.find(b"\n")
+            if eol == -1:
+                if len(self.buf) > len(b"probe %d\n" % MAX_PROBE_SIZE):
+                    raise BadHandshake(f"got {bytes(self.buf)!r} want probe N")
+                return False  # keep waiting
+            line, self.buf = bytes(self.buf[:eol]), self.buf[eol + 1:]
+            try:
+                if not line.startswith(b"probe "):
+                    raise ValueError
+                size = int(line[len(b"probe "):])
+            except ValueError:
+                raise BadHandshake(f"got {line!r} want probe N")
+            if not 0 <= size <= MAX_PROBE_SIZE:
+                raise BadHandshake(f"probe too large: {size}")
+            self._probe_remaining = size
+
+    def send_probe(self, size):
+        """Ask the receiver to tell us when it has received 'size' bytes. The
+        owner's probe_answered() is called when it does."""
+        assert self.state in ("handshake", "probing")
+        self.transport.writeSequence([b"probe %d\n" % size, bytes(size)])
+
+    def decide(self, state):
+        """The owner has finished probing us: state is "go" or "nevermind"."""
+        assert self.state == "probing"
+        self.state = state
+        self.dataReceived(b"")  # cycle the state machine
+
     def _dataReceived(self, data):
         # protocol is:
         #  (maybe: send relay handshake, wait for ok)
@@ -178,14 +432,22 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # side (the sender) to make a decision. If we're the sender,
             # we'll either be moved to state "go" (send GO and move directly
             # to state "records") or state "nevermind" (send NEVERMIND and
-            # hang up).
+            # hang up), or to state "probing" while the sender measures this
+            # connection (and maybe others) before calling decide().
 
+        if self.state == "probing":
+            while (self.state == "probing"
+                   and self._check_and_remove(b"probed\n")):
+                self.owner.probe_answered(self)
+            return
         if self.state == "wait-for-decision":
-            if not self._check_and_remove(b"go\n"):
+            if not self._answer_probes():
+                return
+            if not self._check_for_decision():
                 return
             self._negotiationSuccessful()
         if self.state == "go":
-            GO = b"go\n"
+            GO = b"go\n" if not self.stripe else b"go %d\n" % self.stripe
             self.transport.write(GO)
             self._negotiationSuccessful()
         if self.state == "nevermind":
@@ -202,53 +464,132 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     def _negotiationSuccessful(self):
         self.state = "records"
         self.setTimeout(None)
-        send_key = self.owner._sender_record_key()
+        send_key = self.owner._sender_record_key(self.stripe)
         self.send_box = SecretBox(send_key)
         self.send_nonce = 0
-        receive_key = self.owner._receiver_record_key()
+        receive_key = self.owner._receiver_record_key(self.stripe)
         self.receive_box = SecretBox(receive_key)
         self.next_receive_nonce = 0
+        threadpool = self.owner._crypto_threadpool()
+        if threadpool:
+            reactor = self.owner._reactor
+            self._encryptor = _CryptoPipeline(
+                reactor, threadpool, self.transport.writeSequence,
+                self._crypto_failed, self._update_producer)
+            self._decryptor = _CryptoPipeline(
+                reactor, threadpool, self._records_decrypted,
+                self._crypto_failed, self._update_reading)
         d, self._negotiation_d = self._negotiation_d, None
         d.callback(self)
 
     def dataReceivedRECORDS(self):
+        # self.buf only ever grows at the end, so rather than re-slicing it
+        # for every record (which copies everything left behind), we walk it
+        # with a read offset and discard the consumed prefix once per read.
+        # recordReceived() might cause more data to arrive (and be parsed)
+        # before it returns, so the offset lives on self.
+        buf = self.buf
+        batch = []
+        batch_size = 0
         while True:
-            if len(self.buf) < 4:
-                return
-            length = int(hexlify(self.buf[:4]), 16)
-            if len(self.buf) < 4 + length:
-                return
-            encrypted, self.buf = self.buf[4:4 + length], self.buf[4 + length:]
-
-            record = self._decrypt_record(encrypted)
-            self.recordReceived(record)
-
-    def _decrypt_record(self, encrypted):
-        nonce_buf = encrypted[:SecretBox.NONCE_SIZE]  # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
+            start = self._buf_offset
+            if len(buf) - start < RECORD_LENGTH.size:
+                break
+            (length,) = RECORD_LENGTH.unpack_from(buf, start)
+            end = start + RECORD_LENGTH.size + length
+            if len(buf) < end:
+                break
+            # release the views before delivering the record, since the
+            # buffer cannot be resized while any are outstanding
+            with memoryview(buf) as view, \
+                 view[start + RECORD_LENGTH.size:end] as encrypted:
+                if self._decryptor:
+                    # the nonce is in the clear, so we can check the order
+                    # here, and leave the expensive part for the threads
+                    batch.append(self._check_nonce(encrypted))
+                    batch_size += length
+                else:
+                    record = self._decrypt_record(encrypted)
+            self._buf_offset = end
+            if not self._decryptor:
+                self.recordReceived(record)
+        if self._buf_offset:
+            del buf[:self._buf_offset]
+            self._buf_offset = 0
+        if batch:
+            self._decryptor.submit(self._decrypt_batch, batch, batch_size)
+            self._update_reading()
+
+    def _check_nonce(self, encrypted):
+        # 'encrypted' may be a memoryview into our receive buffer. PyNaCl
+        # wants bytes, so the nonce and ciphertext are each copied exactly
+        # once here, and we don't hold any derived views afterwards.
+        nonce_buf = bytes(encrypted[:SecretBox.NONCE_SIZE])  # prepended
+        nonce = int.from_bytes(nonce_buf, "big")
         if nonce != self.next_receive_nonce:
             raise BadNonce(
                 "received out-of-order record: got %d, expected %d" %
                 (nonce, self.next_receive_nonce))
         self.next_receive_nonce += 1
-        record = self.receive_box.decrypt(encrypted)
-        return record
+        return (nonce_buf, bytes(encrypted[SecretBox.NONCE_SIZE:]))
+
+    def _decrypt_record(self, encrypted):
+        (nonce_buf, ciphertext) = self._check_nonce(encrypted)
+        return self.receive_box.decrypt(ciphertext, nonce_buf)
+
+    def _decrypt_batch(self, batch):
+        # this runs in a worker thread
+        return [self.receive_box.decrypt(ciphertext, nonce_buf)
+                for (nonce_buf, ciphertext) in batch]
+
+    def _records_decrypted(self, records):
+        for record in records:
+            self.recordReceived(record)
+
+    def _crypto_failed(self, f):
+        log.err(f, "transit record encryption/decryption failed")
+        self.transport.loseConnection()
 
     def describe(self):
         return self._description
 
     def send_record(self, record):
-        if not isinstance(record, bytes):
-            raise InternalError
-        assert SecretBox.NONCE_SIZE == 24
-        assert self.send_nonce < 2**(8 * 24)
-        assert len(record) < 2**(8 * 4)
-        nonce = unhexlify(f"{self.send_nonce:048x}")  # big-endian
-        self.send_nonce += 1
-        encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify(f"{len(encrypted):08x}")  # always 4 bytes long
-        self.transport.write(length)
-        self.transport.write(encrypted)
+        self.send_records([record])
+
+    def send_records(self, records):
+        """Encrypt a batch of records and hand all of them (and their length
+        prefixes) to the transport with a single writeSequence() call."""
+        for record in records:
+            if not isinstance(record, bytes):
+                raise InternalError
+            assert len(record) < 2**(8 * 4) - SecretBox.NONCE_SIZE - \
+                SecretBox.MACBYTES
+        if self._encryptor:
+            # the nonces are allocated now, so the threads can encrypt
+            # batches in any order, and the pipeline writes them in order
+            batch = (self.send_nonce, records)
+            self.send_nonce += len(records)
+            self._encryptor.submit(self._encrypt_batch, batch,
+                                   sum(len(record) for record in records))
+            self._update_producer()
+            return
+        self.transport.writeSequence(self._encrypt_records(records))
+
+    def _encrypt_records(self, records):
+        pieces = self._encrypt_batch((self.send_nonce, records))
+        self.send_nonce += len(records)
+        return pieces
+
+    def _encrypt_batch(self, batch):
+        # this may run in a worker thread, so it must not touch self.send_nonce
+        (first_nonce, records) = batch
+        pieces = []
+        for (i, record) in enumerate(records):
+            nonce = NONCE.pack(first_nonce + i)  # big-endian
+            encrypted = self.send_box.encrypt(record, nonce)
+            pieces.append(RECORD_LENGTH.pack(len(encrypted)))
+            pieces.append(encrypted)
+        return pieces
 
     def recordReceived(self, record):
         if self._consumer:
@@ -270,7 +611,12 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             d.callback(r)
 
     def close(self):
-        self.transport.loseConnection()
+        if self._encryptor and self._encryptor.busy():
+            # finish sending the records we've already accepted
+            self._encryptor.whenIdle().addCallback(
+                lambda _: self.transport.loseConnection())
+        else:
+            self.transport.loseConnection()
         while self._waiting_reads:
             d = self._waiting_reads.popleft()
             d.errback(error.ConnectionClosed())
@@ -279,11 +625,26 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._error = BadHandshake("timeout")
         self.transport.loseConnection()
 
+    def whenClosed(self):
+        """Return a Deferred that fires (with None) when this connection is
+        lost, for whatever reason."""
+        d = defer.Deferred()
+        self._closed_observers.append(d)
+        return d
+
     def connectionLost(self, reason=None):
         self.setTimeout(None)
+        if self._decryptor and self._decryptor.busy():
+            # deliver the records that arrived before the connection was lost
+            self._decryptor.whenIdle().addCallback(
+                lambda _: self.connectionLost(reason))
+            return
         while self._waiting_reads:
             d = self._waiting_reads.popleft()
             d.errback(error.ConnectionClosed())
+        observers, self._closed_observers = self._closed_observers, []
+        for d in observers:
+            d.callback(None)
 
         d, self._negotiation_d = self._negotiation_d, None
         # the Deferred is only relevant until negotiation finishes, so skip
@@ -308,24 +669,89 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     # the transport. The 'producer' is something like a t.p.basic.FileSender
     def registerProducer(self, producer, streaming):
         assert interfaces.IConsumer.providedBy(self.transport)
-        self.transport.registerProducer(producer, streaming)
+        if not self._encryptor:
+            self.transport.registerProducer(producer, streaming)
+            return
+        self._producer = producer
+        self._streaming = streaming
+        self._producer_paused = False
+        self._transport_paused = False
+        self.transport.registerProducer(_TransportProducer(self), True)
+        self._update_producer()
 
     def unregisterProducer(self):
+        self._producer = None
         self.transport.unregisterProducer()
 
+    def _transport_wants_data(self, wants):
+        self._transport_paused = not wants
+        self._update_producer()
+
+    def _stop_producer(self):
+        producer, self._producer = self._producer, None
+        if producer:
+            producer.stopProducing()
+
+    def _update_producer(self):
+        # with threaded encryption, our producer may only run while the
+        # transport and the encryption queue both have room
+        if not self._producer:
+            return
+        if self._streaming:
+            blocked = self._transport_paused or self._encryptor.full()
+            if blocked and not self._producer_paused:
+                self._producer_paused = True
+                self._producer.pauseProducing()
+            elif not blocked and self._producer_paused:
+                self._producer_paused = False
+                self._producer.resumeProducing()
+            return
+        # a pull producer (like basic.FileSender) writes one chunk each time
+        # we ask, so keep asking while there's room
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            while (self._producer and not self._transport_paused
+                   and not self._encryptor.full()):
+                self._producer.resumeProducing()
+        finally:
+            self._pumping = False
+
     def write(self, data):
         self.send_record(data)
 
+    def writeSequence(self, data):
+        self.send_records(data)
+
     # IProducer methods, for inbound flow-control. We pass these through to
-    # the transport.
+    # the transport (unless we're already holding it back, because the
+    # decryption queue is full).
     def stopProducing(self):
         self.transport.stopProducing()
 
     def pauseProducing(self):
-        self.transport.pauseProducing()
+        if not self._decryptor:
+            self.transport.pauseProducing()
+            return
+        self._consumer_paused = True
+        self._update_reading()
 
     def resumeProducing(self):
-        self.transport.resumeProducing()
+        if not self._decryptor:
+            self.transport.resumeProducing()
+            return
+        self._consumer_paused = False
+        self._update_reading()
+
+    def _update_reading(self):
+        paused = self._consumer_paused or self._decryptor.full()
+        if paused and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pauseProducing()
+        elif not paused and self._reading_paused:
+            self._reading_paused = False
+            self.transport.resumeProducing()
 
     # Helper methods
 
@@ -404,10 +830,12 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
 class OutboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
 
-    def __init__(self, owner, relay_handshake, description):
+    def __init__(self, owner, relay_handshake, description, endpoint=None):
         self.owner = owner
         self.relay_handshake = relay_handshake
         self._description = description
+        self.endpoint = endpoint  # so we can open more stripes to it later
+        self.for_stripes = False
         self.start = time.time()
 
     def buildProtocol(self, addr):
@@ -429,6 +857,7 @@ class InboundConnectionFactory(protocol.ClientFactory):
         self.start = time.time()
         self._inbound_d = defer.Deferred(self._cancel)
         self._pending_connections = set()
+        self.for_stripes = False
 
     def whenDone(self):
         return self._inbound_d
@@ -465,14 +894,316 @@ class InboundConnectionFactory(protocol.ClientFactory):
         return res
 
     def _proto_succeeded(self, p):
-        self._shutdown()
+        if self._inbound_d.called:
+            # we're only still listening because the peer is going to open
+            # more stripes
+            self.owner._add_stripe(p)
+            return
         self._inbound_d.callback(p)
+        if not self.for_stripes:
+            self._shutdown()
 
     def _proto_failed(self, f):
         # ignore these two, let Twisted log everything else
         f.trap(BadHandshake, defer.CancelledError)
 
 
+class _StripeProducer:
+    # We register one of these (as a streaming producer) with each stripe's
+    # transport, so we can tell which stripes have room for more data.
+    def __init__(self, striped, stripe):
+        self._striped = striped
+        self._stripe = stripe
+
+    def pauseProducing(self):
+        self._striped._stripe_paused(self._stripe)
+
+    def resumeProducing(self):
+        self._striped._stripe_resumed(self._stripe)
+
+    def stopProducing(self):
+        self._striped._stripe_paused(self._stripe)
+
+
+@implementer(interfaces.IConsumer)
+class _StripeConsumer:
+    # and one of these is the consumer of each stripe's inbound records
+    def __init__(self, striped, stripe):
+        self._striped = striped
+        self._stripe = stripe
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, record):
+        self._striped._stripe_data(self._stripe, record)
+
+
+@implementer(interfaces.IProducer, interfaces.IConsumer)
+class StripedConnection:
+    """I glue together several Connections (stripes) to the same peer, and
+    behave like a single Connection.
+
+    send_record() and receive_record() use the first (primary) connection,
+    for control messages like the final ack. Bulk data, which is written to
+    me as an IConsumer (e.g. by a FileSender), is spread across every
+    stripe that has room for it. Each of those records starts with the
+    offset of its data in the stream, and on the receiving side the
+    consumer attached with connectConsumer() or writeToFile() gets the data
+    back in order.
+
+    New stripes can be added at any time with add_stripe(), and are used
+    right away."""
+
+    def __init__(self, primary):
+        self._primary = primary
+        self._stripes = []
+        self.closed = False
+        self._closed_observers = []
+        # outbound data
+        self._producer = None
+        self._streaming = None
+        self._producer_paused = False
+        self._pumping = False
+        self._writable = []  # stripes whose transports want more data
+        self._next_writer = 0
+        self._write_offset = 0
+        # inbound data
+        self._consumer = None
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+        self._read_offset = 0
+        self._reorder = {}  # offset -> data that arrived early
+        self._reorder_bytes = 0
+        self._held = set()  # stripes we paused until the gap is filled
+        self.add_stripe(primary)
+
+    def describe(self):
+        extra = len(self._stripes) - 1
+        if not extra:
+            return self._primary.describe()
+        return "%s (+%d stripes)" % (self._primary.describe(), extra)
+
+    def stripe_count(self):
+        return len(self._stripes)
+
+    def add_stripe(self, stripe):
+        self._stripes.append(stripe)
+        stripe.whenClosed().addCallback(lambda _: self._stripe_lost(stripe))
+        if self._consumer:
+            stripe.connectConsumer(_StripeConsumer(self, stripe))
+        if self._producer:
+            stripe.registerProducer(_StripeProducer(self, stripe), True)
+            self._stripe_resumed(stripe)
+
+    def _stripe_lost(self, stripe):
+        if stripe in self._stripes:
+            self._stripes.remove(stripe)
+        if stripe in self._writable:
+            self._writable.remove(stripe)
+        self._held.discard(stripe)
+        if self._consumer_deferred:
+            # whatever was in flight on that stripe is gone, so we'll never
+            # see the whole stream
+            d = self._consumer_deferred
+            self.disconnectConsumer()
+            d.errback(error.ConnectionClosed())
+        if stripe is self._primary or not self._stripes:
+            self.close()
+
+    # control records go over the primary connection
+
+    def send_record(self, record):
+        self._primary.send_record(record)
+
+    def receive_record(self):
+        return self._primary.receive_record()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for stripe in list(self._stripes):
+            stripe.close()
+        observers, self._closed_observers = self._closed_observers, []
+        for d in observers:
+            d.callback(None)
+
+    def whenClosed(self):
+        d = defer.Deferred()
+        if self.closed:
+            d.callback(None)
+        else:
+            self._closed_observers.append(d)
+        return d
+
+    # IConsumer methods, for outbound data
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        self._streaming = streaming
+        self._producer_paused = False
+        for stripe in self._stripes:
+            stripe.registerProducer(_StripeProducer(self, stripe), True)
+        self._writable = list(self._stripes)
+        self._pump()
+
+    def unregisterProducer(self):
+        self._producer = None
+        for stripe in self._stripes:
+            stripe.unregisterProducer()
+        self._writable = []
+
+    def write(self, data):
+        if not self._stripes:
+            return  # closed, like writing to a disconnected transport
+        stripes = self._writable or self._stripes
+        stripe = stripes[self._next_writer % len(stripes)]
+        self._next_writer += 1
+        offset = self._write_offset
+        self._write_offset += len(data)
+        stripe.send_record(STRIPE_OFFSET.pack(offset) + data)
+
+    def writeSequence(self, data):
+        # the whole batch goes to one stripe, as a single send_records()
+        if not self._stripes:
+            return
+        stripes = self._writable or self._stripes
+        stripe = stripes[self._next_writer % len(stripes)]
+        self._next_writer += 1
+        records = []
+        for chunk in data:
+            records.append(STRIPE_OFFSET.pack(self._write_offset) + chunk)
+            self._write_offset += len(chunk)
+        stripe.send_records(records)
+
+    def _stripe_paused(self, stripe):
+        if stripe in self._writable:
+            self._writable.remove(stripe)
+        if self._producer and self._streaming and not self._writable:
+            if not self._producer_paused:
+                self._producer_paused = True
+                self._producer.pauseProducing()
+
+    def _stripe_resumed(self, stripe):
+        if stripe not in self._writable and stripe in self._stripes:
+            self._writable.append(stripe)
+        self._pump()
+
+    def _pump(self):
+        if not self._producer:
+            return
+        if self._streaming:
+            if self._producer_paused and self._writable:
+                self._producer_paused = False
+                self._producer.resumeProducing()
+            return
+        # a pull producer (like basic.FileSender) writes one chunk each time
+        # we ask, so keep asking while any stripe has room
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            while self._producer and self._writable:
+                self._producer.resumeProducing()
+        finally:
+            self._pumping = False
+
+    # IProducer methods, for inbound flow-control
+
+    def stopProducing(self):
+        for stripe in self._stripes:
+            stripe.stopProducing()
+
+    def pauseProducing(self):
+        for stripe in self._stripes:
+            stripe.pauseProducing()
+
+    def resumeProducing(self):
+        for stripe in self._stripes:
+            if stripe not in self._held:
+                stripe.resumeProducing()
+
+    def connectConsumer(self, consumer, expected=None):
+        """Like Connection.connectConsumer, but the consumer sees the data
+        from every stripe, in order (without the offsets)."""
+        if self._consumer:
+            raise RuntimeError(
+                f"A consumer is already attached: {self._consumer!r}")
+        consumer.registerProducer(self, True)
+        self._consumer = consumer
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = expected
+        d = None
+        if expected is not None:
+            d = defer.Deferred()
+        self._consumer_deferred = d
+        if expected == 0:
+            # write empty record to kick consumer into shutdown
+            self._writeToConsumer(b"")
+            return d
+        for stripe in list(self._stripes):
+            if self._consumer:
+                stripe.connectConsumer(_StripeConsumer(self, stripe))
+        return d
+
+    def disconnectConsumer(self):
+        for stripe in self._stripes:
+            if stripe._consumer:
+                stripe.disconnectConsumer()
+        for stripe in self._held:
+            stripe.resumeProducing()
+        self._held.clear()
+        self._consumer.unregisterProducer()
+        self._consumer = None
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+
+    def writeToFile(self, f, expected, progress=None, hasher=None):
+        fc = FileConsumer(f, progress, hasher)
+        return self.connectConsumer(fc, expected)
+
+    def _stripe_data(self, stripe, record):
+        (offset,) = STRIPE_OFFSET.unpack_from(record)
+        data = record[STRIPE_OFFSET.size:]
+        if offset < self._read_offset or offset in self._reorder:
+            raise TransitError(f"duplicate striped record at {offset}")
+        if offset > self._read_offset:
+            self._reorder[offset] = data
+            self._reorder_bytes += len(data)
+            if self._reorder_bytes > STRIPE_REORDER_LIMIT:
+                # The gap must be on some other stripe, since each stripe
+                # delivers its own records in order, so it's safe to pause
+                # this one until the gap is filled.
+                self._held.add(stripe)
+                stripe.pauseProducing()
+            return
+        self._writeToConsumer(data)
+        while self._consumer and self._read_offset in self._reorder:
+            data = self._reorder.pop(self._read_offset)
+            self._reorder_bytes -= len(data)
+            self._writeToConsumer(data)
+        if self._held and self._reorder_bytes <= STRIPE_REORDER_LIMIT // 2:
+            held, self._held = self._held, set()
+            for stripe in held:
+                stripe.resumeProducing()
+
+    def _writeToConsumer(self, data):
+        self._read_offset += len(data)
+        self._consumer.write(data)
+        self._consumer_bytes_written += len(data)
+        if self._consumer_bytes_expected is not None:
+            if self._consumer_bytes_written >= self._consumer_bytes_expected:
+                d = self._consumer_deferred
+                self.disconnectConsumer()
+                d.callback(self._consumer_bytes_written)
+
+
 def allocate_tcp_port():
     """Return an (integer) available TCP port on localhost. This briefly
     listens on the port in question, then closes it right away."""
@@ -550,8 +1281,103 @@ def there_can_be_only_one(contenders):
     return _ThereCanBeOnlyOne(contenders).run()
 
 
+class _Attempt:
+    """A connection attempt which might not have been started yet. The
+    Deferred is created up front, so it can be handed to
+    there_can_be_only_one(), and cancelling it before start() is called
+    means start() will do nothing. Whoever calls start() must chain the
+    result into .d"""
+
+    def __init__(self, start):
+        self._start = start
+        self._started = None
+        self.d = defer.Deferred(self._cancel)
+
+    def _cancel(self, _):
+        if self._started:
+            self._started.cancel()
+
+    def start(self):
+        if self.d.called:
+            return None
+        self._started = self._start()
+        return self._started
+
+
+class _Staggered:
+    """Start groups of connection attempts one after another, in the style
+    of Happy Eyeballs (RFC 8305). The first group is started right away. Each
+    later group is started when the one before it has had get_delay()
+    seconds to succeed, or as soon as every attempt started so far has
+    failed, whichever comes first. get_delay() may change its mind as we
+    learn more about the network: call reschedule() when it does.
+
+    Each group is a list of functions that start an attempt and return a
+    Deferred. run() returns a list of Deferreds, one per attempt.
+    """
+
+    def __init__(self, reactor, groups, get_delay):
+        self._reactor = reactor
+        self._groups = deque([_Attempt(start) for start in group]
+                             for group in groups)
+        self._get_delay = get_delay
+        self._outstanding = 0
+        self._last_start = None
+        self._timer = None
+        self._stopped = False
+
+    def run(self):
+        attempts = [a.d for group in self._groups for a in group]
+        self._start_next()
+        return attempts
+
+    def stop(self):
+        self._stopped = True
+        t, self._timer = self._timer, None
+        if t and t.active():
+            t.cancel()
+
+    def reschedule(self):
+        if self._timer and self._timer.active():
+            self._timer.reset(self._next_start_delay())
+
+    def _next_start_delay(self):
+        if not self._outstanding:
+            return 0
+        now = self._reactor.seconds()
+        return max(0, self._last_start + self._get_delay() - now)
+
+    def _start_next(self):
+        self._timer = None
+        if self._stopped or not self._groups:
+            return
+        self._last_start = self._reactor.seconds()
+        for a in self._groups.popleft():
+            d = a.start()
+            if d is not None:
+                self._outstanding += 1
+                d.addBoth(self._finished)
+                d.chainDeferred(a.d)
+        if self._groups:
+            self._timer = self._reactor.callLater(self._next_start_delay(),
+                                                  self._start_next)
+
+    def _finished(self, res):
+        self._outstanding -= 1
+        if (isinstance(res, failure.Failure)
+                and not res.check(defer.CancelledError)):
+            # everything we tried has failed, so don't wait any longer
+            if not self._outstanding:
+                self.reschedule()
+        return res
+
+
 class Common:
+    # how long to wait for direct connections before trying the relay, at
+    # most and at least, and in multiples of the connect RTT when we know it
     RELAY_DELAY = 2.0
+    MIN_RELAY_DELAY = 0.25
+    RELAY_DELAY_RTTS = 4
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
 
     def __init__(self,
@@ -559,7 +1385,11 @@ class Common:
                  no_listen=False,
                  tor=None,
                  reactor=None,
-                 timing=None):
+                 timing=None,
+                 stripes=1,
+                 crypto_workers=0,
+                 select_window=0,
+                 listener=None):
         self._side = bytes_to_hexstr(os.urandom(8))  # unicode
         if transit_relay:
             if not isinstance(transit_relay, str):
@@ -575,9 +1405,35 @@ class Common:
         self._tor = tor
         self._transit_key = None
         self._no_listen = no_listen
+        # a listener.SharedListener, to use instead of a port of our own
+        self._shared_listener = listener
         self._waiting_for_transit_key = []
         self._listener = None
         self._winner = None
+        # smoothed TCP connect time, as in RFC 6298
+        self._srtt = None
+        self._staggered = None
+        # how many parallel connections we're willing to use, and how many
+        # the peer said it was willing to use (if it knows about stripes)
+        self._stripes = min(stripes, MAX_STRIPES)
+        self._their_stripes = 1
+        self._next_stripe = 1
+        self._striped = None
+        self._stripe_listener = None
+        self._stripe_listener_timer = None
+        # 0 means we encrypt and decrypt on the reactor thread
+        self._crypto_workers = crypto_workers
+        self._threadpool = None
+        self._threadpool_trigger = None
+        # with a selection window, the sender probes the candidates that
+        # arrive within that many seconds of the first, and picks the best
+        self._select_window = select_window
+        self._their_probes = False
+        self._candidates = {}  # Connection -> [sent, answered..]
+        self._probe_results = []
+        self._select_timer = None
+        self._select_event = None
+        self._window_closed = False
         if reactor is None:
             from twisted.internet import reactor
         self._reactor = reactor
@@ -587,7 +1443,12 @@ class Common:
     def _build_listener(self):
         if self._no_listen or self._tor:
             return ([], None)
-        portnum = allocate_tcp_port()
+        if self._shared_listener:
+            portnum = self._shared_listener.start()
+            ep = self._shared_listener.endpoint(self._inbound_prefix())
+        else:
+            portnum = allocate_tcp_port()
+            ep = endpoints.serverFromString(self._reactor, "tcp:%d" % portnum)
         addresses = ipaddrs.find_addresses()
         non_loopback_addresses = [a for a in addresses if a != "127.0.0.1"]
         if non_loopback_addresses:
@@ -597,11 +1458,17 @@ class Common:
         direct_hints = [
             DirectTCPV1Hint(str(addr), portnum, 0.0) for addr in addresses
         ]
-        ep = endpoints.serverFromString(self._reactor, "tcp:%d" % portnum)
         return direct_hints, ep
 
+    def _inbound_prefix(self):
+        # a SharedListener recognizes our inbound connections by the peer's
+        # handshake, which we can't know until we have the key
+        d = self._get_transit_key()
+        d.addCallback(lambda _: self._expect_this())
+        return d
+
     def get_connection_abilities(self):
-        return [
+        abilities = [
             {
                 "type": "direct-tcp-v1"
             },
@@ -609,6 +1476,21 @@ class Common:
                 "type": "relay-v1"
             },
         ]
+        if self._stripes > 1:
+            abilities.append({"type": "striped-v1", "stripes": self._stripes})
+        return abilities
+
+    def add_connection_abilities(self, abilities):
+        for a in abilities:  # ability structs
+            if a.get("type", "") == "striped-v1":
+                stripes = a.get("stripes")
+                if isinstance(stripes, int) and stripes > 1:
+                    self._their_stripes = stripes
+            if a.get("type", "") == "probe-v1":
+                self._their_probes = True
+
+    def _negotiated_stripes(self):
+        return min(self._stripes, self._their_stripes)
 
     @inlineCallbacks
     def get_connection_hints(self):
@@ -661,6 +1543,20 @@ class Common:
             # lp is an IListeningPort
             # self._listener_port = lp # for tests
             def _stop_listening(res):
+                if (self._negotiated_stripes() > 1
+                        and not isinstance(res, failure.Failure)):
+                    # an inbound connection won, so the peer will be
+                    # connecting to us again for the other stripes
+                    f.for_stripes = True
+                    if self.is_sender:
+                        f._shutdown()
+                    # else the sender may have started its next connection
+                    # before our "go" arrived, so leave the pending ones be:
+                    # the sender will say "nevermind" to any losers
+                    self._stripe_listener = lp
+                    self._stripe_listener_timer = self._reactor.callLater(
+                        TIMEOUT, self._stop_stripe_listener)
+                    return res
                 lp.stopListening()
                 return res
 
@@ -715,31 +1611,24 @@ class Common:
         else:
             return build_sender_handshake(self._transit_key)  # + b"go\n"
 
-    def _sender_record_key(self):
+    def _record_key(self, purpose, stripe):
         assert self._transit_key
+        CTXinfo = b"transit_record_" + purpose + b"_key"
+        if stripe:
+            CTXinfo += b"_stripe_%d" % stripe
+        return HKDF(self._transit_key, SecretBox.KEY_SIZE, CTXinfo=CTXinfo)
+
+    def _sender_record_key(self, stripe=0):
         if self.is_sender:
-            return HKDF(
-                self._transit_key,
-                SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_sender_key")
+            return self._record_key(b"sender", stripe)
         else:
-            return HKDF(
-                self._transit_key,
-                SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_receiver_key")
+            return self._record_key(b"receiver", stripe)
 
-    def _receiver_record_key(self):
-        assert self._transit_key
+    def _receiver_record_key(self, stripe=0):
         if self.is_sender:
-            return HKDF(
-                self._transit_key,
-                SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_receiver_key")
+            return self._record_key(b"receiver", stripe)
         else:
-            return HKDF(
-                self._transit_key,
-                SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_sender_key")
+            return self._record_key(b"sender", stripe)
 
     def set_transit_key(self, key):
         assert isinstance(key, bytes), type(key)
@@ -771,37 +1660,105 @@ class Common:
             # connections, so those connections will know what to say when
             # they connect
             winner = yield self._connect()
+            if self._negotiated_stripes() > 1:
+                winner = self._start_striping(winner)
+            if self._threadpool:
+                winner.whenClosed().addCallback(
+                    lambda _: self._stop_crypto_threadpool())
         return winner
 
+    def _crypto_threadpool(self):
+        # our Connections call this when they finish negotiation
+        if not self._crypto_workers:
+            return None
+        if not self._threadpool:
+            self._threadpool = ThreadPool(minthreads=0,
+                                          maxthreads=self._crypto_workers,
+                                          name="transit-crypto")
+            self._threadpool.start()
+            self._threadpool_trigger = self._reactor.addSystemEventTrigger(
+                "during", "shutdown", self._stop_crypto_threadpool)
+        return self._threadpool
+
+    def _stop_crypto_threadpool(self):
+        pool, self._threadpool = self._threadpool, None
+        if pool:
+            self._reactor.removeSystemEventTrigger(self._threadpool_trigger)
+            pool.stop()
+
+    def _start_striping(self, primary):
+        # Both sides agreed to use stripes. Whoever made the winning
+        # connection makes the rest of them too, to the same place (for a
+        # relay, that's both of us). The sender hands them out as they
+        # finish negotiation, and the StripedConnection starts using each
+        # one as soon as it arrives.
+        self._striped = StripedConnection(primary)
+        self._striped.whenClosed().addCallback(
+            lambda _: self._stop_stripe_listener())
+        factory = getattr(primary, "factory", None)
+        if isinstance(factory, OutboundConnectionFactory):
+            is_relay = factory.relay_handshake is not None
+            self._open_stripes(factory.endpoint, primary.describe(), is_relay,
+                               self._negotiated_stripes() - 1)
+        return self._striped
+
+    @inlineCallbacks
+    def _open_stripes(self, ep, description, is_relay, count):
+        # One at a time: the relay drops any spare connections from one side
+        # when it pairs up a connection, so we must not race ourselves.
+        for i in range(count):
+            if self._striped.closed:
+                return
+            try:
+                p = yield self._start_connector(ep, description, is_relay,
+                                                for_stripes=True)
+            except (BadHandshake, defer.CancelledError, error.ConnectError):
+                log.msg("unable to open transit stripe to " + description)
+                return
+            self._add_stripe(p)
+
+    def _add_stripe(self, p):
+        if self._striped is None or self._striped.closed:
+            p.close()
+            return
+        self._striped.add_stripe(p)
+        if self._striped.stripe_count() >= self._negotiated_stripes():
+            self._stop_stripe_listener()
+
+    def _stop_stripe_listener(self):
+        lp, self._stripe_listener = self._stripe_listener, None
+        if lp:
+            lp.stopListening()
+        t, self._stripe_listener_timer = self._stripe_listener_timer, None
+        if t and t.active():
+            t.cancel()
+
     def _connect(self):
-        # It might be nice to wire this so that a failure in the direct hints
-        # causes the relay hints to be used right away (fast failover). But
-        # none of our current use cases would take advantage of that: if we
-        # have any viable direct hints, then they're either going to succeed
-        # quickly or hang for a long time.
         contenders = []
         if self._listener_d:
             contenders.append(self._listener_d)
-        relay_delay = 0
 
+        direct = []
         for hint_obj in self._their_direct_hints:
             # Check the hint type to see if we can support it (e.g. skip
-            # onion hints on a non-Tor client). Do not increase relay_delay
-            # unless we have at least one viable hint.
+            # onion hints on a non-Tor client).
             ep = endpoint_from_hint_obj(hint_obj, self._tor, self._reactor)
             if not ep:
                 continue
-            d = self._start_connector(ep,
-                                      describe_hint_obj(hint_obj, False, self._tor))
-            contenders.append(d)
-            relay_delay = self.RELAY_DELAY
+            direct.append(functools.partial(
+                self._start_connector, ep,
+                describe_hint_obj(hint_obj, False, self._tor)))
 
-        # Start trying the relays a few seconds after we start to try the
+        # Start trying the relays a little while after we start to try the
         # direct hints. The idea is to prefer direct connections, but not be
         # afraid of using a relay when we have direct hints that don't
         # resolve quickly. Many direct hints will be to unused local-network
         # IP addresses, which won't answer, and would take the full TCP
-        # timeout (30s or more) to fail.
+        # timeout (30s or more) to fail. How long "a little while" is
+        # depends upon how quickly the hints that do answer have answered
+        # (see _relay_delay), and if every direct hint fails outright, we
+        # don't wait at all. Each tier of relay priorities gets the same
+        # treatment.
 
         prioritized_relays = {}
         for rh in self._our_relay_hints:
@@ -811,27 +1768,59 @@ class Common:
                     prioritized_relays[priority] = set()
                 prioritized_relays[priority].add(hint_obj)
 
+        groups = [direct]
         for priority in sorted(prioritized_relays, reverse=True):
+            group = []
             for hint_obj in prioritized_relays[priority]:
                 ep = endpoint_from_hint_obj(hint_obj, self._tor, self._reactor)
                 if not ep:
                     continue
-                d = task.deferLater(
-                    self._reactor,
-                    relay_delay,
-                    self._start_connector,
-                    ep,
+                group.append(functools.partial(
+                    self._start_connector, ep,
                     describe_hint_obj(hint_obj, True, self._tor),
-                    is_relay=True)
-                contenders.append(d)
-            relay_delay += self.RELAY_DELAY
+                    is_relay=True))
+            if group:
+                groups.append(group)
 
+        self._staggered = _Staggered(self._reactor, groups, self._relay_delay)
+        contenders.extend(self._staggered.run())
         if not contenders:
             raise TransitError("No contenders for connection")
 
         winner = there_can_be_only_one(contenders)
+        winner.addBoth(self._connect_done)
         return self._not_forever(2 * TIMEOUT, winner)
 
+    def _connect_done(self, res):
+        staggered, self._staggered = self._staggered, None
+        if staggered:
+            staggered.stop()
+        t, self._select_timer = self._select_timer, None
+        if t and t.active():
+            t.cancel()
+        return res
+
+    def _relay_delay(self):
+        if self._srtt is None:
+            return self.RELAY_DELAY
+        delay = self.RELAY_DELAY_RTTS * self._srtt
+        return min(self.RELAY_DELAY, max(self.MIN_RELAY_DELAY, delay))
+
+    def _observe_connect(self, res, started):
+        # A refused connection took one round trip, just like a successful
+        # one. Other failures (timeouts, unreachable networks) tell us
+        # nothing about the RTT.
+        if (not isinstance(res, failure.Failure)
+                or res.check(error.ConnectionRefusedError)):
+            rtt = self._reactor.seconds() - started
+            if self._srtt is None:
+                self._srtt = rtt
+            else:
+                self._srtt = 0.875 * self._srtt + 0.125 * rtt
+            if self._staggered:
+                self._staggered.reschedule()
+        return res
+
     def _not_forever(self, timeout, d):
         """If the timer fires first, cancel the deferred. If the deferred fires
         first, cancel the timer."""
@@ -848,14 +1837,18 @@ class Common:
     def _build_relay_handshake(self):
         return build_sided_relay_handshake(self._transit_key, self._side)
 
-    def _start_connector(self, ep, description, is_relay=False):
+    def _start_connector(self, ep, description, is_relay=False,
+                         for_stripes=False):
         relay_handshake = None
         if is_relay:
             assert self._transit_key
             relay_handshake = self._build_relay_handshake()
-        f = OutboundConnectionFactory(self, relay_handshake, description)
+        f = OutboundConnectionFactory(self, relay_handshake, description,
+                                      endpoint=ep)
+        f.for_stripes = for_stripes
         d = ep.connect(f)
         # fires with protocol, or ConnectError
+        d.addBoth(self._observe_connect, self._reactor.seconds())
         d.addCallback(lambda p: p.startNegotiation())
         return d
 
@@ -867,20 +1860,111 @@ class Common:
         if not self.is_sender:
             return "wait-for-decision"
 
+        if not self._winner and self._select_window and self._their_probes:
+            return self._add_candidate(p)
+
         if self._winner:
+            factory = getattr(p, "factory", None)
+            if (self._striped and getattr(factory, "for_stripes", False)
+                    and self._next_stripe < self._negotiated_stripes()):
+                # this one was opened to be an additional stripe (and not
+                # left over from the initial race), so it gets a number
+                p.stripe = self._next_stripe
+                self._next_stripe += 1
+                return "go"
             # we already have a winner, so this one loses
             return "nevermind"
         # this one wins!
         self._winner = p
         return "go"
 
+    def _add_candidate(self, p):
+        now = self._reactor.seconds()
+        if not self._candidates and not self._window_closed:
+            self._select_event = self._timing.add(
+                "transit select", window=self._select_window)
+            self._select_timer = self._reactor.callLater(
+                self._select_window, self._close_window)
+        self._candidates[p] = [now]
+        p.send_probe(0)  # to measure the RTT
+        p.send_probe(PROBE_SIZE)  # and then the throughput
+        return "probing"
+
+    def probe_answered(self, p):
+        times = self._candidates.get(p)
+        if times is None:
+            return
+        times.append(self._reactor.seconds())
+        if len(times) < 3:
+            return
+        sent, empty, full = times
+        rtt = empty - sent
+        # below PROBE_RESOLUTION, the link is faster than we can measure
+        # with a probe this size, so those all tie (and RTT decides)
+        throughput = PROBE_SIZE / max(full - empty, PROBE_RESOLUTION)
+        is_relay = getattr(p, "relay_handshake", None) is not None
+        self._timing.add("transit probe", description=p.describe(),
+                         relay=is_relay, rtt=rtt, throughput=throughput)
+        self._probe_results.append((p, is_relay, rtt, throughput))
+        if self._window_closed:
+            self._select()
+
+    def _close_window(self):
+        self._select_timer = None
+        self._window_closed = True
+        self._select()
+
+    def _select(self):
+        # anything still probing when the window closes took longer than
+        # the ones that finished, so those are all we consider
+        results = [r for r in self._probe_results
+                   if r[0].state == "probing" and r[0]._negotiation_d]
+        if not results:
+            return  # wait for the next probe to finish
+        best = choose_probed_connection(results)
+        self._winner = best[0]
+        self._select_event.finish(winner=best[0].describe(),
+                                  relay=best[1], rtt=best[2],
+                                  throughput=best[3],
+                                  candidates=len(self._candidates))
+        candidates, self._candidates = self._candidates, {}
+        self._probe_results = []
+        best[0].decide("go")
+        for p in candidates:
+            if p is not best[0] and p.state == "probing":
+                p.decide("nevermind")
+
+
+def choose_probed_connection(results):
+    """Each result is a tuple of (connection, is_relay, rtt, throughput).
+    Return the one with the best throughput (breaking ties by RTT), except
+    that a relay must beat the best direct connection by more than
+    DIRECT_PREFERENCE."""
+    def speed(r):
+        return (r[3], -r[2])
+    best = max(results, key=speed)
+    direct = [r for r in results if not r[1]]
+    if best[1] and direct:
+        best_direct = max(direct, key=speed)
+        if best_direct[3] * DIRECT_PREFERENCE >= best[3]:
+            best = best_direct
+    return best
+
 
 class TransitSender(Common):
     is_sender = True
+    answers_probes = False
 
 
 class TransitReceiver(Common):
     is_sender = False
+    answers_probes = True
+
+    def get_connection_abilities(self):
+        # we can always answer a sender who wants to probe our connections
+        abilities = super().get_connection_abilities()
+        abilities.append({"type": "probe-v1"})
+        return abilities
 
 
 # based on twisted.protocols.ftp.FileConsumer, but don't close the filehandle
@@ -903,16 +1987,307 @@ class FileConsumer:
 
     def write(self, bytes):
         self._f.write(bytes)
-        if self._progress:
-            self._progress(len(bytes))
+        # hash first, so whatever 'progress' reports has been hashed too
         if self._hasher:
             self._hasher(bytes)
+        if self._progress:
+            self._progress(len(bytes))
 
     def unregisterProducer(self):
         assert self._producer
         self._producer = None
 
 
+# how much a WriteBehindFileConsumer will hold before pausing its producer
+WRITE_BEHIND = 2**23
+
+
+@implementer(interfaces.IConsumer)
+class WriteBehindFileConsumer:
+    """Like FileConsumer, but the file is written (and the data hashed) in a
+    background thread, so a slow disk doesn't stop us from draining the
+    network connection. Up to WRITE_BEHIND bytes may be waiting for the
+    writer: beyond that, we pause our producer until it catches up.
+
+    'progress' is called in the reactor thread as data arrives, 'hasher' in
+    the writer thread as the same data is written. Use call_in_writer() to
+    run something after everything written so far has reached the file.
+    close() must be called when the producer is done: it returns a Deferred
+    that fires once the writer has finished (or errbacks with whatever went
+    wrong while writing). It does not close the file."""
+
+    def __init__(self, f, progress=None, hasher=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._f = f
+        self._progress = progress
+        self._hasher = hasher
+        self._producer = None
+        self._paused = False
+        self._buffered = 0  # only touched in the reactor thread
+        self._failure = None
+        self._closed_d = None
+        self._queue = queue.Queue()  # bounded by pausing the producer
+        self._thread = threading.Thread(target=self._run,
+                                        name="wormhole-writer", daemon=True)
+        self._thread.start()
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        assert streaming
+
+    def unregisterProducer(self):
+        assert self._producer
+        # don't leave the connection stalled on our account
+        if self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+        self._producer = None
+
+    def write(self, data):
+        if self._failure:
+            return  # the producer is being stopped
+        self._buffered += len(data)
+        self._queue.put(functools.partial(self._write, data))
+        # after queueing the write, so anything 'progress' passes to
+        # call_in_writer() sees this data written and hashed
+        if self._progress:
+            self._progress(len(data))
+        if (self._buffered >= WRITE_BEHIND and self._producer
+                and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def call_in_writer(self, f, *args, **kwargs):
+        """Arrange for f(*args, **kwargs) to be called in the writer thread,
+        after everything passed to write() so far has been written (and
+        hashed). Nothing more is called once a write has failed."""
+        self._queue.put(functools.partial(f, *args, **kwargs))
+
+    def close(self):
+        assert not self._closed_d
+        self._closed_d = defer.Deferred()
+        self._queue.put(None)
+        return self._closed_d
+
+    # these run in the writer thread
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._reactor.callFromThread(self._finished)
+                return
+            if self._failure:
+                continue
+            try:
+                item()
+            except Exception:
+                self._failure = failure.Failure()
+                self._reactor.callFromThread(self._stop)
+
+    def _write(self, data):
+        self._f.write(data)
+        if self._hasher:
+            self._hasher(data)
+        self._reactor.callFromThread(self._written, len(data))
+
+    # the rest run in the reactor thread
+
+    def _written(self, length):
+        self._buffered -= length
+        if self._paused and self._buffered <= WRITE_BEHIND // 2:
+            self._paused = False
+            self._producer.resumeProducing()
+
+    def _stop(self):
+        if self._producer:
+            self._producer.stopProducing()
+
+    def _finished(self):
+        if self._failure:
+            self._closed_d.errback(self._failure)
+        else:
+            self._closed_d.callback(None)
+
+
+# how far ahead of the consumer a ReadAheadFileSender may read
+READ_AHEAD = 2**22
+
+
+def _map_file(f):
+    """Return a read-only mmap of 'f' if it is a (non-empty) regular file,
+    or None if it must be read the ordinary way."""
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    try:
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # empty files cannot be mapped, nor can files on some filesystems
+        return None
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+def _read_chunks(f, mm, size):
+    if mm is None:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+    # start wherever the file was positioned, e.g. when resuming
+    for pos in range(f.tell(), len(mm), size):
+        yield mm[pos:pos + size]
+
+
+@implementer(interfaces.IPushProducer)
+class ReadAheadFileSender:
+    """A replacement for twisted.protocols.basic.FileSender that reads the
+    file in a background thread, so a slow disk (or network filesystem, or
+    the zip stream of a directory) doesn't stall the reactor. Up to
+    READ_AHEAD bytes are read ahead of the consumer. Regular files are read
+    through mmap, anything else with f.read().
+
+    Unlike FileSender, I am a streaming producer: the consumer is expected to
+    pause me when it has enough data buffered."""
+
+    CHUNK_SIZE = 2**14
+    BATCH_SIZE = 16
+    lastSent = b""
+    deferred = None
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._queue = None
+        self._paused = False
+        self._stopped = False
+        # set by the reactor thread when it is waiting for the reader
+        self._starved = False
+
+    def beginFileTransfer(self, file, consumer, transform=None, hasher=None):
+        """Like FileSender.beginFileTransfer: send the rest of 'file' to
+        'consumer', passing each chunk through 'transform' (in the reactor
+        thread) first. If given, 'hasher' is called with each chunk in the
+        reader thread, where it may block (e.g. ThreadedHasher.update),
+        holding back the read-ahead rather than the reactor. Returns a
+        Deferred that fires with the last byte sent once everything has been
+        written."""
+        self.file = file
+        self.consumer = consumer
+        self.transform = transform
+        self.hasher = hasher
+        self.deferred = defer.Deferred()
+        self._queue = queue.Queue(max(2, READ_AHEAD // self.CHUNK_SIZE))
+        self._starved = True
+        consumer.registerProducer(self, True)
+        t = threading.Thread(target=self._read_all, name="wormhole-reader",
+                             daemon=True)
+        t.start()
+        return self.deferred
+
+    # these run in the reader thread
+
+    def _read_all(self):
+        try:
+            mm = _map_file(self.file)
+            try:
+                for chunk in _read_chunks(self.file, mm, self.CHUNK_SIZE):
+                    if self.hasher:
+                        self.hasher(chunk)
+                    if not self._put(chunk):
+                        return
+            finally:
+                if mm is not None:
+                    mm.close()
+        except Exception:
+            self._put(failure.Failure())
+        else:
+            self._put(None)  # EOF
+
+    def _put(self, item):
+        while not self._stopped:
+            try:
+                self._queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            if self._starved:
+                self._starved = False
+                self._reactor.callFromThread(self._deliver)
+            return True
+        return False
+
+    # the rest run in the reactor thread
+
+    def _deliver(self):
+        # consumers with writeSequence() (like Connection) get every chunk
+        # that is already waiting, up to BATCH_SIZE, in a single call, so
+        # they can encrypt and write them as one batch of records
+        batch_size = (self.BATCH_SIZE
+                      if hasattr(self.consumer, "writeSequence") else 1)
+        while not (self._paused or self._stopped):
+            # announce that we're waiting *before* looking, so the reader
+            # can't fill the queue in between and not tell us
+            self._starved = True
+            chunks = []
+            done = False
+            while len(chunks) < batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None or isinstance(item, failure.Failure):
+                    # EOF, or the reader failed
+                    done = True
+                    break
+                chunks.append(item)
+            if not (chunks or done):
+                return
+            self._starved = False
+            if chunks:
+                if self.transform:
+                    chunks = [self.transform(chunk) for chunk in chunks]
+                if len(chunks) == 1:
+                    self.consumer.write(chunks[0])
+                else:
+                    self.consumer.writeSequence(chunks)
+                self.lastSent = chunks[-1][-1:]
+            if done:
+                self._finish(item)
+                return
+
+    def _finish(self, f=None):
+        self._stopped = True
+        self.consumer.unregisterProducer()
+        d, self.deferred = self.deferred, None
+        if f is None:
+            d.callback(self.lastSent)
+        else:
+            d.errback(f)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._deliver()
+
+    def stopProducing(self):
+        self._stopped = True
+        d, self.deferred = self.deferred, None
+        if d:
+            d.errback(Exception("Consumer asked us to stop producing"))
+
+
 # the TransitSender/Receiver.connect() yields a Connection, on which you can
 # do send_record(), but what should the receive API be? set a callback for
 # inbound records? get a Deferred for the next record? The producer/consumer
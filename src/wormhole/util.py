@@ -1,6 +1,10 @@
 # No unicode_literals
+import hashlib
 import json
 import os
+import queue
+import threading
+import time
 import unicodedata
 from binascii import hexlify, unhexlify
 from cryptography.hazmat.primitives.kdf import hkdf
@@ -67,6 +71,107 @@ def bytes_to_dict(b):
     return d
 
 
+def hash_prefix(f, length, chunk_size=2**20):
+    """Return a sha256 hasher that has been fed the first 'length' bytes of
+    file 'f', ready to be fed the rest. This does blocking reads, so run it
+    with deferToThread(). Raises ValueError if the file is too short."""
+    hasher = hashlib.sha256()
+    f.seek(0)
+    remaining = length
+    while remaining:
+        data = f.read(min(chunk_size, remaining))
+        if not data:
+            raise ValueError("file is shorter than %d bytes" % length)
+        hasher.update(data)
+        remaining -= len(data)
+    return hasher
+
+
+class ThreadedHasher:
+    """A sha256 hasher (or a continuation of 'hasher') whose update() returns
+    right away, leaving the hashing to a dedicated thread. hashlib releases
+    the GIL while it works on large buffers, so this runs in parallel with
+    whatever the caller does next. update() keeps a reference to the data
+    rather than copying it, so the data must not change afterwards (bytes
+    never do). If more than 'max_queued' chunks are waiting, update() blocks
+    until the hashing thread catches up, so it should be called from a
+    thread that can afford to wait (like the reader of a
+    ReadAheadFileSender, or the writer of a WriteBehindFileConsumer), which
+    then holds back whatever feeds it.
+
+    copy() and digest() wait for the hashing thread to catch up, so call
+    them from a thread that is allowed to block (e.g. with deferToThread).
+    digest() also stops the thread, after which update() must not be
+    called. If the hash is no longer wanted (say, the transfer failed),
+    close() stops the thread without waiting. If 'timing' is given, the
+    hashing throughput is recorded there as a "hash" event."""
+
+    def __init__(self, hasher=None, timing=None, max_queued=64):
+        self._hasher = hasher if hasher is not None else hashlib.sha256()
+        self._queue = queue.Queue(max_queued)
+        self._event = timing.add("hash") if timing else None
+        self._done = False
+        self._closed = False
+        self.hashed = 0  # bytes
+        self.busy = 0.0  # seconds spent in hasher.update()
+        self._thread = threading.Thread(target=self._run,
+                                        name="wormhole-hasher", daemon=True)
+        self._thread.start()
+
+    def update(self, data):
+        self._queue.put(data)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    return
+                if self._closed:
+                    continue  # discard whatever was still queued
+                start = time.perf_counter()
+                self._hasher.update(data)
+                self.busy += time.perf_counter() - start
+                self.hashed += len(data)
+            finally:
+                self._queue.task_done()
+
+    def copy(self):
+        """Return a plain hashlib copy of the state so far."""
+        self._queue.join()
+        return self._hasher.copy()
+
+    def digest(self):
+        if not self._done:
+            self._done = True
+            self._queue.put(None)
+            self._thread.join()
+            if self._event:
+                rate = self.hashed / self.busy if self.busy else 0
+                self._event.finish(bytes=self.hashed,
+                                   busy=round(self.busy, 6),
+                                   MBps=round(rate / 1e6, 1))
+        return self._hasher.digest()
+
+    def hexdigest(self):
+        return bytes_to_hexstr(self.digest())
+
+    def close(self):
+        """Stop the hashing thread, abandoning the hash. This doesn't block,
+        as long as nobody is calling update() at the same time."""
+        if self._done:
+            return
+        self._done = self._closed = True
+        # make room for the stop marker
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._queue.task_done()
+        self._queue.put(None)
+
+
 def estimate_free_space(target):
     # f_bfree is the blocks available to a root user. It might be more
     # accurate to use f_bavail (blocks available to non-root user), but we
@@ -80,6 +185,28 @@ def estimate_free_space(target):
         return None
 
 
+def preallocate(f, size):
+    """Ask the filesystem to reserve space for 'f' to grow to 'size' bytes,
+    so it can lay the file out contiguously, and so we run out of space now
+    rather than halfway through. This also extends the file to that size.
+    Returns False if the platform or filesystem can't do this. Where the
+    filesystem has no native support, posix_fallocate() may fall back to
+    writing zeros, so run this with deferToThread()."""
+    if not hasattr(os, "posix_fallocate"):
+        return False  # Windows, macOS
+    f.flush()
+    offset = os.fstat(f.fileno()).st_size
+    if size <= offset:
+        return True
+    try:
+        os.posix_fallocate(f.fileno(), offset, size - offset)
+    except OSError:
+        # e.g. EOPNOTSUPP. Running out of space (ENOSPC) will happen again
+        # when we write, and will be reported then.
+        return False
+    return True
+
+
 @attrs(repr=False, slots=True, hash=True)
 class _ProvidesValidator:
     interface = attrib()
@@ -196,16 +196,20 @@ class _DeferredWormhole:
 
     # todo: transit_relay_locations (plural) probably, and ability to
     # pass a list? (there's a TODO about this is connector.py too)
-    def dilate(self, transit_relay_location=None, no_listen=False, on_status_update=None, ping_interval=None, expected_subprotocols=None):
+    def dilate(self, transit_relay_location=None, no_listen=False, on_status_update=None, ping_interval=None, expected_subprotocols=None, listener=None):
         """
         :returns DilatedWormhole: an instance for accessing dilation
             functionality. This includes creating endpoints that open
             new subchannels (i.e. the OPEN goes from us to the other
             peer).
+
+        :param listener: a wormhole.listener.SharedListener to accept
+            inbound connections on, rather than a new port for each
+            connection generation.
         """
         if not self._enable_dilate:
             raise NotImplementedError
-        return self._boss.dilate(transit_relay_location, no_listen, on_status_update, ping_interval, expected_subprotocols)
+        return self._boss.dilate(transit_relay_location, no_listen, on_status_update, ping_interval, expected_subprotocols, listener)
 
     def close(self):
         # fails with WormholeError unless we established a connection